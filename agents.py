@@ -1,7 +1,16 @@
-from langchain.llms import OpenAI
 from indexer import product_descriptions
 
-llm = OpenAI()
+# created on first use, a worker that never falls back to the llm agent never builds it
+llm = None
+
+
+def get_llm():
+    global llm
+    if llm is None:
+        from langchain.llms import OpenAI
+
+        llm = OpenAI()
+    return llm
 
 
 class Agent:
@@ -18,7 +27,11 @@ class Agent:
 
     def __call__(self, query: str) -> str:
         constructed_query = self.construct_query(query=query)
-        return llm(constructed_query)
+        return get_llm()(constructed_query)
+
+    async def acall(self, query: str) -> str:
+        constructed_query = self.construct_query(query=query)
+        return await get_llm().apredict(constructed_query)
 
     def construct_query(self, query: str) -> str:
         separator = "\n\n"
@@ -32,8 +45,6 @@ class Agent:
         return constructed_query
 
 
-llm = OpenAI()
-
 classification_agent = Agent(
     purpose="Classify the user query into a product",
     evidence_to_aid_purpose="""
@@ -0,0 +1,386 @@
+"""
+Approximate nearest neighbour index (IVF-PQ) over the binary embedding store, in numpy.
+
+python ann.py [--synthetic 200000] [--nprobe 1 4 16 64] [--rerank 0 50 200]
+    benchmarks recall and latency against exact search on the persisted indexes
+
+- IVF: the rows are clustered by k-means, a query only scans the rows of its nprobe closest clusters
+- PQ: within a cluster each row is stored as the 8 bit codes of its residual, one per sub vector,
+  a query scores a row with table lookups instead of a dot product over the full dimension
+- the best `rerank` approximate candidates are re-scored with the full precision rows,
+  so the scores handed to the similarity cutoff stay exact cosine similarities
+- persisted as ann_index.npz next to embeddings.bin, used only for indexes of ANN_MIN_NODES or more
+"""
+import argparse
+import hashlib
+import os
+import time
+import logging
+
+import numpy as np
+
+from embedding_store import normalise_rows
+
+ANN_INDEX_FNAME = "ann_index.npz"
+# indexes with fewer nodes get no ann index, exact search is as fast there
+ANN_MIN_NODES: int = 20_000
+# coarse clusters, 0 picks about 4 * sqrt(num_nodes)
+ANN_NLIST: int = 0
+# product quantizer sub vectors per embedding, each stored as one byte
+ANN_PQ_SUBSPACES: int = 96
+# recall/latency knobs read at query time:
+# clusters scanned per query
+ANN_NPROBE: int = 16
+# approximate candidates re-scored exactly, 0 returns the approximate scores
+ANN_RERANK: int = 100
+# k-means settings of the build
+ANN_KMEANS_ITERATIONS: int = 20
+ANN_TRAIN_SAMPLE: int = 50_000
+ANN_KMEANS_CHUNK: int = 4096
+
+logger = logging.getLogger("indexer.ann")
+
+
+def node_ids_fingerprint(node_ids: list[str]) -> str:
+    "ties an ann index to the exact rows of the store it was built from"
+    digest = hashlib.blake2b(digest_size=16)
+    for node_id in node_ids:
+        digest.update(node_id.encode("utf-8") + b"\x00")
+    return digest.hexdigest()
+
+
+def nearest_centroids(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    "index of the closest centroid (euclidean) of every row, in chunks to bound memory"
+    centroid_norms = (centroids**2).sum(axis=1)
+    assignment = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), ANN_KMEANS_CHUNK):
+        chunk = data[start : start + ANN_KMEANS_CHUNK]
+        distances = centroid_norms[None, :] - 2.0 * (chunk @ centroids.T)
+        assignment[start : start + ANN_KMEANS_CHUNK] = distances.argmin(axis=1)
+    return assignment
+
+
+def kmeans(
+    data: np.ndarray, k: int, iterations: int, rng: np.random.Generator
+) -> np.ndarray:
+    "lloyd's k-means, empty clusters are re-seeded with random rows"
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(data, centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = (
+            np.add.reduceat(data[order], starts, axis=0) / counts[filled, None]
+        )
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), size=len(empty), replace=False)]
+    return centroids
+
+
+def subspace_count(dim: int, requested: int) -> int:
+    "largest divisor of dim that is at most requested"
+    for m in range(min(requested, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+class IVFPQIndex:
+    """Inverted file index with product quantized residuals.
+    - centroids: (nlist, dim) coarse clusters
+    - codebooks: (m, ksub, dim / m) residual sub vector centroids
+    - rows and codes are stored grouped by cluster, offsets[c]:offsets[c + 1] is cluster c
+    - rows are positions in the embedding matrix it was built from
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        codebooks: np.ndarray,
+        offsets: np.ndarray,
+        rows: np.ndarray,
+        codes: np.ndarray,
+        fingerprint: str,
+    ) -> None:
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.offsets = offsets
+        self.rows = rows
+        self.codes = codes
+        self.fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        matrix: np.ndarray,
+        node_ids: list[str],
+        nlist: int = 0,
+        subspaces: int = ANN_PQ_SUBSPACES,
+        seed: int = 0,
+    ) -> "IVFPQIndex":
+        "matrix: the normalised (num_nodes, dim) rows of the embedding store"
+        rng = np.random.default_rng(seed)
+        data = np.asarray(matrix, dtype=np.float32)
+        num_rows, dim = data.shape
+        nlist = nlist or ANN_NLIST or max(1, int(4 * np.sqrt(num_rows)))
+        nlist = min(nlist, num_rows)
+        train = data
+        if num_rows > ANN_TRAIN_SAMPLE:
+            train = data[rng.choice(num_rows, size=ANN_TRAIN_SAMPLE, replace=False)]
+
+        start = time.perf_counter()
+        centroids = kmeans(train, nlist, ANN_KMEANS_ITERATIONS, rng)
+        assignment = nearest_centroids(data, centroids)
+        logger.debug(
+            f"ann: {nlist} clusters over {num_rows} rows in {time.perf_counter() - start:.1f}s"
+        )
+
+        start = time.perf_counter()
+        m = subspace_count(dim, subspaces)
+        dsub = dim // m
+        ksub = min(256, len(train))
+        train_residuals = train - centroids[nearest_centroids(train, centroids)]
+        codebooks = np.stack(
+            [
+                kmeans(
+                    np.ascontiguousarray(train_residuals[:, j * dsub : (j + 1) * dsub]),
+                    ksub,
+                    ANN_KMEANS_ITERATIONS,
+                    rng,
+                )
+                for j in range(m)
+            ]
+        )
+        residuals = data - centroids[assignment]
+        codes = np.stack(
+            [
+                nearest_centroids(
+                    np.ascontiguousarray(residuals[:, j * dsub : (j + 1) * dsub]),
+                    codebooks[j],
+                )
+                for j in range(m)
+            ],
+            axis=1,
+        ).astype(np.uint8)
+        logger.debug(
+            f"ann: {m} x {ksub} product quantizer in {time.perf_counter() - start:.1f}s"
+        )
+
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+        return cls(
+            centroids,
+            codebooks.astype(np.float32),
+            offsets.astype(np.int64),
+            order.astype(np.int64),
+            codes[order],
+            node_ids_fingerprint(node_ids),
+        )
+
+    def search(
+        self,
+        query: np.ndarray,
+        matrix: np.ndarray,
+        top_k: int,
+        row_mask: np.ndarray | None = None,
+        nprobe: int | None = None,
+        rerank: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (rows, scores) of one normalised query (dim,), sorted by descending score
+        - matrix: the full precision rows, used for the rerank
+        - row_mask: optional boolean mask over the rows, eg. one product of the combined index
+        """
+        nprobe = min(nprobe or ANN_NPROBE, self.nlist)
+        rerank = ANN_RERANK if rerank is None else rerank
+        coarse = self.centroids @ query
+        probed = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+
+        m, _ksub, dsub = self.codebooks.shape
+        # (m, ksub) inner product of every query sub vector with its codebook
+        lookup = np.einsum("msd,md->ms", self.codebooks, query.reshape(m, dsub))
+        rows = []
+        scores = []
+        for cluster in probed:
+            start, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if start == end:
+                continue
+            rows.append(self.rows[start:end])
+            # q.x = q.centroid + q.residual, the residual part is summed from the lookup table
+            scores.append(
+                coarse[cluster] + lookup[np.arange(m), self.codes[start:end]].sum(axis=1)
+            )
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows = np.concatenate(rows)
+        scores = np.concatenate(scores).astype(np.float32)
+        if row_mask is not None:
+            keep = row_mask[rows]
+            rows, scores = rows[keep], scores[keep]
+
+        candidates = top_k_of(scores, max(top_k, rerank))
+        rows, scores = rows[candidates], scores[candidates]
+        if rerank:
+            scores = np.asarray(matrix[rows] @ query, dtype=np.float32)
+        best = top_k_of(scores, top_k)
+        return rows[best], scores[best]
+
+    def persist(self, persist_dir: str) -> None:
+        path = os.path.join(persist_dir, ANN_INDEX_FNAME)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                codebooks=self.codebooks,
+                offsets=self.offsets,
+                rows=self.rows,
+                codes=self.codes,
+                fingerprint=np.asarray(self.fingerprint),
+            )
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "IVFPQIndex | None":
+        path = os.path.join(persist_dir, ANN_INDEX_FNAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(
+                data["centroids"],
+                data["codebooks"],
+                data["offsets"],
+                data["rows"],
+                data["codes"],
+                str(data["fingerprint"]),
+            )
+
+
+def top_k_of(scores: np.ndarray, top_k: int) -> np.ndarray:
+    "positions of the top_k scores, best first"
+    k = min(top_k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(k)
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def remove_ann_index(persist_dir: str) -> None:
+    path = os.path.join(persist_dir, ANN_INDEX_FNAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def benchmark(
+    matrix: np.ndarray,
+    node_ids: list[str],
+    queries: np.ndarray,
+    top_k: int,
+    nprobes: list[int],
+    reranks: list[int],
+) -> list[dict]:
+    "recall@top_k of the ann results against exact search, and latency per query"
+    start = time.perf_counter()
+    ann_index = IVFPQIndex.build(matrix, node_ids)
+    build_seconds = time.perf_counter() - start
+
+    exact_seconds = []
+    exact_rows = []
+    for query in queries:
+        start = time.perf_counter()
+        exact_rows.append(top_k_of(matrix @ query, top_k))
+        exact_seconds.append(time.perf_counter() - start)
+
+    results = [
+        {
+            "method": "exact",
+            "recall": 1.0,
+            "p50_ms": round(float(np.percentile(exact_seconds, 50)) * 1000, 4),
+            "p95_ms": round(float(np.percentile(exact_seconds, 95)) * 1000, 4),
+        }
+    ]
+    for nprobe in nprobes:
+        for rerank in reranks:
+            seconds = []
+            recalls = []
+            for query, expected in zip(queries, exact_rows):
+                start = time.perf_counter()
+                rows, _scores = ann_index.search(
+                    query, matrix, top_k, nprobe=nprobe, rerank=rerank
+                )
+                seconds.append(time.perf_counter() - start)
+                recalls.append(len(np.intersect1d(rows, expected)) / len(expected))
+            results.append(
+                {
+                    "method": f"ivfpq nprobe={nprobe} rerank={rerank}",
+                    "recall": round(float(np.mean(recalls)), 4),
+                    "p50_ms": round(float(np.percentile(seconds, 50)) * 1000, 4),
+                    "p95_ms": round(float(np.percentile(seconds, 95)) * 1000, 4),
+                }
+            )
+    print(
+        f"{len(node_ids)} rows, {ann_index.nlist} clusters, "
+        f"{ann_index.codes.shape[1]} byte codes, built in {build_seconds:.1f}s"
+    )
+    return results
+
+
+if __name__ == "__main__":
+    from embedding_store import MmapEmbeddingStore, mmap_store_exists
+    from indexer import PATH_RAG_INDEX
+    from utils import documents_to_index
+
+    parser = argparse.ArgumentParser(description="ivf-pq against exact search")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 50, ANN_RERANK])
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="grow the persisted rows to this many noisy copies, to model a large catalogue",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    matrices = []
+    node_ids = []
+    for doc_filename, _start_skip, _end_skip in documents_to_index:
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, doc_filename)
+        if mmap_store_exists(persist_dir):
+            store = MmapEmbeddingStore(persist_dir)
+            matrices.append(np.asarray(store.matrix, dtype=np.float32))
+            node_ids.extend(store.node_ids)
+        else:
+            print(f"skipping {persist_dir}: no embeddings.bin")
+    if not matrices:
+        raise SystemExit(
+            "no index has an embeddings.bin store, convert them with python embedding_store.py"
+        )
+    matrix = np.concatenate(matrices)
+    if args.synthetic > len(matrix):
+        copies = matrix[rng.integers(0, len(matrix), size=args.synthetic - len(matrix))]
+        noise = rng.normal(scale=0.02, size=copies.shape).astype(np.float32)
+        matrix = np.concatenate([matrix, normalise_rows(copies + noise)])
+        node_ids += [f"synthetic-{i}" for i in range(len(matrix) - len(node_ids))]
+
+    # queries: perturbed rows, the persisted embeddings are the only real vectors at hand
+    picked = matrix[rng.integers(0, len(matrix), size=args.queries)]
+    queries = normalise_rows(
+        picked + rng.normal(scale=0.03, size=picked.shape).astype(np.float32)
+    )
+    for result in benchmark(matrix, node_ids, queries, args.top_k, args.nprobe, args.rerank):
+        print(
+            f"{result['method']:<32} recall@{args.top_k} {result['recall']:.3f}  "
+            f"p50 {result['p50_ms']:.3f}ms  p95 {result['p95_ms']:.3f}ms"
+        )
@@ -0,0 +1,211 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+import logging
+
+import numpy as np
+
+from embedding_store import normalise_rows
+
+# a cached answer is reused when the new query is within this cosine distance
+ANSWER_CACHE_MAX_DISTANCE: float = 0.03
+ANSWER_CACHE_TTL_SECONDS: float = 24 * 60 * 60
+ANSWER_CACHE_MAX_ENTRIES: int = 2000
+# set to persist the cache across restarts
+ANSWER_CACHE_PERSIST: bool = False
+ANSWER_CACHE_PATH = "data/answer-cache.npz"
+# at most one write of the persisted cache per interval, answers stored in between
+# are written together, and pending ones at exit
+ANSWER_CACHE_PERSIST_INTERVAL: float = 30.0
+
+logger = logging.getLogger("indexer.answer_cache")
+
+
+@dataclass
+class CachedAnswer:
+    index_id: str
+    query_text: str
+    response_text: str
+    sources: list[int]
+    created_at: float
+    last_hit: float
+
+
+class SemanticAnswerCache:
+    """Answer cache keyed on (product index, query embedding).
+    - a query close enough to a cached one returns the stored (response_text, sources)
+    - entries expire after a ttl, least recently hit entries are evicted beyond max_entries
+    - one normalised embedding matrix per index, so lookup is a single matrix-vector product
+    """
+
+    def __init__(
+        self,
+        max_distance: float = ANSWER_CACHE_MAX_DISTANCE,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        persist_path: str | None = ANSWER_CACHE_PATH if ANSWER_CACHE_PERSIST else None,
+        persist_interval: float = ANSWER_CACHE_PERSIST_INTERVAL,
+    ) -> None:
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+        self._answers: dict[str, list[CachedAnswer]] = {}
+        self._embeddings: dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        # one writer at a time, lookups only wait on _lock while the snapshot is taken
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._last_persist = 0.0
+        if persist_path is not None:
+            if os.path.exists(persist_path):
+                self.load()
+            atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return sum(len(answers) for answers in self._answers.values())
+
+    def lookup(
+        self, index_id: str, query_embedding
+    ) -> tuple[str, list[int]] | None:
+        with self._lock:
+            self._expire(index_id)
+            embeddings = self._embeddings.get(index_id)
+            if embeddings is None or len(embeddings) == 0:
+                return None
+            query = normalise_rows(np.asarray(query_embedding, dtype=np.float32))
+            similarities = embeddings @ query
+            best = int(np.argmax(similarities))
+            distance = 1.0 - float(similarities[best])
+            if distance > self.max_distance:
+                return None
+            answer = self._answers[index_id][best]
+            answer.last_hit = time.time()
+        logger.debug(
+            f"answer cache hit for {index_id}, distance: {distance:.4f}, "
+            f"cached query: {answer.query_text}"
+        )
+        return answer.response_text, answer.sources
+
+    def store(
+        self,
+        index_id: str,
+        query_text: str,
+        query_embedding,
+        response_text: str,
+        sources: list[int],
+    ) -> None:
+        now = time.time()
+        embedding = normalise_rows(np.asarray(query_embedding, dtype=np.float32))
+        with self._lock:
+            answers = self._answers.setdefault(index_id, [])
+            answers.append(
+                CachedAnswer(index_id, query_text, response_text, sources, now, now)
+            )
+            previous = self._embeddings.get(index_id)
+            self._embeddings[index_id] = (
+                embedding[None, :] if previous is None else np.vstack([previous, embedding])
+            )
+            self._evict()
+            self._dirty = True
+        if self.persist_path is not None:
+            self.persist_if_due()
+
+    def invalidate(self, index_id: str) -> None:
+        "drop every answer for an index, eg. after it was rebuilt"
+        with self._lock:
+            self._answers.pop(index_id, None)
+            self._embeddings.pop(index_id, None)
+            self._dirty = True
+        logger.debug(f"answer cache invalidated for {index_id}")
+        if self.persist_path is not None:
+            # not debounced, stale answers must not come back after a restart
+            self.persist()
+
+    def _keep(self, index_id: str, keep: list[int]) -> None:
+        answers = self._answers[index_id]
+        self._answers[index_id] = [answers[i] for i in keep]
+        self._embeddings[index_id] = self._embeddings[index_id][keep]
+
+    def _expire(self, index_id: str) -> None:
+        answers = self._answers.get(index_id)
+        if not answers:
+            return
+        oldest_allowed = time.time() - self.ttl_seconds
+        keep = [i for i, answer in enumerate(answers) if answer.created_at >= oldest_allowed]
+        if len(keep) != len(answers):
+            self._keep(index_id, keep)
+
+    def _evict(self) -> None:
+        overflow = sum(len(answers) for answers in self._answers.values()) - self.max_entries
+        if overflow <= 0:
+            return
+        by_last_hit = sorted(
+            (answer.last_hit, index_id, i)
+            for index_id, answers in self._answers.items()
+            for i, answer in enumerate(answers)
+        )
+        evicted: dict[str, set[int]] = {}
+        for _last_hit, index_id, i in by_last_hit[:overflow]:
+            evicted.setdefault(index_id, set()).add(i)
+        for index_id, rows in evicted.items():
+            keep = [i for i in range(len(self._answers[index_id])) if i not in rows]
+            self._keep(index_id, keep)
+
+    def persist_if_due(self) -> None:
+        if time.monotonic() - self._last_persist >= self.persist_interval:
+            self.persist()
+
+    def flush(self) -> None:
+        "write answers stored since the last write, eg. at exit"
+        if self.persist_path is not None and self._dirty:
+            self.persist()
+
+    def persist(self) -> None:
+        with self._write_lock:
+            with self._lock:
+                answers = [
+                    answer.__dict__ for index_answers in self._answers.values()
+                    for answer in index_answers
+                ]
+                embeddings = [
+                    self._embeddings[index_id] for index_id in self._answers
+                    if len(self._answers[index_id])
+                ]
+                self._dirty = False
+            matrix = np.vstack(embeddings) if embeddings else np.empty((0, 0), np.float32)
+            # a unique temporary file, other processes may write the same cache
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.persist_path)), suffix=".tmp.npz"
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, embeddings=matrix, answers=np.array(json.dumps(answers)))
+                os.replace(tmp_path, self.persist_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._last_persist = time.monotonic()
+
+    def load(self) -> None:
+        with np.load(self.persist_path) as saved:
+            matrix = saved["embeddings"]
+            answers = [CachedAnswer(**answer) for answer in json.loads(str(saved["answers"]))]
+        with self._lock:
+            self._answers = {}
+            rows: dict[str, list[int]] = {}
+            for row, answer in enumerate(answers):
+                self._answers.setdefault(answer.index_id, []).append(answer)
+                rows.setdefault(answer.index_id, []).append(row)
+            self._embeddings = {
+                index_id: matrix[index_rows] for index_id, index_rows in rows.items()
+            }
+        logger.debug(f"answer cache loaded {len(answers)} answers from {self.persist_path}")
+
+
+answer_cache = SemanticAnswerCache()
@@ -1,6 +1,8 @@
 from langchain.llms import OpenAI
 from agents import Agent, classification_agent
 from indexer import BuildRagIndex, index_to_product_mapping, product_descriptions
+from registry import index_registry
+from router import product_router
 
 from flask import Flask, make_response, jsonify
 from flask import request
@@ -9,12 +11,13 @@ from flask_cors import CORS
 
 from pydantic import BaseModel
 
+from tracing import queued_file_handler
+
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-fh = logging.FileHandler("query.log", mode="a")
-fh.setLevel(logging.INFO)
+fh = queued_file_handler("query.log", logging.INFO)
 logger.addHandler(fh)
 
 
@@ -58,8 +61,7 @@ def get_response() -> dict:
         # response query initialize
         response_query = []
         # find the appropriate index for the product
-        product_that_query_is_about = classification_agent(query)
-        product_that_query_is_about = product_that_query_is_about.strip()
+        product_that_query_is_about = product_router.route(query).product
 
         print(f"product_that_query_is_about: {product_that_query_is_about}")
         # appropriate rag index
@@ -81,7 +83,7 @@ def get_response() -> dict:
             return response_obj
             ...
 
-        b = BuildRagIndex(index_id)
+        b = index_registry.get(index_id)
         response_text, page_numbers = b.query(query)
         response_query.append(msg1)
         response_query.append(response_text)
@@ -96,4 +98,6 @@ def get_response() -> dict:
 
 
 if __name__ == "__main__":
+    index_registry.warm()
+    product_router.warm()
     app.run(host= '0.0.0.0', port=8001)
@@ -1,6 +1,9 @@
 from langchain.llms import OpenAI
 from agents import Agent, classification_agent
 from indexer import BuildRagIndex, index_to_product_mapping, product_descriptions
+from registry import index_registry
+from router import product_router
+from conversation_store import conversation_store
 
 from fastapi import FastAPI
 from pydantic import BaseModel, Field
@@ -10,15 +13,17 @@ from flask import Flask, make_response, jsonify
 from flask import request
 import json
 from flask_cors import CORS
+import time
 
 from utils import documents_to_index
 
+from tracing import queued_file_handler
+
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-fh = logging.FileHandler("query.log", mode="a")
-fh.setLevel(logging.INFO)
+fh = queued_file_handler("query.log", logging.INFO)
 logger.addHandler(fh)
 
 ###### Pydantic base classes for FastAPI ######
@@ -34,6 +39,12 @@ class Response(BaseModel):
     sources: str | None
 
 
+class Memory(BaseModel):
+    content: str
+    # classification made in the first turn, reused once the user confirms
+    product: str | None = None
+
+
 ####################################################
 
 
@@ -58,33 +69,31 @@ def _build_cors_preflight_response():
 # query = "Something is wrong with the scanner. What should I do?"
 
 
-def memory_refresher():
-    f = open("memory.txt", "w")
-    f.close()
+def memory_refresher(session_id: str):
+    conversation_store.delete(session_id)
 
 
-def memory_getter() -> Message | None:
-    f = open("memory.txt", "r")
-    memory = f.read()
-    f.close()
-    if memory == "":
+def memory_getter(session_id: str) -> Memory | None:
+    memory = conversation_store.get(session_id)
+    if memory is None:
         # return means this is a new request
         return None
     else:
-        memory = json.loads(memory)
-        return Message(**memory)
+        return Memory(**memory)
 
 
-def memory_writer(memory: Message):
-    with open("memory.txt", "w") as f:
-        f.write(json.dumps(memory.dict()))
+def memory_writer(session_id: str, memory: Memory):
+    conversation_store.set(session_id, memory.dict())
 
 
 def get_classification(message: Message) -> Response:
-    product_that_query_is_about = classification_agent(message.content)
-    product_that_query_is_about = product_that_query_is_about.strip()
+    route = product_router.route(message.content)
+    product_that_query_is_about = route.product
 
-    logger.debug(f"product_that_query_is_about: {product_that_query_is_about}")
+    logger.debug(
+        f"product_that_query_is_about: {product_that_query_is_about}, "
+        f"confidence: {route.confidence:.3f}, routed by: {route.routed_by}"
+    )
     # appropriate rag index
     try:
         index_id = index_to_product_mapping[product_that_query_is_about]
@@ -97,12 +106,13 @@ def get_classification(message: Message) -> Response:
         return {"content":f"{msg1}{msg2}{msg3}", "product":None, "sources":None}
 
 
-def perform_rag_call(message: Message) -> Response:
+def perform_rag_call(message: Memory) -> Response:
     # response query initialize
     response_query = []
-    # find the appropriate index for the product
-    product_that_query_is_about = classification_agent(message.content)
-    product_that_query_is_about = product_that_query_is_about.strip()
+    # reuse the product confirmed by the user, classify only if there is none
+    product_that_query_is_about = message.product
+    if product_that_query_is_about is None:
+        product_that_query_is_about = product_router.route(message.content).product
 
     print(f"product_that_query_is_about: {product_that_query_is_about}")
     # appropriate rag index
@@ -123,7 +133,7 @@ def perform_rag_call(message: Message) -> Response:
         logger.info(f"\n {'-'*30}\n")
         return response_obj
 
-    b = BuildRagIndex(index_id)
+    b = index_registry.get(index_id)
     response_text, page_numbers = b.query(message.content)
     # sort page numbers for presentation
     page_numbers = sorted(page_numbers)
@@ -160,20 +170,25 @@ def get_response() -> dict | Response | None:
         print(message)
         #       print(postData)
         #       message = Dict2Class(postData)
-        memory = memory_getter()
+        # clients that send no X-Session-Id header share one conversation
+        session_id = request.headers.get("X-Session-Id", "default")
+        memory = memory_getter(session_id)
 
         if memory is None:
             print("memory is None, hence doing classification")
             # means this is a fresh request
             # send a classification response
-            memory_writer(message)
             response_msg = get_classification(message)
+            memory_writer(
+                session_id,
+                Memory(content=message.content, product=response_msg["product"]),
+            )
             if "sorry" in response_msg["content"].lower():
-                memory_refresher()
+                memory_refresher(session_id)
                 return response_msg
             return response_msg
         elif message.content.strip().lower() in ["n", "no"]:
-            memory_refresher()
+            memory_refresher(session_id)
             return {
                 "content":"Sorry for getting it wrong, request you to try asking your question again.\n\n",
                 "product":None,
@@ -181,11 +196,11 @@ def get_response() -> dict | Response | None:
             }
         elif message.content.strip().lower() in ["", "y", "yes"]:
             # switch the message so as to reset the memory for the next call
-            memory_refresher()
+            memory_refresher(session_id)
             # perform the rag call
             return perform_rag_call(memory)
         else:
-            memory_refresher()
+            memory_refresher(session_id)
             return {
                 "content":"\nApologoes for the hiccup. Needed to reset my memory there. I am ready now. Please ask me again.",
                 "product":None,
@@ -193,10 +208,74 @@ def get_response() -> dict | Response | None:
                 }
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/chat/stream", methods=["POST", "OPTIONS"])
+def stream_response():
+    """
+    same conversation flow as /chat, with the answer streamed as server-sent events
+    - `token` events carry pieces of the answer as soon as synthesis starts
+    - the final `done` event carries content, product and sources
+    """
+    if request.method == "OPTIONS":  # CORS preflight
+        return _build_cors_preflight_response()
+    request_start = time.perf_counter()
+    message = Message(content=request.get_json()["content"])
+    session_id = request.headers.get("X-Session-Id", "default")
+    memory = memory_getter(session_id)
+    is_rag_turn = memory is not None and message.content.strip().lower() in ["", "y", "yes"]
+
+    if not is_rag_turn:
+        # classification, deny and reset turns are short, send them as one event
+        return app.response_class(
+            sse_event("done", get_response()), mimetype="text/event-stream"
+        )
+
+    memory_refresher(session_id)
+    product_that_query_is_about = memory.product
+    if product_that_query_is_about not in index_to_product_mapping:
+        return app.response_class(
+            sse_event("done", perform_rag_call(memory)), mimetype="text/event-stream"
+        )
+
+    b = index_registry.get(index_to_product_mapping[product_that_query_is_about])
+    tokens, page_numbers = b.stream_query(memory.content)
+
+    def events():
+        first_token_seconds = None
+        msg1 = f"Product: {product_that_query_is_about}.\n\n"
+        content = [msg1, "\n\n"]
+        yield sse_event("token", {"token": "".join(content)})
+        for token in tokens:
+            if first_token_seconds is None:
+                first_token_seconds = time.perf_counter() - request_start
+            content.append(token)
+            yield sse_event("token", {"token": token})
+
+        response_obj = {
+            "content": "".join(content),
+            "product": product_that_query_is_about,
+            "sources": ", ".join([str(page_num) for page_num in sorted(page_numbers)]),
+        }
+        logger.info(response_obj)
+        logger.info(
+            f"time to first token: {first_token_seconds or 0.0:.3f}s, "
+            f"total latency: {time.perf_counter() - request_start:.3f}s"
+        )
+        logger.info(f"\n {'-'*30}\n")
+        yield sse_event("done", response_obj)
+
+    return app.response_class(events(), mimetype="text/event-stream")
+
+
 class ConversationHandler:
     def __init__(self, message: Message):
         self.memory: Message | None = None
 
 
 if __name__ == "__main__":
+    index_registry.warm()
+    product_router.warm()
     app.run(host="0.0.0.0", port=8000)
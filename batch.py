@@ -0,0 +1,323 @@
+"""
+Answer many questions in one pass, eg. to replay historical support tickets.
+
+python batch.py tickets.jsonl [--concurrency 8] [--output answers.jsonl]
+
+input, one json object per line, product is optional:
+{"question": "How to do Occlusal scan?", "product": "IFU Primescan Connect DE"}
+
+- all questions are embedded in batched calls, through the embedding cache
+- the router scores all of them in one matrix product, only unclear ones ask the llm agent
+- questions are grouped by product and each group is retrieved in one matrix product
+- synthesis calls run with bounded concurrency, answers are yielded in input order
+- a question that fails, eg. on an llm timeout or a missing index, gets an answer with
+  `error` set, the rest of the batch goes on; a failed embedding or routing call fails
+  every question it was made for
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Awaitable
+import logging
+
+from answer_cache import answer_cache
+from combined_index import COMBINED_INDEX_NAME, USE_COMBINED_INDEX
+from embedding_cache import embedding_cache
+from indexer import index_to_product_mapping, retrieval_executor
+from registry import index_registry
+from router import product_router
+from tracing import in_context, span
+
+# synthesis calls in flight for one batch
+BATCH_SYNTHESIS_CONCURRENCY: int = 8
+# largest batch accepted by the api
+BATCH_MAX_QUESTIONS: int = 1000
+
+logger = logging.getLogger("indexer.batch")
+
+
+@dataclass
+class BatchAnswer:
+    index: int
+    question: str
+    product: str | None
+    routed_by: str  # "given", "embedding", "llm", "cache" or "failed"
+    content: str = ""
+    sources: str | None = None
+    error: str | None = None
+
+    def unknown_product(self) -> "BatchAnswer":
+        self.content = (
+            "Sorry, I cannot seem to find the product you are asking about in my database.\n\n"
+            "I only have the following products in my database: "
+            f"{list(index_to_product_mapping.keys())}"
+        )
+        return self
+
+    def answered(self, response_text: str, page_numbers: list[int]) -> "BatchAnswer":
+        "same content and sources as a /converse/ answer"
+        self.content = "\n\n".join([f"Product: {self.product}.\n\n", response_text])
+        self.sources = ", ".join(str(page_num) for page_num in sorted(page_numbers))
+        return self
+
+    def failed(self, exc: Exception) -> "BatchAnswer":
+        logger.error(f"batch: question {self.index} failed: {exc!r}")
+        self.error = f"{type(exc).__name__}: {exc}"
+        return self
+
+
+async def answer_batch(
+    questions: list[str],
+    products: list[str | None] | None = None,
+    concurrency: int = BATCH_SYNTHESIS_CONCURRENCY,
+    llm_semaphore: asyncio.Semaphore | None = None,
+) -> AsyncIterator[BatchAnswer]:
+    """
+    answers in the order of questions, each one as soon as it and all before it are done
+    - products: the product of every question when known, None to route it
+    - llm_semaphore: shared with the interactive requests, caps llm calls across both
+    """
+    tasks = await plan_batch(questions, products, concurrency, llm_semaphore)
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        # eg. the client went away, drop the synthesis calls that are still waiting
+        for task in tasks:
+            task.cancel()
+
+
+async def plan_batch(
+    questions: list[str],
+    products: list[str | None] | None,
+    concurrency: int,
+    llm_semaphore: asyncio.Semaphore | None,
+) -> list[asyncio.Task]:
+    "embed, route and retrieve every question, then start one synthesis task per question"
+    loop = asyncio.get_running_loop()
+    products = list(products or [None] * len(questions))
+
+    def done(answer: BatchAnswer) -> asyncio.Future:
+        future = loop.create_future()
+        future.set_result(answer)
+        return future
+
+    # the embedding calls block on the network, keep them off the retrieval executor
+    try:
+        with span("query_embedding", queries=len(questions)):
+            query_embeddings = await loop.run_in_executor(
+                None,
+                in_context(
+                    embedding_cache.get_query_embeddings, product_router.embed_model, questions
+                ),
+            )
+    except Exception as exc:
+        # eg. the embedding api is down, every question gets the error instead of a cut stream
+        return [
+            done(
+                BatchAnswer(
+                    i, question, products[i], "given" if products[i] else "failed"
+                ).failed(exc)
+            )
+            for i, question in enumerate(questions)
+        ]
+
+    to_route = [i for i, product in enumerate(products) if not product]
+    routed = {}
+    routing_error = None
+    if to_route:
+        try:
+            with span("classification", queries=len(to_route)) as classification:
+                routes = await product_router.aroute_batch(
+                    [questions[i] for i in to_route],
+                    [query_embeddings[i] for i in to_route],
+                    llm_semaphore,
+                )
+                classification.attributes["llm"] = sum(r.routed_by == "llm" for r in routes)
+            routed = dict(zip(to_route, routes))
+        except Exception as exc:
+            # eg. an llm timeout, the questions with a given product go on
+            routing_error = exc
+    answers = [
+        BatchAnswer(i, question, routed[i].product, routed[i].routed_by)
+        if i in routed
+        else BatchAnswer(i, question, products[i], "given" if products[i] else "failed")
+        for i, question in enumerate(questions)
+    ]
+
+    synthesis_semaphore = asyncio.Semaphore(concurrency)
+    tasks: list[asyncio.Task | None] = [None] * len(questions)
+    if routing_error is not None:
+        for i in to_route:
+            tasks[i] = done(answers[i].failed(routing_error))
+
+    def guarded(answer: BatchAnswer, synthesis: Awaitable[BatchAnswer]) -> asyncio.Future:
+        return asyncio.ensure_future(answer_or_error(answer, synthesis))
+
+    if USE_COMBINED_INDEX:
+        pending = [answer for answer in answers if tasks[answer.index] is None]
+        try:
+            b = await loop.run_in_executor(
+                retrieval_executor, in_context(index_registry.get, COMBINED_INDEX_NAME)
+            )
+            all_nodes = await loop.run_in_executor(
+                retrieval_executor,
+                in_context(
+                    b.retrieve_batch,
+                    [answer.question for answer in pending],
+                    [query_embeddings[answer.index] for answer in pending],
+                    [answer.product for answer in pending],
+                ),
+            )
+        except Exception as exc:
+            for answer in pending:
+                tasks[answer.index] = done(answer.failed(exc))
+            return tasks
+        for answer, nodes in zip(pending, all_nodes):
+            tasks[answer.index] = guarded(
+                answer,
+                synthesize_combined(b, answer, nodes, synthesis_semaphore, llm_semaphore),
+            )
+        return tasks
+
+    groups: dict[str, list[int]] = {}
+    for answer in answers:
+        if tasks[answer.index] is not None:
+            continue
+        if answer.product not in index_to_product_mapping:
+            tasks[answer.index] = done(answer.unknown_product())
+        else:
+            groups.setdefault(answer.product, []).append(answer.index)
+
+    async def plan_product(product: str, indexes: list[int]) -> None:
+        index_id = index_to_product_mapping[product]
+        b = await loop.run_in_executor(
+            retrieval_executor, in_context(index_registry.get, index_id)
+        )
+        texts = [questions[i] for i in indexes]
+        # all cache hits when the index uses the router's embedding model
+        embeddings = await loop.run_in_executor(
+            None,
+            in_context(
+                embedding_cache.get_query_embeddings,
+                b.rag_index.service_context.embed_model,
+                texts,
+            ),
+        )
+        uncached = []
+        for i, embedding in zip(indexes, embeddings):
+            cached_answer = answer_cache.lookup(index_id, embedding)
+            if cached_answer is not None:
+                answers[i].routed_by = "cache"
+                tasks[i] = done(answers[i].answered(*cached_answer))
+            else:
+                uncached.append((i, embedding))
+        if not uncached:
+            return
+
+        all_nodes = await loop.run_in_executor(
+            retrieval_executor,
+            in_context(
+                b.retrieve_batch,
+                [questions[i] for i, _ in uncached],
+                [embedding for _, embedding in uncached],
+            ),
+        )
+        logger.debug(f"batch: retrieved {len(uncached)} questions from {index_id}")
+        for (i, embedding), nodes in zip(uncached, all_nodes):
+            tasks[i] = guarded(
+                answers[i],
+                synthesize_product(
+                    b, answers[i], embedding, nodes, synthesis_semaphore, llm_semaphore
+                ),
+            )
+
+    for product, indexes in groups.items():
+        try:
+            await plan_product(product, indexes)
+        except Exception as exc:
+            # eg. the index of this product cannot be loaded, other products go on
+            for i in indexes:
+                if tasks[i] is None:
+                    tasks[i] = done(answers[i].failed(exc))
+    return tasks
+
+
+async def answer_or_error(
+    answer: BatchAnswer, synthesis: Awaitable[BatchAnswer]
+) -> BatchAnswer:
+    "the answer, or the question with its error when synthesis failed"
+    try:
+        return await synthesis
+    except Exception as exc:
+        return answer.failed(exc)
+
+
+async def synthesize_product(
+    b,
+    answer: BatchAnswer,
+    query_embedding: list[float],
+    nodes: list,
+    synthesis_semaphore: asyncio.Semaphore,
+    llm_semaphore: asyncio.Semaphore | None,
+) -> BatchAnswer:
+    timings = {}
+    async with synthesis_semaphore:
+        response = await b.asynthesize(answer.question, nodes, timings, llm_semaphore)
+    b.log_timings(timings)
+    return answer.answered(*b.finish_query(answer.question, query_embedding, response))
+
+
+async def synthesize_combined(
+    b,
+    answer: BatchAnswer,
+    nodes: list,
+    synthesis_semaphore: asyncio.Semaphore,
+    llm_semaphore: asyncio.Semaphore | None,
+) -> BatchAnswer:
+    timings = {}
+    async with synthesis_semaphore:
+        response = await b.asynthesize(answer.question, nodes, timings, llm_semaphore)
+    b.log_timings(timings)
+    answer.product, answer.sources = b.format_sources(
+        b.source_products(response.source_nodes), answer.product
+    )
+    answer.content = "\n\n".join([f"Product: {answer.product}.\n\n", str(response)])
+    return answer
+
+
+def throughput(num_questions: int, seconds: float) -> dict:
+    return {
+        "questions": num_questions,
+        "seconds": round(seconds, 3),
+        "questions_per_second": round(num_questions / seconds, 2) if seconds else 0.0,
+    }
+
+
+async def run(path: str, concurrency: int, output: str | None) -> dict:
+    with open(path) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    start = time.perf_counter()
+    with open(output, "w") if output else contextlib.nullcontext() as out:
+        async for answer in answer_batch(
+            [item["question"] for item in items],
+            [item.get("product") for item in items],
+            concurrency,
+        ):
+            print(f"{answer.index}\t{answer.product}\t{answer.sources}\t{answer.question}")
+            if out is not None:
+                out.write(json.dumps(asdict(answer)) + "\n")
+    return throughput(len(items), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="answer a file of questions in one batch")
+    parser.add_argument("questions", help="json lines with question and optional product")
+    parser.add_argument("--concurrency", type=int, default=BATCH_SYNTHESIS_CONCURRENCY)
+    parser.add_argument("--output", default=None, help="write the answers as json lines")
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args.questions, args.concurrency, args.output))))
@@ -0,0 +1,313 @@
+"""
+Latency benchmark over the persisted indexes in data/rag-index/, without any OpenAI calls.
+
+python benchmark.py [--top-k 1 5 10 20 50] [--queries 50] [--concurrency 1 8 32] [--llm-latency 0.0]
+
+- a deterministic hashing embedder and a fake llm stand in for the OpenAI models
+- measures index load time, retrieval latency per similarity_top_k,
+  synthesis overhead and /converse/ throughput under concurrency
+- results are written as json, tagged with the git commit, eg. to compare runs across commits
+"""
+import os
+
+# the OpenAI clients are created at import time, they are never called here
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-placeholder")
+
+import argparse
+import asyncio
+import hashlib
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import uuid
+from typing import Any
+
+import numpy as np
+
+from llama_index import ServiceContext, set_global_service_context
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.llms.base import (
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata,
+    llm_completion_callback,
+)
+from llama_index.llms.custom import CustomLLM
+
+import agents
+import indexer
+import main
+from answer_cache import answer_cache
+from conversation_store import InMemoryConversationStore
+from embedding_cache import embedding_cache
+from embedding_store import MmapEmbeddingStore, mmap_store_exists
+from langchain.llms.fake import FakeListLLM
+from lexical import tokenize
+from loadtest import QUESTIONS
+from registry import index_registry, index_dir_for
+from router import product_router
+from utils import documents_to_index
+
+# dimension of text-embedding-ada-002, used when no index is persisted
+DEFAULT_EMBEDDING_DIM: int = 1536
+BENCHMARK_TOP_K = [1, 5, 10, 20, 50]
+BENCHMARK_CONCURRENCY = [1, 8, 32]
+PATH_BENCHMARK_RESULTS = "benchmarks/"
+
+
+class HashingEmbedding(BaseEmbedding):
+    "deterministic local embedder, each token is hashed to a signed dimension"
+
+    dim: int = DEFAULT_EMBEDDING_DIM
+
+    def embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            h = int.from_bytes(digest, "little")
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query: str) -> list[float]:
+        return self.embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> list[float]:
+        return self.embed(query)
+
+    def _get_text_embedding(self, text: str) -> list[float]:
+        return self.embed(text)
+
+
+class FakeLLM(CustomLLM):
+    "answers instantly, or after `latency` seconds to model a remote llm"
+
+    latency: float = 0.0
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=4096, num_output=256, model_name="fake-llm")
+
+    def answer(self, prompt: str) -> str:
+        return f"Fake answer to a prompt of {len(prompt)} characters."
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.latency)
+        return CompletionResponse(text=self.answer(prompt))
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        await asyncio.sleep(self.latency)
+        return CompletionResponse(text=self.answer(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
+        time.sleep(self.latency)
+        text = ""
+        for token in self.answer(prompt).split(" "):
+            text += token + " "
+            yield CompletionResponse(text=text, delta=token + " ")
+
+
+def summarise(seconds: list[float]) -> dict:
+    "latency percentiles in milliseconds"
+    values = np.asarray(seconds) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 4),
+        "p50_ms": round(float(np.percentile(values, 50)), 4),
+        "p95_ms": round(float(np.percentile(values, 95)), 4),
+        "p99_ms": round(float(np.percentile(values, 99)), 4),
+    }
+
+
+def git_revision() -> dict:
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, check=False
+        ).stdout.strip()
+
+    return {
+        "sha": git("rev-parse", "HEAD") or None,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+def persisted_documents() -> list[str]:
+    return [
+        doc_filename
+        for doc_filename, _start_skip, _end_skip in documents_to_index
+        if os.path.exists(index_dir_for(doc_filename))
+    ]
+
+
+def embedding_dim(documents: list[str]) -> int:
+    "dimension of the persisted embeddings, the fake embedder has to match it"
+    for doc_filename in documents:
+        if mmap_store_exists(index_dir_for(doc_filename)):
+            return MmapEmbeddingStore(index_dir_for(doc_filename)).matrix.shape[1]
+    return DEFAULT_EMBEDDING_DIM
+
+
+def benchmark_index_load(documents: list[str], repeats: int) -> dict:
+    "cold load of every index, outside the registry"
+    results = {}
+    for doc_filename in documents:
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            b = indexer.BuildRagIndex(doc_filename)
+            seconds.append(time.perf_counter() - start)
+        results[doc_filename] = {
+            "num_nodes": len(b.retriever),
+            "min_s": round(min(seconds), 4),
+            "mean_s": round(sum(seconds) / len(seconds), 4),
+        }
+    return results
+
+
+def benchmark_retrieval(
+    documents: list[str], queries: list[str], top_ks: list[int]
+) -> dict:
+    "BuildRagIndex.retrieve_nodes at several similarity_top_k, query embedding excluded"
+    default_top_k = indexer.SIMILARITY_TOP_K
+    results = {}
+    try:
+        for doc_filename in documents:
+            b = index_registry.get(doc_filename)
+            embed_model = b.rag_index.service_context.embed_model
+            embeddings = [embed_model.get_query_embedding(query) for query in queries]
+            results[doc_filename] = {}
+            for top_k in top_ks:
+                # retrieve_nodes reads the module level setting on every call
+                indexer.SIMILARITY_TOP_K = top_k
+                seconds = []
+                for query, embedding in zip(queries, embeddings):
+                    start = time.perf_counter()
+                    b.retrieve_nodes(query, embedding, {})
+                    seconds.append(time.perf_counter() - start)
+                results[doc_filename][str(top_k)] = summarise(seconds)
+    finally:
+        indexer.SIMILARITY_TOP_K = default_top_k
+    return results
+
+
+def benchmark_synthesis(documents: list[str], queries: list[str]) -> dict:
+    "time spent in the response synthesizer around the (fake) llm calls"
+    results = {}
+    for doc_filename in documents:
+        b = index_registry.get(doc_filename)
+        embed_model = b.rag_index.service_context.embed_model
+        seconds = []
+        for query in queries:
+            nodes = b.retrieve_nodes(query, embed_model.get_query_embedding(query), {})
+            start = time.perf_counter()
+            b.response_synthesizer.synthesize(query, nodes)
+            seconds.append(time.perf_counter() - start)
+        results[doc_filename] = summarise(seconds)
+    return results
+
+
+async def benchmark_converse(conversations: int, concurrency: int) -> dict:
+    "full two turn conversations through the /converse/ handler, in process"
+    latencies = {"classify": [], "answer": []}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def conversation(i: int) -> None:
+        session_id = uuid.uuid4().hex
+        async with semaphore:
+            turns = [("classify", QUESTIONS[i % len(QUESTIONS)]), ("answer", "y")]
+            for turn, content in turns:
+                start = time.perf_counter()
+                await main.get_response(main.Message(content=content), session_id)
+                latencies[turn].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation(i) for i in range(conversations)))
+    total_seconds = time.perf_counter() - start
+    return {
+        "conversations_per_second": round(conversations / total_seconds, 2),
+        "requests_per_second": round(2 * conversations / total_seconds, 2),
+        **{turn: summarise(values) for turn, values in latencies.items()},
+    }
+
+
+async def benchmark_converse_levels(conversations: int, levels: list[int]) -> dict:
+    "one event loop for every level, the llm semaphore in main is bound to it"
+    return {
+        str(concurrency): await benchmark_converse(conversations, concurrency)
+        for concurrency in levels
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    documents = persisted_documents()
+    dim = args.dim or embedding_dim(documents)
+
+    # indexes loaded from here on pick up the fake models
+    embed_model = HashingEmbedding(model_name="hashing-embedding", dim=dim)
+    llm = FakeLLM(latency=args.llm_latency)
+    set_global_service_context(ServiceContext.from_defaults(llm=llm, embed_model=embed_model))
+
+    # keep fake embeddings, answers and sessions out of the real stores
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    embedding_cache.path = os.path.join(workdir, "embedding-cache.sqlite")
+    answer_cache.max_distance = -1.0
+    # fake query embeddings are not in the space of the persisted ones,
+    # without this the similarity cutoff would drop every node
+    indexer.SIMILARITY_CUTOFF = -1.0
+    agents.llm = FakeListLLM(responses=list(main.index_to_product_mapping.keys()))
+    main.conversation_store = InMemoryConversationStore()
+    product_router._embed_model = embed_model
+
+    queries = [QUESTIONS[i % len(QUESTIONS)] + f" ({i})" for i in range(args.queries)]
+
+    results = {"index_load": benchmark_index_load(documents, args.load_repeats)}
+    index_registry.warm()
+    product_router.warm()
+    results["retrieval"] = benchmark_retrieval(documents, queries, args.top_k)
+    results["synthesis"] = benchmark_synthesis(documents, queries)
+    results["converse"] = asyncio.run(
+        benchmark_converse_levels(args.conversations, args.concurrency)
+    )
+    return {
+        "git": git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {
+            "documents": documents,
+            "queries": args.queries,
+            "conversations": args.conversations,
+            "llm_latency_s": args.llm_latency,
+            "embedding_dim": dim,
+        },
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark retrieval and /converse/ latency")
+    parser.add_argument("--top-k", type=int, nargs="+", default=BENCHMARK_TOP_K)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=BENCHMARK_CONCURRENCY)
+    parser.add_argument("--load-repeats", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per fake llm call")
+    parser.add_argument("--dim", type=int, default=None, help="defaults to the persisted one")
+    parser.add_argument("--output", default=None, help="defaults to benchmarks/<commit>.json")
+    args = parser.parse_args()
+
+    report = run(args)
+    output = args.output or os.path.join(
+        PATH_BENCHMARK_RESULTS, f"{(report['git']['sha'] or 'unknown')[:12]}.json"
+    )
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"written to {output}")
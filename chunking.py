@@ -0,0 +1,150 @@
+"""
+Section aware chunking of partitioned pages, sized in tokens.
+
+- a page is cut into sections at every Title element, eg. a heading or a WARNING, with the elements after it
+- whole sections are packed into chunks of at most CHUNK_TOKEN_BUDGET tokens, in page order, without overlap
+- a section over the budget is split between its elements, an element over the budget between sentences,
+  and every part starts with the title of its section
+- chunks never cross pages, a page stays the document that incremental updates diff and sources cite
+- every node records its token count in metadata, hidden from the embedding model and the llm,
+  so the context handed to synthesis is packed without tokenizing it again
+- tokens are counted with the tiktoken encoding llama_index packs prompts with
+"""
+from llama_index import Document
+from llama_index.node_parser.node_utils import build_nodes_from_splits
+from llama_index.schema import BaseNode, NodeWithScore, TextNode
+from llama_index.text_splitter import SentenceSplitter
+
+from tracing import count_tokens
+
+# largest chunk, in tokens
+CHUNK_TOKEN_BUDGET: int = 512
+# unstructured element categories that start a new section
+SECTION_CATEGORIES = ("Title",)
+# node metadata key of the token count
+TOKEN_COUNT_KEY = "token_count"
+
+PageElements = list[tuple[str, str]]
+
+
+def page_text(page_elements: PageElements) -> str:
+    "the text of the page document, its hash is what incremental updates compare"
+    return "\n".join(text for _category, text in page_elements)
+
+
+def split_sections(page_elements: PageElements) -> list[PageElements]:
+    "elements grouped into sections, a section starts with its title when it has one"
+    sections = []
+    for category, text in page_elements:
+        if not text.strip():
+            continue
+        if category in SECTION_CATEGORIES or not sections:
+            sections.append([])
+        sections[-1].append((category, text))
+    return sections
+
+
+def pack(pieces: list[tuple[str, int]], token_budget: int) -> list[str]:
+    "consecutive (text, tokens) pieces joined into chunks of at most token_budget tokens"
+    chunks = []
+    texts, tokens = [], 0
+    for text, piece_tokens in pieces:
+        # + 1 for the newline joining it to the previous piece
+        if texts and tokens + 1 + piece_tokens > token_budget:
+            chunks.append("\n".join(texts))
+            texts, tokens = [], 0
+        tokens += piece_tokens + (1 if texts else 0)
+        texts.append(text)
+    if texts:
+        chunks.append("\n".join(texts))
+    return chunks
+
+
+def split_section(section: PageElements, token_budget: int) -> list[tuple[str, int]]:
+    "(text, tokens) parts of a section over the budget, each one starts with its title"
+    title = section[0][1] if section[0][0] in SECTION_CATEGORIES else None
+    if title is not None and 2 * count_tokens(title) > token_budget:
+        # too long to repeat, eg. a paragraph mistaken for a title
+        title = None
+    body = [text for _category, text in (section[1:] if title is not None else section)]
+    room = token_budget - (count_tokens(title) + 1 if title is not None else 0)
+
+    units = []
+    for text in body:
+        tokens = count_tokens(text)
+        if tokens <= room:
+            units.append((text, tokens))
+        else:
+            splitter = SentenceSplitter(chunk_size=room, chunk_overlap=0)
+            units.extend(
+                (sentences, count_tokens(sentences)) for sentences in splitter.split_text(text)
+            )
+
+    parts = pack(units, room) if units else [""]
+    if title is not None:
+        parts = [f"{title}\n{part}" if part else title for part in parts]
+    return [(part, count_tokens(part)) for part in parts]
+
+
+def chunk_page(
+    page_elements: PageElements, token_budget: int | None = None
+) -> list[tuple[str, int]]:
+    "(text, tokens) of every chunk of one page, in page order"
+    # read at call time, eg. an evaluation run overrides CHUNK_TOKEN_BUDGET
+    token_budget = token_budget or CHUNK_TOKEN_BUDGET
+    pieces = []
+    for section in split_sections(page_elements):
+        text = "\n".join(text for _category, text in section)
+        tokens = count_tokens(text)
+        if tokens <= token_budget:
+            pieces.append((text, tokens))
+        else:
+            pieces.extend(split_section(section, token_budget))
+    return [(chunk, count_tokens(chunk)) for chunk in pack(pieces, token_budget)]
+
+
+def nodes_from_pages(paged_elements: dict, token_budget: int | None = None) -> list[TextNode]:
+    """
+    one document per page and its chunks as nodes
+    - paged_elements: {page_number: [(category, text), ...]}
+    - nodes of a page are linked as previous/next, like the nodes of SimpleNodeParser
+    """
+    nodes = []
+    for pagenum, page_elements in paged_elements.items():
+        document = Document(doc_id=pagenum, text=page_text(page_elements))
+        chunks = chunk_page(page_elements, token_budget)
+        page_nodes = build_nodes_from_splits(
+            [text for text, _tokens in chunks], document, include_prev_next_rel=True
+        )
+        for node, (_text, tokens) in zip(page_nodes, chunks):
+            # build_nodes_from_splits shares the document's metadata dict between nodes
+            node.metadata = {**node.metadata, TOKEN_COUNT_KEY: tokens}
+            node.excluded_embed_metadata_keys = [
+                *node.excluded_embed_metadata_keys,
+                TOKEN_COUNT_KEY,
+            ]
+            node.excluded_llm_metadata_keys = [
+                *node.excluded_llm_metadata_keys,
+                TOKEN_COUNT_KEY,
+            ]
+        nodes.extend(page_nodes)
+    return nodes
+
+
+def node_tokens(node: BaseNode) -> int:
+    "tokens of the node text, only counted for nodes chunked before counts were recorded"
+    tokens = node.metadata.get(TOKEN_COUNT_KEY)
+    return tokens if tokens is not None else count_tokens(node.get_content())
+
+
+def pack_context(nodes: list[NodeWithScore], token_budget: int) -> list[NodeWithScore]:
+    "nodes in score order while their tokens fit token_budget, the best node is always kept"
+    packed = []
+    tokens = 0
+    for node_with_score in nodes:
+        size = node_tokens(node_with_score.node)
+        if packed and tokens + size > token_budget:
+            continue
+        packed.append(node_with_score)
+        tokens += size
+    return packed
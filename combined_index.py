@@ -0,0 +1,354 @@
+"""
+One index over every manual, with product/filename/page metadata on each node.
+
+python combined_index.py    builds data/rag-index/_combined/ from the per product indexes
+
+- built from the persisted product indexes, nothing is re-embedded
+- a query can be restricted to one product (filtered) or search all of them (unfiltered),
+  any mix of both is scored in a single matrix product
+- one docstore and one embedding matrix are loaded instead of one per product
+- a node's ref_doc_id is "<filename>:<page>", pages of different manuals never share a
+  ref_doc_info entry, the bare page is kept in the node metadata for the sources
+"""
+import asyncio
+import json
+import os
+import time
+import logging
+
+import numpy as np
+
+from llama_index import VectorStoreIndex
+from llama_index.schema import NodeRelationship, NodeWithScore, RelatedNodeInfo
+
+from chunking import pack_context
+from embedding_store import normalise_rows
+import indexer  # retrieval settings are read at call time, so they can be overridden
+from indexer import (
+    BuildRagIndex,
+    PATH_RAG_INDEX,
+    index_to_product_mapping,
+    retrieval_executor,
+)
+from retriever import MatrixRetriever
+from tracing import in_context, span
+from utils import documents_to_index
+
+COMBINED_INDEX_NAME = "_combined"
+PRODUCTS_FNAME = "products.json"
+# serve rag calls from the combined index instead of one index per product
+USE_COMBINED_INDEX: bool = False
+# product kept in conversation memory when the user confirmed a search of all manuals
+ALL_PRODUCTS = "_all"
+
+logger = logging.getLogger("indexer.combined_index")
+
+
+def combined_index_exists() -> bool:
+    return os.path.exists(
+        os.path.join(os.getcwd(), PATH_RAG_INDEX, COMBINED_INDEX_NAME, PRODUCTS_FNAME)
+    )
+
+
+def combined_ref_doc_id(doc_filename: str, page: str) -> str:
+    "ref_doc_id of a page in the combined index, page numbers repeat across manuals"
+    return f"{doc_filename}:{page}"
+
+
+def build_combined_index(
+    documents: list[tuple[str, int, int]] = documents_to_index,
+) -> VectorStoreIndex:
+    "merge the persisted product indexes, embeddings are copied over, not recomputed"
+    product_for_filename = {
+        filename: product for product, filename in index_to_product_mapping.items()
+    }
+    products = list(index_to_product_mapping.keys())
+    nodes = []
+    node_products = {}
+    service_context = None
+    for doc_filename, _start_skip, _end_skip in documents:
+        product = product_for_filename.get(doc_filename)
+        builder = BuildRagIndex(doc_filename, load_index=False)
+        if product is None or not builder.check_if_index_exists():
+            logger.debug(f"combined index: skipping {doc_filename}")
+            continue
+        rag_index = builder.retrieve_index()
+        service_context = service_context or rag_index.service_context
+        retriever = MatrixRetriever.from_index(rag_index)
+        for node_id, embedding in zip(retriever.node_ids, retriever.matrix):
+            node = rag_index.docstore.get_node(node_id)
+            page = node.ref_doc_id
+            node.metadata.update({"product": product, "filename": doc_filename, "page": page})
+            node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(
+                node_id=combined_ref_doc_id(doc_filename, page)
+            )
+            # extends the exclusions of the product node, eg. its token count
+            node.excluded_embed_metadata_keys = [
+                *node.excluded_embed_metadata_keys,
+                "product",
+                "filename",
+                "page",
+            ]
+            node.excluded_llm_metadata_keys = [*node.excluded_llm_metadata_keys, "filename"]
+            node.embedding = np.asarray(embedding, dtype=np.float32).tolist()
+            nodes.append(node)
+            node_products[node_id] = products.index(product)
+        logger.debug(f"combined index: added {len(retriever)} nodes of {doc_filename}")
+
+    # embeddings are already set on every node, so nothing is sent to the model
+    rag_index = VectorStoreIndex(nodes, service_context=service_context)
+    builder = CombinedRagIndex(load_index=False)
+    builder.save_rag_index(rag_index)
+    persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, COMBINED_INDEX_NAME)
+    with open(os.path.join(persist_dir, PRODUCTS_FNAME), "w") as f:
+        json.dump({"products": products, "node_products": node_products}, f)
+    return rag_index
+
+
+class CombinedRagIndex(BuildRagIndex):
+    """BuildRagIndex over the combined index of all manuals.
+    - product_codes holds the product of every matrix row, -1 in a query means all products
+    - a filtered query falls back to all products when its product has no node above the cutoff
+    """
+
+    def __init__(self, load_index: bool = True):
+        super().__init__(COMBINED_INDEX_NAME, load_index=load_index)
+
+    def build_or_retrieve_index(self) -> VectorStoreIndex:
+        if not combined_index_exists():
+            logger.debug("combined index does not exist, hence building it.")
+            return build_combined_index()
+        return self.retrieve_index()
+
+    def attach_index(self, rag_index: VectorStoreIndex):
+        super().attach_index(rag_index)
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, COMBINED_INDEX_NAME)
+        with open(os.path.join(persist_dir, PRODUCTS_FNAME)) as f:
+            data = json.load(f)
+        self.products: list[str] = data["products"]
+        node_products = data["node_products"]
+        self.product_codes = np.asarray(
+            [node_products.get(node_id, -1) for node_id in self.retriever.node_ids],
+            dtype=np.int64,
+        )
+
+    def product_code(self, product: str | None) -> int:
+        return self.products.index(product) if product in self.products else -1
+
+    def product_means(self) -> dict[str, np.ndarray]:
+        "normalised mean embedding of every product, eg. for the router centroids"
+        matrix = np.asarray(self.retriever.matrix, dtype=np.float32)
+        return {
+            product: normalise_rows(matrix[self.product_codes == code].mean(axis=0))
+            for code, product in enumerate(self.products)
+            if np.any(self.product_codes == code)
+        }
+
+    def search(
+        self, query_embeddings, product_codes, top_k: int
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        filtered and unfiltered search in one pass
+        - query_embeddings: (num_queries, dim), product_codes: (num_queries,), -1 for all products
+        - rows of other products are masked to -inf for the filtered queries
+        - with an ann index, each query scans its probed clusters instead
+        """
+        queries = normalise_rows(np.atleast_2d(np.asarray(query_embeddings, np.float32)))
+        product_codes = np.asarray(product_codes, dtype=np.int64)
+        ann_index = self.retriever.ann_index
+        if ann_index is not None:
+            # only the probed clusters are scored, filtered queries mask the candidates
+            return [
+                ann_index.search(
+                    query,
+                    self.retriever.matrix,
+                    top_k,
+                    row_mask=self.product_codes == code if code >= 0 else None,
+                )
+                for query, code in zip(queries, product_codes)
+            ]
+        scores = queries @ self.retriever.matrix.T
+        mask = (product_codes[:, None] >= 0) & (
+            self.product_codes[None, :] != product_codes[:, None]
+        )
+        scores[mask] = -np.inf
+        results = []
+        for rows, row_scores in self.retriever.top_k_rows(scores, top_k):
+            finite = np.isfinite(row_scores)
+            results.append((rows[finite], row_scores[finite]))
+        return results
+
+    def lexical_search(
+        self, query_text: str, product_code: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        "bm25 candidates, restricted to one product unless product_code is -1"
+        rows, scores = self.retriever.lexical_search(
+            query_text, indexer.LEXICAL_TOP_K * len(self.products)
+        )
+        if product_code >= 0:
+            keep = self.product_codes[rows] == product_code
+            rows, scores = rows[keep], scores[keep]
+        top_k = indexer.LEXICAL_TOP_K
+        return rows[:top_k], scores[:top_k]
+
+    def retrieve_nodes(
+        self,
+        query_text: str,
+        query_embedding: list[float],
+        timings: dict,
+        product: str | None = None,
+    ) -> list[NodeWithScore]:
+        "the three retrieval levels, restricted to product when it is known"
+        # ------- level 1 retreival
+        code = self.product_code(product)
+        # the unfiltered search rides along in the same pass, as the fallback
+        codes = [code, -1] if code >= 0 else [-1]
+        with span("vector_search", index=COMBINED_INDEX_NAME, product=product) as vector_search:
+            results = self.search(
+                [query_embedding] * len(codes), codes, indexer.SIMILARITY_TOP_K
+            )
+        timings["retrieve"] = vector_search.seconds
+
+        with span("score_filter", index=COMBINED_INDEX_NAME, product=product) as score_filter:
+            retrieved_nodes = self.filter_nodes(query_text, query_embedding, codes, results)
+            score_filter.attributes["nodes"] = len(retrieved_nodes)
+        timings["filter"] = score_filter.seconds
+        return retrieved_nodes
+
+    def retrieve_batch(
+        self,
+        query_texts: list[str],
+        query_embeddings: list[list[float]],
+        products: list[str | None],
+    ) -> list[list[NodeWithScore]]:
+        "retrieve_nodes for many queries, filtered and unfiltered searches of all of them in one pass"
+        query_codes = [self.product_code(product) for product in products]
+        codes = [[code, -1] if code >= 0 else [-1] for code in query_codes]
+        with span(
+            "vector_search", index=COMBINED_INDEX_NAME, queries=len(query_texts)
+        ) as vector_search:
+            flat_results = self.search(
+                [
+                    query_embedding
+                    for query_embedding, query_code in zip(query_embeddings, codes)
+                    for _ in query_code
+                ],
+                [code for query_code in codes for code in query_code],
+                indexer.SIMILARITY_TOP_K,
+            )
+            vector_search.attributes["nodes"] = sum(len(rows) for rows, _ in flat_results)
+
+        with span(
+            "score_filter", index=COMBINED_INDEX_NAME, queries=len(query_texts)
+        ) as score_filter:
+            retrieved_nodes = []
+            position = 0
+            for query_text, query_embedding, query_code in zip(
+                query_texts, query_embeddings, codes
+            ):
+                results = flat_results[position : position + len(query_code)]
+                position += len(query_code)
+                retrieved_nodes.append(
+                    self.filter_nodes(query_text, query_embedding, query_code, results)
+                )
+            score_filter.attributes["nodes"] = sum(len(nodes) for nodes in retrieved_nodes)
+        return retrieved_nodes
+
+    def filter_nodes(
+        self,
+        query_text: str,
+        query_embedding: list[float],
+        codes: list[int],
+        results: list[tuple[np.ndarray, np.ndarray]],
+    ) -> list[NodeWithScore]:
+        "levels 2 and 3, the first product code with nodes above the cutoff wins"
+        for code, (rows, scores) in zip(codes, results):
+            if self.retriever.lexical_index is not None:
+                lexical_rows, _ = self.lexical_search(query_text, code)
+                rows, scores = self.retriever.fuse(
+                    query_embedding, rows, lexical_rows, indexer.SIMILARITY_TOP_K
+                )
+            logger.debug(
+                f"number of retrieved_nodes after 1st retreival: {len(rows)}, "
+                f"product: {self.products[code] if code >= 0 else 'all'}"
+            )
+            logger.debug(f"page_nums: {self.retriever.pages(rows, scores)}")
+
+            # ------- level 2 retreival
+            rows, scores = self.retriever.apply_cutoff(
+                rows, scores, indexer.SIMILARITY_CUTOFF
+            )
+            logger.debug(f"number of retrieved_nodes after 2nd retreival: {len(rows)}")
+            if len(rows):
+                break
+
+        # -------- level 3 retreival
+        rows, scores = self.retriever.apply_cap(rows, scores, indexer.MAX_SOURCE_NODES)
+
+        # -------- level 4 retreival
+        return pack_context(self.retriever.to_nodes(rows, scores), indexer.MAX_CONTEXT_TOKENS)
+
+    @staticmethod
+    def source_products(nodes: list[NodeWithScore]) -> list[tuple[str, int]]:
+        "(product, page) of every source node, best node first"
+        sources = []
+        for node_with_score in nodes:
+            source = (
+                node_with_score.node.metadata["product"],
+                int(node_with_score.node.metadata["page"]),
+            )
+            if source not in sources:
+                sources.append(source)
+        return sources
+
+    @staticmethod
+    def format_sources(
+        sources: list[tuple[str, int]], product: str | None
+    ) -> tuple[str | None, str]:
+        """
+        the product of the best source, which may differ from the classified one,
+        and the sources as shown to the user, pages only when they are all from that product
+        """
+        answered_product = sources[0][0] if sources else product
+        if all(source_product == answered_product for source_product, _page in sources):
+            return answered_product, ", ".join(str(page) for _product, page in sorted(sources))
+        return answered_product, ", ".join(f"{p} p. {page}" for p, page in sources)
+
+    def query(self, query_text: str, product: str | None = None):
+        "response text and (product, page) sources, product=None searches every manual"
+        logger.debug(f"querying combined index for --> {query_text}, product: {product}")
+        timings = {}
+        query_embedding = self.embed_query(query_text)
+        retrieved_nodes = self.retrieve_nodes(query_text, query_embedding, timings, product)
+        response = self.synthesize(query_text, retrieved_nodes, timings)
+        self.log_timings(timings)
+        return str(response), self.source_products(response.source_nodes)
+
+    async def aquery(
+        self,
+        query_text: str,
+        llm_semaphore: asyncio.Semaphore | None = None,
+        product: str | None = None,
+    ):
+        "async version of query"
+        logger.debug(f"querying combined index for --> {query_text}, product: {product}")
+        timings = {}
+        query_embedding = await self.aembed_query(query_text)
+        retrieved_nodes = await asyncio.get_running_loop().run_in_executor(
+            retrieval_executor,
+            in_context(self.retrieve_nodes, query_text, query_embedding, timings, product),
+        )
+        response = await self.asynthesize(
+            query_text, retrieved_nodes, timings, llm_semaphore
+        )
+        self.log_timings(timings)
+        return str(response), self.source_products(response.source_nodes)
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    rag_index = build_combined_index()
+    print(
+        f"built combined index with {len(rag_index.docstore.docs)} nodes "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
@@ -0,0 +1,185 @@
+"""
+Read only, compressed docstore with per node random access, next to docstore.json.
+
+python compressed_docstore.py    writes it for the existing index directories
+
+Layout inside an index directory:
+- docstore.bin          every node serialised as json and zlib compressed on its own, back to back
+- docstore_index.json   node ids, byte offsets, doc hashes and the ref doc -> node ids table
+
+- loading reads only docstore_index.json, node bodies are decompressed when a node is retrieved
+- decoded nodes are kept in an LRU cache of NODE_CACHE_SIZE entries
+- docstore.json is still written, incremental updates load it to modify the index
+"""
+from functools import lru_cache
+from typing import Dict, Optional, Sequence
+import json
+import os
+import time
+import zlib
+
+from llama_index.schema import BaseNode
+from llama_index.storage.docstore import SimpleDocumentStore
+from llama_index.storage.docstore.types import BaseDocumentStore, RefDocInfo
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+
+COMPRESSED_DOCSTORE_FNAME = "docstore.bin"
+COMPRESSED_DOCSTORE_INDEX_FNAME = "docstore_index.json"
+# serve from the compressed docstore when an index has one
+USE_COMPRESSED_DOCSTORE: bool = True
+# decoded nodes kept per index
+NODE_CACHE_SIZE: int = 256
+ZLIB_LEVEL: int = 6
+
+
+def compressed_docstore_exists(persist_dir: str) -> bool:
+    return os.path.exists(os.path.join(persist_dir, COMPRESSED_DOCSTORE_INDEX_FNAME))
+
+
+def write_compressed_docstore(persist_dir: str, docstore: BaseDocumentStore) -> None:
+    "write the blobs and the offset index, replacing any previous version atomically"
+    node_ids = []
+    offsets = [0]
+    doc_hashes = {}
+    data_path = os.path.join(persist_dir, COMPRESSED_DOCSTORE_FNAME)
+    with open(data_path + ".tmp", "wb") as f:
+        for node_id, node in docstore.docs.items():
+            blob = zlib.compress(json.dumps(doc_to_json(node)).encode("utf-8"), ZLIB_LEVEL)
+            f.write(blob)
+            node_ids.append(node_id)
+            offsets.append(offsets[-1] + len(blob))
+            doc_hash = docstore.get_document_hash(node_id)
+            if doc_hash is not None:
+                doc_hashes[node_id] = doc_hash
+    ref_doc_info = {
+        ref_doc_id: {"node_ids": info.node_ids, "metadata": info.metadata}
+        for ref_doc_id, info in (docstore.get_all_ref_doc_info() or {}).items()
+    }
+    index_path = os.path.join(persist_dir, COMPRESSED_DOCSTORE_INDEX_FNAME)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(
+            {
+                "node_ids": node_ids,
+                "offsets": offsets,
+                "doc_hashes": doc_hashes,
+                "ref_doc_info": ref_doc_info,
+            },
+            f,
+        )
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(index_path + ".tmp", index_path)
+
+
+class CompressedDocumentStore(BaseDocumentStore):
+    """Read only docstore over docstore.bin.
+    - a node is read with one positioned read and decompressed on first access
+    - every get returns a fresh node object, callers may modify it freely
+    """
+
+    def __init__(self, persist_dir: str, cache_size: int = NODE_CACHE_SIZE) -> None:
+        with open(os.path.join(persist_dir, COMPRESSED_DOCSTORE_INDEX_FNAME)) as f:
+            index = json.load(f)
+        offsets = index["offsets"]
+        self._spans = {
+            node_id: (offsets[i], offsets[i + 1] - offsets[i])
+            for i, node_id in enumerate(index["node_ids"])
+        }
+        self._doc_hashes: dict[str, str] = index["doc_hashes"]
+        self._ref_doc_info: dict[str, dict] = index["ref_doc_info"]
+        self._fd = os.open(os.path.join(persist_dir, COMPRESSED_DOCSTORE_FNAME), os.O_RDONLY)
+        # the decoded json, not the node, so a caller modifying a node cannot change the cache
+        self._read = lru_cache(maxsize=cache_size)(self._read_uncached)
+
+    def __del__(self) -> None:
+        fd = getattr(self, "_fd", None)
+        if fd is not None:
+            os.close(fd)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def _read_uncached(self, node_id: str) -> dict:
+        offset, length = self._spans[node_id]
+        # pread does not move a shared file position, safe across threads
+        return json.loads(zlib.decompress(os.pread(self._fd, length, offset)))
+
+    def cache_info(self) -> dict:
+        info = self._read.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+    @property
+    def docs(self) -> Dict[str, BaseNode]:
+        "decodes every node, eg. to rebuild the lexical index"
+        return {node_id: self.get_document(node_id) for node_id in self._spans}
+
+    def get_document(self, doc_id: str, raise_error: bool = True) -> Optional[BaseNode]:
+        if doc_id not in self._spans:
+            if raise_error:
+                raise ValueError(f"doc_id {doc_id} not found.")
+            return None
+        return json_to_doc(self._read(doc_id))
+
+    def document_exists(self, doc_id: str) -> bool:
+        return doc_id in self._spans
+
+    def get_document_hash(self, doc_id: str) -> Optional[str]:
+        return self._doc_hashes.get(doc_id)
+
+    def get_all_ref_doc_info(self) -> Optional[Dict[str, RefDocInfo]]:
+        return {
+            ref_doc_id: RefDocInfo(**info) for ref_doc_id, info in self._ref_doc_info.items()
+        }
+
+    def get_ref_doc_info(self, ref_doc_id: str) -> Optional[RefDocInfo]:
+        info = self._ref_doc_info.get(ref_doc_id)
+        return RefDocInfo(**info) if info is not None else None
+
+    def _read_only(self) -> None:
+        raise NotImplementedError(
+            "the compressed docstore is read only, load docstore.json to modify an index"
+        )
+
+    def add_documents(self, docs: Sequence[BaseNode], allow_update: bool = True) -> None:
+        self._read_only()
+
+    def delete_document(self, doc_id: str, raise_error: bool = True) -> None:
+        self._read_only()
+
+    def set_document_hash(self, doc_id: str, doc_hash: str) -> None:
+        self._read_only()
+
+    def delete_ref_doc(self, ref_doc_id: str, raise_error: bool = True) -> None:
+        self._read_only()
+
+
+def load_compressed_docstore(persist_dir: str) -> CompressedDocumentStore | None:
+    "None when disabled or not written yet, the caller then loads docstore.json"
+    if not USE_COMPRESSED_DOCSTORE or not compressed_docstore_exists(persist_dir):
+        return None
+    return CompressedDocumentStore(persist_dir)
+
+
+if __name__ == "__main__":
+    from indexer import PATH_RAG_INDEX
+    from utils import documents_to_index
+
+    for doc_filename, _start_skip, _end_skip in documents_to_index:
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, doc_filename)
+        json_path = os.path.join(persist_dir, "docstore.json")
+        if not os.path.exists(json_path):
+            print(f"skipping {persist_dir}: no docstore.json")
+            continue
+        start = time.perf_counter()
+        docstore = SimpleDocumentStore.from_persist_dir(persist_dir)
+        json_seconds = time.perf_counter() - start
+        write_compressed_docstore(persist_dir, docstore)
+
+        start = time.perf_counter()
+        compressed = CompressedDocumentStore(persist_dir)
+        load_seconds = time.perf_counter() - start
+        bin_size = os.path.getsize(os.path.join(persist_dir, COMPRESSED_DOCSTORE_FNAME))
+        print(
+            f"{doc_filename}: {len(compressed)} nodes, "
+            f"{os.path.getsize(json_path) / 1024:.0f} KiB json -> {bin_size / 1024:.0f} KiB, "
+            f"load {json_seconds * 1000:.1f}ms -> {load_seconds * 1000:.1f}ms"
+        )
@@ -0,0 +1,148 @@
+from abc import ABC, abstractmethod
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# idle conversations are forgotten after this many seconds
+CONVERSATION_TTL_SECONDS: float = 30 * 60
+# "sqlite" is shared by all worker processes, "memory" only lives in one process
+CONVERSATION_STORE_BACKEND = "sqlite"
+CONVERSATION_STORE_PATH = "data/conversations.sqlite"
+# expired sessions are swept every this many writes
+SWEEP_EVERY: int = 256
+
+
+class ConversationStore(ABC):
+    """Session keyed conversation state.
+    - state is a small json serialisable dict, eg. the pending question and its product
+    - get/set/delete are O(1) and safe to call from many threads
+    - sessions expire after ttl_seconds without a write
+    - a backend missing one of the methods fails when it is constructed
+    """
+
+    def __init__(self, ttl_seconds: float = CONVERSATION_TTL_SECONDS) -> None:
+        self.ttl_seconds = ttl_seconds
+
+    @abstractmethod
+    def get(self, session_id: str) -> dict | None:
+        ...
+
+    @abstractmethod
+    def set(self, session_id: str, state: dict) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        ...
+
+
+class InMemoryConversationStore(ConversationStore):
+    "single process store, for one uvicorn worker or tests"
+
+    def __init__(self, ttl_seconds: float = CONVERSATION_TTL_SECONDS) -> None:
+        super().__init__(ttl_seconds)
+        self._states: dict[str, tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, session_id: str) -> dict | None:
+        with self._lock:
+            entry = self._states.get(session_id)
+            if entry is None:
+                return None
+            expires_at, state = entry
+            if expires_at < time.monotonic():
+                del self._states[session_id]
+                return None
+            return dict(state)
+
+    def set(self, session_id: str, state: dict) -> None:
+        with self._lock:
+            self._states[session_id] = (time.monotonic() + self.ttl_seconds, dict(state))
+            self._writes += 1
+            if self._writes % SWEEP_EVERY == 0:
+                self._sweep()
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._states.pop(session_id, None)
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        for session_id in [s for s, (expires_at, _) in self._states.items() if expires_at < now]:
+            del self._states[session_id]
+
+
+class SQLiteConversationStore(ConversationStore):
+    "shared store, one sqlite file used by every thread and worker process"
+
+    def __init__(
+        self,
+        path: str = CONVERSATION_STORE_PATH,
+        ttl_seconds: float = CONVERSATION_TTL_SECONDS,
+    ) -> None:
+        super().__init__(ttl_seconds)
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS conversations (
+                    session_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )"""
+            )
+            self._local.connection = connection
+        return connection
+
+    def get(self, session_id: str) -> dict | None:
+        row = self._connection().execute(
+            "SELECT state FROM conversations WHERE session_id = ? AND expires_at >= ?",
+            (session_id, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_id: str, state: dict) -> None:
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO conversations (session_id, state, expires_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(state), time.time() + self.ttl_seconds),
+        )
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % SWEEP_EVERY == 0
+        if sweep:
+            connection.execute(
+                "DELETE FROM conversations WHERE expires_at < ?", (time.time(),)
+            )
+
+    def delete(self, session_id: str) -> None:
+        self._connection().execute(
+            "DELETE FROM conversations WHERE session_id = ?", (session_id,)
+        )
+
+
+CONVERSATION_STORE_BACKENDS = {
+    "memory": InMemoryConversationStore,
+    "sqlite": SQLiteConversationStore,
+}
+
+
+def make_conversation_store(backend: str = CONVERSATION_STORE_BACKEND) -> ConversationStore:
+    return CONVERSATION_STORE_BACKENDS[backend]()
+
+
+conversation_store = make_conversation_store()
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+import logging
+
+import numpy as np
+
+EMBEDDING_CACHE_PATH = "data/embedding-cache.sqlite"
+# size bounds, least recently used entries are evicted first
+EMBEDDING_CACHE_MAX_ENTRIES: int = 200_000
+EMBEDDING_CACHE_MAX_BYTES: int = 1 << 30
+# size bounds are checked every this many writes
+EMBEDDING_CACHE_EVICT_EVERY: int = 64
+
+logger = logging.getLogger("indexer.embedding_cache")
+
+
+def normalise_text(text: str) -> str:
+    "unicode and whitespace normalisation, case is kept since embeddings are case sensitive"
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_key(text: str, model_name: str) -> str:
+    return hashlib.sha256(
+        f"{model_name}\x00{normalise_text(text)}".encode("utf-8")
+    ).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent content addressed embedding cache.
+    - key: sha256 of the model name and the normalised text
+    - value: float32 embedding blob
+    - sqlite file so it is shared across threads and worker processes
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings(last_access)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _count(self, hits: int, misses: int) -> None:
+        with self._counter_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        if not keys:
+            return {}
+        connection = self._connection()
+        found = {}
+        # stay below sqlite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        if found:
+            now = time.time()
+            connection.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+        return found
+
+    def put_many(self, model_name: str, items: dict[str, list[float]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        connection = self._connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, model, vector, last_access) VALUES (?, ?, ?, ?)",
+            [
+                (key, model_name, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for key, vector in items.items()
+            ],
+        )
+        with self._counter_lock:
+            self._writes += 1
+            should_evict = self._writes % EMBEDDING_CACHE_EVICT_EVERY == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        "drop least recently used entries until both size bounds hold"
+        connection = self._connection()
+        count, total_bytes = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        average_bytes = max(total_bytes // max(count, 1), 1)
+        keep = min(self.max_entries, self.max_bytes // average_bytes)
+        connection.execute(
+            """DELETE FROM embeddings WHERE key IN (
+                SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?
+            )""",
+            (count - keep,),
+        )
+        logger.debug(f"embedding cache: evicted {count - keep} entries")
+
+    def cached_query_embedding(self, embed_model, query_text: str) -> list[float] | None:
+        "the cached embedding of a query, never calls the model"
+        key = embedding_key(query_text, embed_model.model_name)
+        return self.get_many([key]).get(key)
+
+    def get_query_embedding(self, embed_model, query_text: str) -> list[float]:
+        key = embedding_key(query_text, embed_model.model_name)
+        found = self.get_many([key])
+        if key in found:
+            self._count(hits=1, misses=0)
+            return found[key]
+        self._count(hits=0, misses=1)
+        embedding = embed_model.get_query_embedding(query_text)
+        self.put_many(embed_model.model_name, {key: embedding})
+        return embedding
+
+    async def aget_query_embedding(self, embed_model, query_text: str) -> list[float]:
+        "cache lookups are local, only a miss awaits the async embedding client"
+        key = embedding_key(query_text, embed_model.model_name)
+        found = self.get_many([key])
+        if key in found:
+            self._count(hits=1, misses=0)
+            return found[key]
+        self._count(hits=0, misses=1)
+        embedding = await embed_model.aget_query_embedding(query_text)
+        self.put_many(embed_model.model_name, {key: embedding})
+        return embedding
+
+    def get_query_embeddings(self, embed_model, query_texts: list[str]) -> list[list[float]]:
+        """
+        embeddings for many queries, misses are sent in batched calls
+        - batching goes through the text embedding endpoint, that is only the same
+          as embedding a query for models without a separate query engine, eg. ada-002
+        """
+        query_engine = getattr(embed_model, "_query_engine", None)
+        if query_engine != getattr(embed_model, "_text_engine", None):
+            return [self.get_query_embedding(embed_model, text) for text in query_texts]
+        return self.get_text_embeddings(embed_model, query_texts)
+
+    def get_text_embeddings(self, embed_model, texts: list[str]) -> list[list[float]]:
+        "embeddings for many texts, only cache misses are sent to the model, in batches"
+        keys = [embedding_key(text, embed_model.model_name) for text in texts]
+        found = self.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        self._count(hits=len(texts) - len(missing), misses=len(missing))
+
+        missing_keys = list(missing)
+        batch_size = embed_model.embed_batch_size
+        for start in range(0, len(missing_keys), batch_size):
+            batch_keys = missing_keys[start : start + batch_size]
+            embeddings = embed_model._get_text_embeddings(
+                [missing[key] for key in batch_keys]
+            )
+            computed = dict(zip(batch_keys, embeddings))
+            self.put_many(embed_model.model_name, computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,203 @@
+"""
+Binary, memory-mapped replacement for the persisted `vector_store.json`.
+
+Layout inside an index directory:
+- embeddings.bin    row-major float32 (or float16) matrix, one row per node
+- embeddings.json   header: dtype, dim, count and the node id / ref doc id tables
+
+Rows are stored L2-normalised, so a dot product is the cosine similarity
+that llama_index's simple vector store computes.
+"""
+from collections.abc import Mapping
+import json
+import os
+import sys
+
+import numpy as np
+
+from llama_index import StorageContext, VectorStoreIndex, load_index_from_storage
+from llama_index.vector_stores.simple import SimpleVectorStore, SimpleVectorStoreData
+
+EMBEDDINGS_FNAME = "embeddings.bin"
+EMBEDDINGS_HEADER_FNAME = "embeddings.json"
+VECTOR_STORE_FNAME = "vector_store.json"
+SUPPORTED_DTYPES = ("float32", "float16")
+
+
+def normalise_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def mmap_store_exists(persist_dir: str) -> bool:
+    return os.path.exists(os.path.join(persist_dir, EMBEDDINGS_HEADER_FNAME))
+
+
+class MmapEmbeddingStore:
+    """Read only view over a persisted embedding matrix.
+    The matrix is opened with mmap, so opening is O(1) and worker processes
+    share the same page cache.
+    """
+
+    def __init__(self, persist_dir: str) -> None:
+        self.persist_dir = persist_dir
+        with open(os.path.join(persist_dir, EMBEDDINGS_HEADER_FNAME)) as f:
+            header = json.load(f)
+        self.dtype = np.dtype(header["dtype"])
+        self.dim: int = header["dim"]
+        self.node_ids: list[str] = header["node_ids"]
+        self.ref_doc_ids: list[str] = header["ref_doc_ids"]
+        self.id_to_row = {node_id: row for row, node_id in enumerate(self.node_ids)}
+        if self.node_ids:
+            self.matrix = np.memmap(
+                os.path.join(persist_dir, EMBEDDINGS_FNAME),
+                dtype=self.dtype,
+                mode="r",
+                shape=(len(self.node_ids), self.dim),
+            )
+        else:
+            self.matrix = np.empty((0, self.dim), dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def get(self, node_id: str) -> list[float]:
+        return self.matrix[self.id_to_row[node_id]].astype(np.float32).tolist()
+
+    def embedding_dict(self) -> "MmapEmbeddingDict":
+        return MmapEmbeddingDict(self)
+
+    def text_id_to_ref_doc_id(self) -> dict[str, str]:
+        return dict(zip(self.node_ids, self.ref_doc_ids))
+
+    @staticmethod
+    def write(
+        persist_dir: str,
+        node_ids: list[str],
+        embeddings,
+        ref_doc_ids: list[str],
+        dtype: str = "float32",
+    ) -> None:
+        "write the matrix and header, replacing any previous store atomically"
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"dtype must be one of {SUPPORTED_DTYPES}, got {dtype}")
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(node_ids), -1)
+        matrix = normalise_rows(matrix).astype(dtype)
+        header = {
+            "dtype": dtype,
+            "dim": int(matrix.shape[1]),
+            "count": len(node_ids),
+            "normalised": True,
+            "node_ids": list(node_ids),
+            "ref_doc_ids": list(ref_doc_ids),
+        }
+        data_path = os.path.join(persist_dir, EMBEDDINGS_FNAME)
+        header_path = os.path.join(persist_dir, EMBEDDINGS_HEADER_FNAME)
+        matrix.tofile(data_path + ".tmp")
+        with open(header_path + ".tmp", "w") as f:
+            json.dump(header, f)
+        os.replace(data_path + ".tmp", data_path)
+        os.replace(header_path + ".tmp", header_path)
+
+    @classmethod
+    def write_from_vector_store(
+        cls, persist_dir: str, vector_store: SimpleVectorStore, dtype: str = "float32"
+    ) -> None:
+        data: SimpleVectorStoreData = vector_store._data
+        node_ids = list(data.embedding_dict.keys())
+        cls.write(
+            persist_dir,
+            node_ids,
+            [data.embedding_dict[node_id] for node_id in node_ids],
+            [data.text_id_to_ref_doc_id.get(node_id, "None") for node_id in node_ids],
+            dtype=dtype,
+        )
+
+
+class MmapEmbeddingDict(Mapping):
+    """dict-like view handed to SimpleVectorStore in place of its embedding_dict
+    rows are only decoded into python lists when they are read
+    """
+
+    def __init__(self, store: MmapEmbeddingStore) -> None:
+        self.store = store
+
+    def __getitem__(self, node_id: str) -> list[float]:
+        return self.store.get(node_id)
+
+    def __iter__(self):
+        return iter(self.store.node_ids)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __contains__(self, node_id) -> bool:
+        return node_id in self.store.id_to_row
+
+
+def load_index_from_mmap(
+    persist_dir: str, service_context=None, writable: bool = False, docstore=None
+) -> VectorStoreIndex:
+    """
+    drop in replacement for `load_index_from_storage` that reads embeddings
+    from the binary store instead of parsing vector_store.json
+
+    - writable=False: embeddings stay memory mapped, inserts/deletes are not possible
+    - writable=True: embeddings are copied into a plain dict, eg. for incremental updates
+    - docstore: eg. a read only compressed docstore, instead of parsing docstore.json
+    """
+    store = MmapEmbeddingStore(persist_dir)
+    if writable:
+        embedding_dict = {
+            node_id: store.get(node_id) for node_id in store.node_ids
+        }
+    else:
+        embedding_dict = store.embedding_dict()
+    vector_store = SimpleVectorStore(
+        data=SimpleVectorStoreData(
+            embedding_dict=embedding_dict,
+            text_id_to_ref_doc_id=store.text_id_to_ref_doc_id(),
+        )
+    )
+    sc = StorageContext.from_defaults(
+        persist_dir=persist_dir, vector_store=vector_store, docstore=docstore
+    )
+    return load_index_from_storage(sc, service_context=service_context)
+
+
+def convert_index_dir(
+    persist_dir: str, dtype: str = "float32", remove_json: bool = False
+) -> bool:
+    "one shot conversion of a persisted vector_store.json into the binary store"
+    json_path = os.path.join(persist_dir, VECTOR_STORE_FNAME)
+    if not os.path.exists(json_path):
+        print(f"skipping {persist_dir}: no {VECTOR_STORE_FNAME}")
+        return False
+
+    vector_store = SimpleVectorStore.from_persist_path(json_path)
+    MmapEmbeddingStore.write_from_vector_store(persist_dir, vector_store, dtype=dtype)
+    json_size = os.path.getsize(json_path)
+    bin_size = os.path.getsize(os.path.join(persist_dir, EMBEDDINGS_FNAME))
+    print(
+        f"converted {persist_dir}: {json_size / 2**20:.2f} MiB json -> "
+        f"{bin_size / 2**20:.2f} MiB {dtype}"
+    )
+    if remove_json:
+        os.remove(json_path)
+    return True
+
+
+if __name__ == "__main__":
+    # python embedding_store.py [float32|float16] [--remove-json]
+    from indexer import PATH_RAG_INDEX
+    from utils import documents_to_index
+
+    dtype = "float16" if "float16" in sys.argv else "float32"
+    remove_json = "--remove-json" in sys.argv
+    for doc_filename, _start_skip, _end_skip in documents_to_index:
+        convert_index_dir(
+            os.path.join(os.getcwd(), PATH_RAG_INDEX, doc_filename),
+            dtype=dtype,
+            remove_json=remove_json,
+        )
@@ -0,0 +1,218 @@
+"""
+Retrieval quality and speed over a golden question set, no llm calls.
+
+python evaluate.py [data/golden_questions.jsonl] [--top-k 10] [--cutoff 0.75] [--max-nodes 5]
+
+golden file, one json object per line:
+{"question": "How to do Occlusal scan?", "product": "IFU Primescan Connect DE", "expected_pages": [40, 41]}
+
+- runs the three retrieval levels of BuildRagIndex.retrieve_nodes for every question
+- reports recall@k, MRR and page hit rate of the retrieved pages, with per query latency
+- the level 1 candidates are scored too, to see what the cutoff and the cap drop
+- pages are compared as (product, page), page 40 of another manual is a miss
+- a question that fails, eg. because its product index is not built, is reported as an error
+"""
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+import indexer
+from llama_index.schema import BaseNode
+
+from indexer import index_to_product_mapping
+from combined_index import COMBINED_INDEX_NAME
+from embedding_cache import embedding_cache
+from registry import index_registry
+
+PATH_GOLDEN_QUESTIONS = "data/golden_questions.jsonl"
+EVALUATION_RECALL_AT = [1, 3, 5, 10]
+
+logger = logging.getLogger("indexer.evaluate")
+
+
+def load_golden(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+Source = tuple[str, int]
+
+
+def node_source(node: BaseNode, product: str) -> Source:
+    "(product, page) of a node, combined index nodes carry both in their metadata"
+    return node.metadata.get("product", product), int(node.metadata.get("page", node.ref_doc_id))
+
+
+def ranked_pages(sources_with_scores: list[tuple[str, int, float]]) -> list[Source]:
+    "(product, page) in rank order, a page with several nodes counts once at its best rank"
+    pages = []
+    for product, page, _score in sources_with_scores:
+        if (product, page) not in pages:
+            pages.append((product, page))
+    return pages
+
+
+def recall_at(pages: list[Source], expected: set[Source], k: int) -> float:
+    return len(expected.intersection(pages[:k])) / len(expected) if expected else 0.0
+
+
+def reciprocal_rank(pages: list[Source], expected: set[Source]) -> float:
+    for rank, page in enumerate(pages, start=1):
+        if page in expected:
+            return 1.0 / rank
+    return 0.0
+
+
+def evaluate_question(item: dict, combined: bool, recall_ks: list[int]) -> dict:
+    product = item["product"]
+    expected = set((product, int(page)) for page in item["expected_pages"])
+    if combined:
+        b = index_registry.get(COMBINED_INDEX_NAME)
+    else:
+        b = index_registry.get(index_to_product_mapping[product])
+
+    start = time.perf_counter()
+    query_embedding = embedding_cache.get_query_embedding(
+        b.rag_index.service_context.embed_model, item["question"]
+    )
+    embed_seconds = time.perf_counter() - start
+
+    timings = {}
+    start = time.perf_counter()
+    if combined:
+        nodes = b.retrieve_nodes(item["question"], query_embedding, timings, product)
+    else:
+        nodes = b.retrieve_nodes(item["question"], query_embedding, timings)
+    retrieve_seconds = time.perf_counter() - start
+
+    # level 1 candidates, outside the timed call, from the search retrieve_nodes filters
+    if combined:
+        [(rows, scores)] = b.search(
+            [query_embedding], [b.product_code(product)], indexer.SIMILARITY_TOP_K
+        )
+    else:
+        [(rows, scores)] = b.retriever.search(query_embedding, indexer.SIMILARITY_TOP_K)
+    candidates = [
+        (*node_source(node.node, product), round(float(node.score), 4))
+        for node in b.retriever.to_nodes(rows, scores)
+    ]
+    retrieved = [
+        (*node_source(node.node, product), round(float(node.score), 4)) for node in nodes
+    ]
+    pages = ranked_pages(retrieved)
+    candidate_pages = ranked_pages(candidates)
+
+    return {
+        "question": item["question"],
+        "product": product,
+        "expected_pages": sorted(page for _product, page in expected),
+        "retrieved": retrieved,
+        "candidates": candidates,
+        "recall": {str(k): recall_at(pages, expected, k) for k in recall_ks},
+        "candidate_recall": recall_at(candidate_pages, expected, len(candidate_pages)),
+        "reciprocal_rank": reciprocal_rank(pages, expected),
+        "hit": bool(expected.intersection(pages)),
+        "embed_ms": round(embed_seconds * 1000, 3),
+        "retrieve_ms": round(retrieve_seconds * 1000, 3),
+        "stage_ms": {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+    }
+
+
+def evaluate_or_error(item: dict, combined: bool, recall_ks: list[int]) -> dict:
+    "evaluate_question, or an error record so one failing question does not end the run"
+    try:
+        return evaluate_question(item, combined, recall_ks)
+    except Exception as exc:
+        logger.exception(f"evaluation failed for: {item['question']}")
+        return {
+            "question": item["question"],
+            "product": item["product"],
+            "error": f"{type(exc).__name__}: {exc}",
+        }
+
+
+def summarise(results: list[dict], recall_ks: list[int]) -> dict:
+    errors = [
+        {"question": r["question"], "product": r["product"], "error": r["error"]}
+        for r in results if "error" in r
+    ]
+    results = [result for result in results if "error" not in result]
+    if not results:
+        return {"questions": 0, "errors": errors}
+    latencies = np.asarray([result["retrieve_ms"] for result in results])
+    return {
+        "questions": len(results),
+        "errors": errors,
+        "recall": {
+            str(k): round(float(np.mean([r["recall"][str(k)] for r in results])), 4)
+            for k in recall_ks
+        },
+        "candidate_recall": round(float(np.mean([r["candidate_recall"] for r in results])), 4),
+        "mrr": round(float(np.mean([r["reciprocal_rank"] for r in results])), 4),
+        "page_hit_rate": round(float(np.mean([r["hit"] for r in results])), 4),
+        "retrieve_ms": {
+            "p50": round(float(np.percentile(latencies, 50)), 3),
+            "p95": round(float(np.percentile(latencies, 95)), 3),
+            "max": round(float(latencies.max()), 3),
+        },
+    }
+
+
+def evaluate(
+    golden_path: str = PATH_GOLDEN_QUESTIONS,
+    combined: bool = False,
+    recall_ks: list[int] = EVALUATION_RECALL_AT,
+) -> dict:
+    results = [
+        evaluate_or_error(item, combined, recall_ks) for item in load_golden(golden_path)
+    ]
+    return {
+        "config": {
+            "similarity_top_k": indexer.SIMILARITY_TOP_K,
+            "similarity_cutoff": indexer.SIMILARITY_CUTOFF,
+            "max_source_nodes": indexer.MAX_SOURCE_NODES,
+            "combined": combined,
+        },
+        "summary": summarise(results, recall_ks),
+        "questions": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="evaluate retrieval over a golden question set")
+    parser.add_argument("golden", nargs="?", default=PATH_GOLDEN_QUESTIONS)
+    parser.add_argument("--top-k", type=int, default=indexer.SIMILARITY_TOP_K)
+    parser.add_argument("--cutoff", type=float, default=indexer.SIMILARITY_CUTOFF)
+    parser.add_argument("--max-nodes", type=int, default=indexer.MAX_SOURCE_NODES)
+    parser.add_argument("--recall-at", type=int, nargs="+", default=EVALUATION_RECALL_AT)
+    parser.add_argument("--combined", action="store_true", help="search the combined index")
+    parser.add_argument("--output", default=None, help="write the full report as json")
+    args = parser.parse_args()
+
+    # retrieve_nodes reads the module level settings on every call
+    indexer.SIMILARITY_TOP_K = args.top_k
+    indexer.SIMILARITY_CUTOFF = args.cutoff
+    indexer.MAX_SOURCE_NODES = args.max_nodes
+
+    report = evaluate(args.golden, args.combined, args.recall_at)
+    for result in report["questions"]:
+        if "error" in result:
+            print(f"error {result['question']} ({result['product']}): {result['error']}")
+            continue
+        print(
+            f"{'hit ' if result['hit'] else 'miss'} rr={result['reciprocal_rank']:.2f} "
+            f"{result['retrieve_ms']:.2f}ms {result['question']} "
+            f"expected {result['expected_pages']}, got "
+            + ", ".join(
+                str(page) if product == result["product"] else f"{product} p. {page}"
+                for product, page in ranked_pages(result["retrieved"])
+            )
+        )
+    print(json.dumps(report["config"]))
+    print(json.dumps(report["summary"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,93 @@
+"""
+Partitioned pdf elements cached per pdf content hash.
+
+- data/extraction-cache/<sha256 of the pdf>.jsonl.gz, one json line per page:
+  [page_number, [[category, text], ...]], after a header line with the format and partitioner versions
+- re-indexing an unchanged pdf, eg. with other filtering hyperparameters or start/end skips,
+  reads the elements back instead of partitioning again
+- a cache file is only renamed into place once every page is written
+"""
+from importlib import metadata
+from typing import Iterable, Iterator
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import logging
+
+PATH_EXTRACTION_CACHE = "data/extraction-cache/"
+# bump when the cached element format changes
+EXTRACTION_CACHE_VERSION: int = 1
+# reuse partitioned elements of pdfs that did not change
+USE_EXTRACTION_CACHE: bool = True
+
+logger = logging.getLogger("indexer.extraction_cache")
+
+PageElements = tuple[int | None, list[tuple[str, str]]]
+
+
+def document_hash(document_location: str) -> str:
+    digest = hashlib.sha256()
+    with open(document_location, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def partitioner_version() -> str:
+    try:
+        return metadata.version("unstructured")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def cache_header() -> dict:
+    return {"version": EXTRACTION_CACHE_VERSION, "unstructured": partitioner_version()}
+
+
+def elements_path(document_location: str) -> str:
+    return os.path.join(
+        os.getcwd(),
+        PATH_EXTRACTION_CACHE,
+        f"{document_hash(document_location)}.jsonl.gz",
+    )
+
+
+def is_cached(path: str) -> bool:
+    "a cache file written by this format and partitioner version"
+    if not os.path.exists(path):
+        return False
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+    if header != cache_header():
+        logger.debug(f"extraction cache: stale {path}, header {header}")
+        return False
+    return True
+
+
+def write_page_elements(path: str, pages: Iterable[PageElements]) -> str:
+    "consumes pages, the file only appears under path when all of them are written"
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.open(
+            raw, "wt", encoding="utf-8", compresslevel=6
+        ) as f:
+            f.write(json.dumps(cache_header()) + "\n")
+            for page_number, page_elements in pages:
+                f.write(json.dumps([page_number, page_elements]) + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+def read_page_elements(path: str) -> Iterator[PageElements]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        f.readline()
+        for line in f:
+            page_number, page_elements = json.loads(line)
+            yield page_number, page_elements
@@ -3,29 +3,53 @@ from llama_index import (
     VectorStoreIndex,
     get_response_synthesizer,
     StorageContext,
+    ServiceContext,
     load_index_from_storage,
-    SummaryIndex,
 )
-from llama_index.retrievers import VectorIndexRetriever
-from llama_index.node_parser import SimpleNodeParser
-from llama_index.query_engine import RetrieverQueryEngine
-from llama_index.indices.postprocessor import SimilarityPostprocessor
-from llama_index.schema import Node
-
-import unstructured
-from unstructured.partition.auto import partition
-
-from prompts import text_qa_template
+from llama_index.schema import BaseNode, MetadataMode, NodeWithScore
+
+from prompts import text_qa_prompt
+from embedding_store import MmapEmbeddingStore, load_index_from_mmap, mmap_store_exists
+from retriever import MatrixRetriever
+from lexical import LexicalIndex
+from ann import ANN_MIN_NODES, IVFPQIndex, remove_ann_index
+from quantization import QuantizedScan, write_quantized
+from compressed_docstore import load_compressed_docstore, write_compressed_docstore
+from chunking import node_tokens, nodes_from_pages, pack_context, page_text
+from embedding_cache import embedding_cache
+from answer_cache import answer_cache
+from tracing import Span, count_tokens, in_context, queued_file_handler, record, span
 
 import os
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 from itertools import chain
+from typing import Iterator
 from collections import Counter
+from dataclasses import dataclass, field
 import json
 import logging
-
-
-SIMILARITY_TOP_K = 5
+import time
+
+import numpy as np
+
+
+# level 1: nodes scored by the retriever
+SIMILARITY_TOP_K: int = 10
+# level 2: minimum cosine similarity for a node to be used
+SIMILARITY_CUTOFF: float = 0.75
+# level 3: maximum number of nodes handed to the response synthesizer
+MAX_SOURCE_NODES: int = 5
+# level 4: maximum tokens of node text handed to the response synthesizer
+MAX_CONTEXT_TOKENS: int = 3000
+# bm25 candidates fused with the vector candidates at level 1
+LEXICAL_TOP_K: int = 10
+# a bm25 hit this strong, and this far ahead of the runner up,
+# is answered without embedding the query
+LEXICAL_CONFIDENT_SCORE: float = 15.0
+LEXICAL_CONFIDENT_RATIO: float = 1.5
 PATH_RAG_INDEX = "data/rag-index/"
 PATH_TO_DATA = "data/"
 
@@ -33,13 +57,25 @@ PATH_TO_DATA = "data/"
 THRESHOLD_INFORMATION_VALUE: int = 20
 TEXT_IN_DOCUMENT_LOWER_BOUND: int = 2
 
+# partition page ranges in parallel and never hold all elements of a pdf in memory
+STREAMING_PARTITION: bool = True
+# section aware, token budgeted chunks (chunking.py) instead of SimpleNodeParser
+SECTION_CHUNKING: bool = True
+
+# threads that run the cpu bound retrieval for async callers
+RETRIEVAL_WORKERS: int = 4
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-fh = logging.FileHandler("indexer.log", mode="a")
-fh.setLevel(logging.DEBUG)
+# written by a background thread, logging never blocks a request on file io
+fh = queued_file_handler("indexer.log", logging.DEBUG)
 logger.addHandler(fh)
 
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval"
+)
+
 product_descriptions = {
     "CEREC Primemill": "This is an device that is used for computed-aided production of dental restorations, abutments, parts of abutments and drilling templates for implant placement.",
     "Primescan Connect": "Primescan Connect allows you to create digital impressions for detnal purposes and send digital scans to a laboratory of your choice to manufacture at your laboratory partner.",
@@ -57,21 +93,62 @@ index_to_product_mapping = {
 }
 
 
+@dataclass
+class UpdateReport:
+    "outcome of an incremental re-index, page numbers are the persisted ref_doc_ids"
+    doc_filename: str
+    added: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    unchanged: int = 0
+    timings: dict[str, float] = field(default_factory=dict)
+
+
 class BuildRagIndex:
     def __init__(
         self,
         doc_filename: str,
         start_skip: int = 0,
         end_skip: int = 0,
+        load_index: bool = True,
     ):
         self.doc_filename = doc_filename  # IFU_CEREC_Primemill_EN_6719681.pdf
         self.start_skip = start_skip
         self.end_skip = end_skip
         self.text_in_document_lower_bound = TEXT_IN_DOCUMENT_LOWER_BOUND
         self.threshold_information_value = THRESHOLD_INFORMATION_VALUE
-        self.rag_index = self.build_or_retrieve_index()
+        # load_index=False gives a handle for the ingestion steps only
+        if load_index:
+            self.attach_index(self.build_or_retrieve_index())
         pass
 
+    def attach_index(self, rag_index: VectorStoreIndex):
+        "set up retrieval and synthesis over a built or loaded index"
+        self.rag_index = rag_index
+        self.retriever = MatrixRetriever.from_index(self.rag_index)
+        self.retriever.attach_lexical_index(self.load_lexical_index(self.rag_index))
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, self.doc_filename)
+        self.retriever.attach_ann_index(IVFPQIndex.load(persist_dir))
+        quantized_scan = QuantizedScan.load(persist_dir)
+        self.retriever.attach_quantized_scan(quantized_scan)
+        if quantized_scan is not None and self.retriever.quantized_scan is None:
+            logger.warning(
+                f"{quantized_scan.kind} scan of {self.doc_filename} needs the embeddings.bin "
+                "store it was written from, run python quantization.py; using the exact scan"
+            )
+        self.response_synthesizer = get_response_synthesizer(
+            service_context=self.rag_index.service_context,
+            response_mode="compact_accumulate",
+            text_qa_template=text_qa_prompt,
+        )
+        # compact_accumulate cannot stream, streamed answers use compact
+        self.streaming_synthesizer = get_response_synthesizer(
+            service_context=self.rag_index.service_context,
+            response_mode="compact",
+            text_qa_template=text_qa_prompt,
+            streaming=True,
+        )
+
     def build_or_retrieve_index(self) -> VectorStoreIndex:
         index_exists = self.check_if_index_exists()
 
@@ -83,11 +160,9 @@ class BuildRagIndex:
                 f"index does not exist for {self.doc_filename}, hence building it."
             )
             # build and retrieve index
-            paged_text = self.split_document_into_pages()
-            rag_index = self.build_index(paged_text)
-            # save rag index
-            self.save_rag_index(rag_index)
-            return rag_index
+            paged_elements = self.split_document_into_pages()
+            # build_index persists the index and its derived files
+            return self.build_index(paged_elements)
 
     def check_if_index_exists(self) -> bool:
         "use filename to check if index exists"
@@ -101,13 +176,33 @@ class BuildRagIndex:
 
     def retrieve_index(self) -> VectorStoreIndex:
         "called if check index comes true"
-        sc = StorageContext.from_defaults(
-            persist_dir=os.path.join(os.getcwd(), PATH_RAG_INDEX, self.doc_filename)
-        )
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, self.doc_filename)
+        # node bodies are only decoded when retrieved, no docstore.json parse
+        docstore = load_compressed_docstore(persist_dir)
+        if mmap_store_exists(persist_dir):
+            # binary embeddings, no vector_store.json parse on the load path
+            return load_index_from_mmap(persist_dir, docstore=docstore)
+        sc = StorageContext.from_defaults(persist_dir=persist_dir, docstore=docstore)
         index = load_index_from_storage(sc)
         #! make sure you are ok with removing index_id
         return index
 
+    def load_lexical_index(self, rag_index: VectorStoreIndex) -> LexicalIndex:
+        "persisted bm25 index, built from the docstore for indexes that predate it"
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, self.doc_filename)
+        lexical_index = LexicalIndex.load(persist_dir)
+        if lexical_index is None:
+            lexical_index = self.build_lexical_index(rag_index)
+            if os.path.exists(persist_dir):
+                lexical_index.persist(persist_dir)
+        return lexical_index
+
+    @staticmethod
+    def build_lexical_index(rag_index: VectorStoreIndex) -> LexicalIndex:
+        return LexicalIndex.build(
+            [(node_id, node.get_content()) for node_id, node in rag_index.docstore.docs.items()]
+        )
+
     def split_document_into_pages(self) -> dict:
         """
         take a pdf document and split it into paged content
@@ -115,34 +210,25 @@ class BuildRagIndex:
         - skip end to account for ending cruft
 
         Output:
-        - a dict of {page_number: text}
+        - a dict of {page_number: [(category, text), ...]}, the unstructured elements of the page
         """
-        # to keep track of text frequency to do use information entropy on
-        textrank = Counter()
-
         document_location = os.path.join(os.getcwd(), PATH_TO_DATA, self.doc_filename)
         logger.debug(
             f"document to be indexed checked for at location: {document_location}"
         )
 
-        elements = partition(filename=document_location)
-        paged_text_list = defaultdict(list)
-        logger.debug(f"paged_text_list {list(paged_text_list.items())[25:35]}")
-
-        # first build textrank
-        for el in elements:
-            textrank.update([el.text])
+        if STREAMING_PARTITION:
+            # ingestion only, not imported on the serving path
+            from partitioning import partition_with_frequency_filter
 
-        # now add the relevant text that is below threshold information entropy value
-        for el in elements:
-            frequency_of_text = textrank[el.text]
-            if frequency_of_text < self.threshold_information_value:
-                paged_text_list[el.metadata.page_number].append(el.text)
-            else:
-                logger.debug(f"frequency: {frequency_of_text} skipped text: {el.text}")
+            paged_text_list, old_size = partition_with_frequency_filter(
+                document_location, self.threshold_information_value
+            )
+        else:
+            paged_text_list, old_size = self.partition_in_memory(document_location)
+        logger.debug(f"paged_text_list {list(paged_text_list.items())[25:35]}")
 
         ########### Text analytics for logging
-        old_size = len(elements)
         new_size = sum([len(textlist) for textlist in paged_text_list.values()])
 
         logger.debug(
@@ -179,36 +265,160 @@ class BuildRagIndex:
         )
         logger.debug(f"skipped_pages {skipped_pages}")
 
-        paged_text = {
-            pagenumber: "\n".join(textlist)
+        paged_elements = {
+            pagenumber: textlist
             for pagenumber, textlist in paged_text_list.items()
             if pagenumber not in skipped_pages
             and pagenumber not in skipped_pages_due_to_low_information.keys()
         }
 
-        logger.debug(f"paged_text: {list(paged_text.items())[25:35]}")
+        logger.debug(f"paged_elements: {list(paged_elements.items())[25:35]}")
 
-        return paged_text
+        return paged_elements
+
+    def partition_in_memory(self, document_location: str) -> tuple[dict, int]:
+        "whole document partitioning, every element is held in memory"
+        # ingestion only, unstructured is slow to import
+        from unstructured.partition.auto import partition
+
+        # to keep track of text frequency to do use information entropy on
+        textrank = Counter()
+
+        elements = partition(filename=document_location)
+        paged_text_list = defaultdict(list)
+
+        # first build textrank
+        for el in elements:
+            textrank.update([el.text])
+
+        # now add the relevant text that is below threshold information entropy value
+        for el in elements:
+            frequency_of_text = textrank[el.text]
+            if frequency_of_text < self.threshold_information_value:
+                paged_text_list[el.metadata.page_number].append((el.category, el.text))
+            else:
+                logger.debug(f"frequency: {frequency_of_text} skipped text: {el.text}")
+        return paged_text_list, len(elements)
+
+    def parse_nodes(self, paged_document: dict) -> list[BaseNode]:
+        "one document per page, split into nodes"
+        if SECTION_CHUNKING:
+            nodes = nodes_from_pages(paged_document)
+            logger.debug(f"num of nodes created {len(nodes)} from {len(paged_document)} pages")
+            return nodes
+
+        from llama_index.node_parser import SimpleNodeParser
 
-    def build_index(self, paged_document: dict):
-        """
-        index document and store it with the filename
-        """
         parser = SimpleNodeParser.from_defaults()
 
         documents = [
-            Document(doc_id=pagenum, text=text_on_page)
-            for pagenum, text_on_page in paged_document.items()
+            Document(doc_id=pagenum, text=page_text(page_elements))
+            for pagenum, page_elements in paged_document.items()
         ]
         logger.debug("num of documents created {}".format(len(documents)))
         nodes = parser.get_nodes_from_documents(documents, show_progress=True)
         logger.debug("num of nodes created {}".format(len(nodes)))
-        rag_index = VectorStoreIndex(nodes)
+        return nodes
+
+    def build_index(self, paged_document: dict):
+        """
+        index document and store it with the filename
+        """
+        nodes = self.parse_nodes(paged_document)
+        service_context = ServiceContext.from_defaults()
+        self.embed_nodes(nodes, service_context.embed_model)
+        rag_index = VectorStoreIndex(nodes, service_context=service_context)
         self.save_rag_index(rag_index)
         return rag_index
 
         ...
 
+    def update_index(self) -> UpdateReport:
+        """
+        incremental re-index of a new revision of the document
+        - per page content hashes are diffed against the persisted docstore
+        - only added and changed pages are parsed and embedded
+        - nodes of changed and removed pages are deleted
+        """
+        if not self.check_if_index_exists():
+            self.attach_index(self.build_or_retrieve_index())
+            return UpdateReport(
+                self.doc_filename, added=[str(p) for p in self.rag_index.ref_doc_info]
+            )
+
+        report = UpdateReport(self.doc_filename)
+        timings = report.timings
+
+        stage_start = time.perf_counter()
+        paged_elements = {
+            str(pagenum): page_elements
+            for pagenum, page_elements in self.split_document_into_pages().items()
+        }
+        timings["partition"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, self.doc_filename)
+        if mmap_store_exists(persist_dir):
+            rag_index = load_index_from_mmap(persist_dir, writable=True)
+        else:
+            rag_index = load_index_from_storage(
+                StorageContext.from_defaults(persist_dir=persist_dir)
+            )
+        timings["load"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        persisted_hashes = {}
+        for pagenum, ref_doc_info in rag_index.docstore.get_all_ref_doc_info().items():
+            source_node = rag_index.docstore.get_node(ref_doc_info.node_ids[0]).source_node
+            persisted_hashes[pagenum] = source_node.hash if source_node else None
+        new_hashes = {
+            pagenum: Document(doc_id=pagenum, text=page_text(page_elements)).hash
+            for pagenum, page_elements in paged_elements.items()
+        }
+        for pagenum, page_hash in new_hashes.items():
+            if pagenum not in persisted_hashes:
+                report.added.append(pagenum)
+            elif persisted_hashes[pagenum] != page_hash:
+                report.changed.append(pagenum)
+            else:
+                report.unchanged += 1
+        report.removed = [p for p in persisted_hashes if p not in new_hashes]
+        timings["diff"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        for pagenum in report.changed + report.removed:
+            rag_index.delete_ref_doc(pagenum, delete_from_docstore=True)
+        timings["delete"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        nodes = self.parse_nodes(
+            {pagenum: paged_elements[pagenum] for pagenum in report.added + report.changed}
+        )
+        timings["parse"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        self.embed_nodes(nodes, rag_index.service_context.embed_model)
+        rag_index.insert_nodes(nodes)
+        timings["embed"] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        self.save_rag_index(rag_index)
+        timings["write"] = time.perf_counter() - stage_start
+
+        self.attach_index(rag_index)
+        logger.debug(f"update report: {report}")
+        return report
+
+    def embed_nodes(self, nodes: list[BaseNode], embed_model) -> None:
+        "set node embeddings through the embedding cache, unchanged text is not re-embedded"
+        embeddings = embedding_cache.get_text_embeddings(
+            embed_model,
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes],
+        )
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        logger.debug(f"embedding cache: {embedding_cache.stats()}")
+
     def save_index_with_filename(self):
         "save the index with the filename"
         ...
@@ -221,84 +431,377 @@ class BuildRagIndex:
             os.makedirs(dir_to_save_index)
         # rag_index.set_index_id(self.urlsplit_obj.netloc)
         rag_index.storage_context.persist(persist_dir=dir_to_save_index)
+        # answers from the previous version of the index are stale
+        answer_cache.invalidate(self.doc_filename)
+        MmapEmbeddingStore.write_from_vector_store(
+            dir_to_save_index, rag_index.storage_context.vector_store
+        )
+        self.build_lexical_index(rag_index).persist(dir_to_save_index)
+        write_compressed_docstore(dir_to_save_index, rag_index.docstore)
+        store = MmapEmbeddingStore(dir_to_save_index)
+        write_quantized(dir_to_save_index, store.matrix, store.node_ids)
+        self.save_ann_index(dir_to_save_index, store)
+
+    @staticmethod
+    def save_ann_index(persist_dir: str, store: MmapEmbeddingStore):
+        "ivf-pq index next to the binary embedding store, for large indexes only"
+        if len(store) < ANN_MIN_NODES:
+            # a previous, larger version of the index may have left one
+            remove_ann_index(persist_dir)
+            return
+        start = time.perf_counter()
+        IVFPQIndex.build(store.matrix, store.node_ids).persist(persist_dir)
+        logger.debug(
+            f"ann index for {len(store)} nodes built in {time.perf_counter() - start:.1f}s"
+        )
 
     def query(self, query_text: str):
-        response = self.query_rag_index(query_text)
-        response_text = str(response)
-        sources = list(
-            set(
-                [
-                    int(node_with_score.node.ref_doc_id)
-                    for node_with_score in response.source_nodes
-                ]
+        timings = {}
+        lexical_nodes = self.lexical_shortcut(query_text, timings)
+        if lexical_nodes is not None:
+            response = self.synthesize(query_text, lexical_nodes, timings)
+            self.log_timings(timings)
+            return self.finish_query(query_text, None, response)
+
+        query_embedding = self.embed_query(query_text)
+        cached_answer = answer_cache.lookup(self.doc_filename, query_embedding)
+        if cached_answer is not None:
+            return cached_answer
+
+        response = self.query_rag_index(query_text, query_embedding)
+        return self.finish_query(query_text, query_embedding, response)
+
+    async def aquery(
+        self, query_text: str, llm_semaphore: asyncio.Semaphore | None = None
+    ):
+        """
+        async version of query
+        - query embedding and synthesis use the async llm/embedding clients
+        - the cpu bound retrieval runs on the bounded retrieval executor
+        - llm_semaphore caps the synthesis calls in flight
+        """
+        timings = {}
+        lexical_nodes = self.lexical_shortcut(query_text, timings)
+        if lexical_nodes is not None:
+            response = await self.asynthesize(
+                query_text, lexical_nodes, timings, llm_semaphore
             )
+            self.log_timings(timings)
+            return self.finish_query(query_text, None, response)
+
+        query_embedding = await self.aembed_query(query_text)
+        cached_answer = answer_cache.lookup(self.doc_filename, query_embedding)
+        if cached_answer is not None:
+            return cached_answer
+
+        logger.debug(f"querying rag index for --> {query_text}")
+        loop = asyncio.get_running_loop()
+        retrieved_nodes = await loop.run_in_executor(
+            retrieval_executor,
+            in_context(self.retrieve_nodes, query_text, query_embedding, timings),
+        )
+        response = await self.asynthesize(
+            query_text, retrieved_nodes, timings, llm_semaphore
         )
+        self.log_timings(timings)
+        return self.finish_query(query_text, query_embedding, response)
+
+    def stream_query(self, query_text: str) -> tuple[Iterator[str], list[int]]:
+        """
+        streaming version of query
+        - retrieval runs right away, so the source pages are known before the first token
+        - the returned iterator yields answer tokens as the llm produces them
+        """
+        timings = {}
+        query_embedding = None
+        retrieved_nodes = self.lexical_shortcut(query_text, timings)
+        if retrieved_nodes is None:
+            query_embedding = self.embed_query(query_text)
+            cached_answer = answer_cache.lookup(self.doc_filename, query_embedding)
+            if cached_answer is not None:
+                response_text, sources = cached_answer
+                return iter([response_text]), sources
+
+            logger.debug(f"querying rag index for --> {query_text}")
+            retrieved_nodes = self.retrieve_nodes(query_text, query_embedding, timings)
+        return self.stream_answer(query_text, query_embedding, retrieved_nodes, timings)
+
+    async def astream_query(self, query_text: str) -> tuple[Iterator[str], list[int]]:
+        """
+        async version of stream_query
+        - the query embedding uses the async embedding client
+        - the cpu bound retrieval runs on the bounded retrieval executor
+        - nothing is sent to the llm until the returned iterator is read
+        """
+        timings = {}
+        query_embedding = None
+        retrieved_nodes = self.lexical_shortcut(query_text, timings)
+        if retrieved_nodes is None:
+            query_embedding = await self.aembed_query(query_text)
+            cached_answer = answer_cache.lookup(self.doc_filename, query_embedding)
+            if cached_answer is not None:
+                response_text, sources = cached_answer
+                return iter([response_text]), sources
+
+            logger.debug(f"querying rag index for --> {query_text}")
+            retrieved_nodes = await asyncio.get_running_loop().run_in_executor(
+                retrieval_executor,
+                in_context(self.retrieve_nodes, query_text, query_embedding, timings),
+            )
+        return self.stream_answer(query_text, query_embedding, retrieved_nodes, timings)
+
+    def stream_answer(
+        self,
+        query_text: str,
+        query_embedding: list[float] | None,
+        retrieved_nodes: list[NodeWithScore],
+        timings: dict,
+    ) -> tuple[Iterator[str], list[int]]:
+        "answer tokens synthesized from retrieved_nodes, and their source pages"
+        sources = self.source_pages(retrieved_nodes)
+        if not retrieved_nodes:
+            # without nodes the synthesizer returns a plain Response, not a stream
+            logger.debug(f"no nodes passed the cutoff for --> {query_text}")
+            return iter(["Empty Response"]), sources
+
+        def tokens() -> Iterator[str]:
+            # a generator outlives any with block, so the span is recorded by hand
+            synthesis = Span("synthesis", attributes={"nodes": len(retrieved_nodes)})
+            response = self.streaming_synthesizer.synthesize(query_text, retrieved_nodes)
+            chunks = []
+            for token in response.response_gen:
+                if not chunks:
+                    timings["first_token"] = time.perf_counter() - synthesis.start
+                chunks.append(token)
+                yield token
+            synthesis.seconds = timings["synthesize"] = time.perf_counter() - synthesis.start
+            response_text = "".join(chunks)
+            self.count_synthesis_tokens(synthesis, retrieved_nodes, response_text)
+            synthesis.attributes["first_token_ms"] = round(timings["first_token"] * 1000, 3)
+            record(synthesis)
+            self.log_timings(timings)
+            logger.debug(f"response from query: {response_text}\n\nsources: {sources}")
+            if query_embedding is not None:
+                answer_cache.store(
+                    self.doc_filename, query_text, query_embedding, response_text, sources
+                )
+
+        return tokens(), sources
+
+    @staticmethod
+    def source_pages(nodes: list[NodeWithScore]) -> list[int]:
+        return list(set([int(node_with_score.node.ref_doc_id) for node_with_score in nodes]))
+
+    def finish_query(
+        self, query_text: str, query_embedding: list[float] | None, response
+    ):
+        "response text and source pages, cached for similar queries"
+        response_text = str(response)
+        sources = self.source_pages(response.source_nodes)
         logger.debug(f"response from query: {response_text}\n\nsources: {sources}")
+        # lexical shortcut answers have no embedding to key the answer cache on
+        if query_embedding is not None:
+            answer_cache.store(
+                self.doc_filename, query_text, query_embedding, response_text, sources
+            )
         return response_text, sources
 
-    def query_rag_index(self, query_text: str):
+    def query_rag_index(self, query_text: str, query_embedding: list[float] | None = None):
         "query the index for a given query"
         logger.debug(f"querying rag index for --> {query_text}")
-        retriever = VectorIndexRetriever(
-            index=self.rag_index,
-            similarity_top_k=10,
-            # node_ids=node_ids,
-            # filters=keyword_filters,
-        )
+        timings = {}
+        if query_embedding is None:
+            query_embedding = self.embed_query(query_text)
+        retrieved_nodes = self.retrieve_nodes(query_text, query_embedding, timings)
 
-        # ------- level 1 retreival
-        retrieved_nodes = retriever.retrieve(query_text)
-        logger.debug(
-            f"number of retrieved_nodes after 1st retreival: {len(retrieved_nodes)}"
-        )
+        # synthesize straight from the scored nodes, no intermediate index,
+        # so every retrieved node stays in response.source_nodes
+        response = self.synthesize(query_text, retrieved_nodes, timings)
 
-        def get_pages(retrieved_nodes: list[Node]) -> list[str]:
-            return [
-                (node_with_score.node.ref_doc_id, node_with_score.score)
-                for node_with_score in retrieved_nodes
-            ]
+        self.log_timings(timings)
+        return response
 
-        # print(retrieved_nodes[:2])
-        logger.debug(f"page_nums: {get_pages(retrieved_nodes)}")
+    def embed_query(self, query_text: str) -> list[float]:
+        with span("query_embedding", index=self.doc_filename):
+            return embedding_cache.get_query_embedding(
+                self.rag_index.service_context.embed_model, query_text
+            )
 
-        # ------- level 2 retreival
-        retrieved_nodes = [
-            node_with_score
-            for node_with_score in retrieved_nodes
-            if node_with_score.score > 0.75
-        ]
+    async def aembed_query(self, query_text: str) -> list[float]:
+        with span("query_embedding", index=self.doc_filename):
+            return await embedding_cache.aget_query_embedding(
+                self.rag_index.service_context.embed_model, query_text
+            )
 
-        logger.debug(
-            f"number of retrieved_nodes after 2nd retreival: {len(retrieved_nodes)}"
-        )
-        logger.debug(f"page_nums: {get_pages(retrieved_nodes)}")
+    def synthesize(self, query_text: str, nodes: list[NodeWithScore], timings: dict):
+        with span("synthesis", nodes=len(nodes)) as synthesis:
+            response = self.response_synthesizer.synthesize(query_text, nodes)
+        timings["synthesize"] = synthesis.seconds
+        self.count_synthesis_tokens(synthesis, nodes, str(response))
+        return response
 
-        # -------- level 3 retreival
-        # if number of nodes more than 5 just use the top 5
-        if len(retrieved_nodes) > 5:
-            retrieved_nodes = retrieved_nodes[:5]
+    async def asynthesize(
+        self,
+        query_text: str,
+        nodes: list[NodeWithScore],
+        timings: dict,
+        llm_semaphore: asyncio.Semaphore | None = None,
+    ):
+        "waiting on llm_semaphore is not counted as synthesis"
+        async with llm_semaphore or contextlib.nullcontext():
+            with span("synthesis", nodes=len(nodes)) as synthesis:
+                response = await self.response_synthesizer.asynthesize(query_text, nodes)
+        timings["synthesize"] = synthesis.seconds
+        self.count_synthesis_tokens(synthesis, nodes, str(response))
+        return response
 
-        # # configure response synthesizer
-        response_synthesizer = get_response_synthesizer(
-            response_mode="compact_accumulate"
+    @staticmethod
+    def count_synthesis_tokens(
+        synthesis: Span, nodes: list[NodeWithScore], response_text: str
+    ) -> None:
+        "counted after the span has ended, so tokenizing is not part of its duration"
+        synthesis.attributes["context_tokens"] = sum(node_tokens(node.node) for node in nodes)
+        synthesis.attributes["response_tokens"] = count_tokens(response_text)
+
+    def confident_lexical_hits(
+        self, query_text: str, timings: dict | None = None
+    ) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        (rows, bm25 scores) of a query that bm25 answers confidently on its own, else None
+        - the best hit must clear LEXICAL_CONFIDENT_SCORE and lead the runner up by LEXICAL_CONFIDENT_RATIO
+        - only the hits about as strong as the best one are kept
+        """
+        if self.retriever.lexical_index is None:
+            return None
+        with span("lexical_search", index=self.doc_filename) as lexical_search:
+            rows, scores = self.retriever.lexical_search(query_text, LEXICAL_TOP_K)
+            confident = len(rows) > 0 and scores[0] >= LEXICAL_CONFIDENT_SCORE
+            if confident and len(rows) > 1:
+                confident = scores[0] >= LEXICAL_CONFIDENT_RATIO * scores[1]
+            lexical_search.attributes.update(nodes=len(rows), confident=bool(confident))
+        if timings is not None:
+            timings["lexical"] = lexical_search.seconds
+        if not confident:
+            return None
+        keep = scores >= scores[0] / LEXICAL_CONFIDENT_RATIO
+        return rows[keep], scores[keep]
+
+    def lexical_shortcut(self, query_text: str, timings: dict) -> list[NodeWithScore] | None:
+        """
+        nodes for a query that bm25 answers confidently on its own, else None
+        - only taken when the query embedding is not cached, that is when it saves a remote call;
+          the router routes such queries lexically, so /converse/ never embeds them
+        - scores are cosine similarities to the bm25 weighted mean of the hits,
+          which stands in for the query embedding, so SIMILARITY_CUTOFF applies as usual
+        """
+        if (
+            embedding_cache.cached_query_embedding(
+                self.rag_index.service_context.embed_model, query_text
+            )
+            is not None
+        ):
+            return None
+        hits = self.confident_lexical_hits(query_text, timings)
+        if hits is None:
+            return None
+
+        rows, bm25_scores = hits
+        scores = self.retriever.similarities(
+            self.retriever.weighted_mean(rows, bm25_scores), rows
         )
+        order = np.argsort(-scores)
+        rows, scores = self.retriever.apply_cutoff(rows[order], scores[order], SIMILARITY_CUTOFF)
+        if len(rows) == 0:
+            return None
+        rows, scores = self.retriever.apply_cap(rows, scores, MAX_SOURCE_NODES)
+        logger.debug(f"lexical shortcut, query embedding skipped for --> {query_text}")
+        logger.debug(f"page_nums: {self.retriever.pages(rows, scores)}")
+        return pack_context(self.retriever.to_nodes(rows, scores), MAX_CONTEXT_TOKENS)
+
+    def retrieve_nodes(
+        self, query_text: str, query_embedding: list[float], timings: dict
+    ) -> list[NodeWithScore]:
+        "the three retrieval levels, stage timings are added to timings"
+        # ------- level 1 retreival
+        with span("vector_search", index=self.doc_filename) as vector_search:
+            [(rows, scores)] = self.retriever.search(query_embedding, SIMILARITY_TOP_K)
+            rows, scores = self.hybrid_candidates(query_text, query_embedding, rows, scores)
+            vector_search.attributes["nodes"] = len(rows)
+        timings["retrieve"] = vector_search.seconds
+
+        with span("score_filter", index=self.doc_filename) as score_filter:
+            retrieved_nodes = self.cut_candidates(rows, scores)
+            score_filter.attributes["nodes"] = len(retrieved_nodes)
+        timings["filter"] = score_filter.seconds
+        return retrieved_nodes
+
+    def retrieve_batch(
+        self, query_texts: list[str], query_embeddings: list[list[float]]
+    ) -> list[list[NodeWithScore]]:
+        "retrieve_nodes for many queries, level 1 scores all of them in one matrix product"
+        with span(
+            "vector_search", index=self.doc_filename, queries=len(query_texts)
+        ) as vector_search:
+            candidates = [
+                self.hybrid_candidates(query_text, query_embedding, rows, scores)
+                for query_text, query_embedding, (rows, scores) in zip(
+                    query_texts,
+                    query_embeddings,
+                    self.retriever.search(query_embeddings, SIMILARITY_TOP_K),
+                )
+            ]
+            vector_search.attributes["nodes"] = sum(len(rows) for rows, _ in candidates)
 
-        # construct index to query using retreived nodes
-        query_index = SummaryIndex(
-            nodes=[node_with_score.node for node_with_score in retrieved_nodes],
-        )
+        with span(
+            "score_filter", index=self.doc_filename, queries=len(query_texts)
+        ) as score_filter:
+            retrieved_nodes = [self.cut_candidates(rows, scores) for rows, scores in candidates]
+            score_filter.attributes["nodes"] = sum(len(nodes) for nodes in retrieved_nodes)
+        return retrieved_nodes
 
-        # assemble query engine
-        query_engine = query_index.as_query_engine(
-            response_synthesizer=response_synthesizer,
-            text_qa_template=text_qa_template,
-            # streaming=True
-        )
+    def hybrid_candidates(
+        self,
+        query_text: str,
+        query_embedding: list[float],
+        rows: np.ndarray,
+        scores: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        "level 1 vector candidates with the bm25 candidates fused in"
+        if self.retriever.lexical_index is not None:
+            # hybrid: bm25 candidates are fused in by rank, scores stay cosine
+            lexical_rows, lexical_scores = self.retriever.lexical_search(
+                query_text, LEXICAL_TOP_K
+            )
+            logger.debug(
+                f"lexical page_nums: {self.retriever.pages(lexical_rows, lexical_scores)}"
+            )
+            rows, scores = self.retriever.fuse(
+                query_embedding, rows, lexical_rows, SIMILARITY_TOP_K
+            )
+        logger.debug(f"number of retrieved_nodes after 1st retreival: {len(rows)}")
+        logger.debug(f"page_nums: {self.retriever.pages(rows, scores)}")
+        return rows, scores
 
-        response = query_engine.query(
-            query_text,
+    def cut_candidates(self, rows: np.ndarray, scores: np.ndarray) -> list[NodeWithScore]:
+        "levels 2 to 4"
+        # ------- level 2 retreival
+        rows, scores = self.retriever.apply_cutoff(rows, scores, SIMILARITY_CUTOFF)
+        logger.debug(f"number of retrieved_nodes after 2nd retreival: {len(rows)}")
+        logger.debug(f"page_nums: {self.retriever.pages(rows, scores)}")
+
+        # -------- level 3 retreival
+        # if number of nodes more than MAX_SOURCE_NODES just use the top ones
+        rows, scores = self.retriever.apply_cap(rows, scores, MAX_SOURCE_NODES)
+
+        # -------- level 4 retreival
+        # the best nodes whose recorded token counts fit MAX_CONTEXT_TOKENS
+        return pack_context(self.retriever.to_nodes(rows, scores), MAX_CONTEXT_TOKENS)
+
+    def log_timings(self, timings: dict):
+        logger.debug(
+            "stage timings (s): "
+            + ", ".join(f"{stage}: {seconds:.4f}" for stage, seconds in timings.items())
         )
-        return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+"""
+Batch ingestion of every manual in `utils.documents_to_index`.
+
+python ingest.py [--workers N] [--embed-concurrency N] [--embed-batch-size N]
+python ingest.py --incremental
+
+- partitioning, page filtering and node parsing run in a process pool (cpu bound)
+- nodes are embedded in batches on a bounded thread pool, through the embedding cache
+- each index is written as soon as all of its embeddings are back
+- --incremental only re-embeds the pages that changed since the index was built
+"""
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from dataclasses import dataclass, field
+import argparse
+import os
+import time
+import logging
+
+from llama_index import ServiceContext, VectorStoreIndex
+from llama_index.schema import BaseNode, MetadataMode
+
+from embedding_cache import embedding_cache
+from indexer import BuildRagIndex, UpdateReport
+import partitioning
+from utils import documents_to_index
+
+# concurrent embedding requests in flight
+INGEST_EMBED_CONCURRENCY: int = 4
+# texts per embedding request
+INGEST_EMBED_BATCH_SIZE: int = 64
+
+logger = logging.getLogger("indexer.ingest")
+
+
+@dataclass
+class ParsedDocument:
+    doc_filename: str
+    start_skip: int
+    end_skip: int
+    num_pages: int
+    nodes: list[BaseNode]
+    partition_seconds: float
+    parse_seconds: float
+
+
+@dataclass
+class IngestReport:
+    doc_filename: str
+    num_pages: int
+    num_nodes: int
+    partition_seconds: float
+    parse_seconds: float
+    embed_seconds: float = 0.0
+    write_seconds: float = 0.0
+    stage_rates: dict = field(default_factory=dict)
+
+
+def partition_and_parse(doc_filename: str, start_skip: int, end_skip: int) -> ParsedDocument:
+    "runs in a worker process"
+    # documents are already spread over processes, no nested pool per document
+    partitioning.PARTITION_WORKERS = 1
+    builder = BuildRagIndex(doc_filename, start_skip, end_skip, load_index=False)
+    start = time.perf_counter()
+    paged_elements = builder.split_document_into_pages()
+    partition_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    nodes = builder.parse_nodes(paged_elements)
+    parse_seconds = time.perf_counter() - start
+    return ParsedDocument(
+        doc_filename,
+        start_skip,
+        end_skip,
+        len(paged_elements),
+        nodes,
+        partition_seconds,
+        parse_seconds,
+    )
+
+
+def embed_batch(embed_model, nodes: list[BaseNode]) -> tuple[float, float]:
+    "embed one batch of nodes in place, returns (start, end) timestamps"
+    start = time.perf_counter()
+    embeddings = embedding_cache.get_text_embeddings(
+        embed_model, [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    )
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    return start, time.perf_counter()
+
+
+def write_index(
+    parsed: ParsedDocument, service_context: ServiceContext, batch_futures: list[Future]
+) -> IngestReport:
+    wait(batch_futures)
+    spans = [future.result() for future in batch_futures]
+    embed_seconds = (
+        max(end for _, end in spans) - min(start for start, _ in spans) if spans else 0.0
+    )
+
+    start = time.perf_counter()
+    rag_index = VectorStoreIndex(parsed.nodes, service_context=service_context)
+    builder = BuildRagIndex(
+        parsed.doc_filename, parsed.start_skip, parsed.end_skip, load_index=False
+    )
+    builder.save_rag_index(rag_index)
+    write_seconds = time.perf_counter() - start
+
+    report = IngestReport(
+        doc_filename=parsed.doc_filename,
+        num_pages=parsed.num_pages,
+        num_nodes=len(parsed.nodes),
+        partition_seconds=parsed.partition_seconds,
+        parse_seconds=parsed.parse_seconds,
+        embed_seconds=embed_seconds,
+        write_seconds=write_seconds,
+    )
+    report.stage_rates = {
+        "pages_per_second": rate(report.num_pages, report.partition_seconds),
+        "nodes_per_second": rate(report.num_nodes, report.parse_seconds),
+        "embeddings_per_second": rate(report.num_nodes, report.embed_seconds),
+    }
+    logger.debug(f"ingested {parsed.doc_filename}: {report}")
+    return report
+
+
+def rate(count: int, seconds: float) -> float:
+    return round(count / seconds, 2) if seconds > 0 else float("inf")
+
+
+def ingest_documents(
+    documents: list[tuple[str, int, int]] = documents_to_index,
+    max_workers: int | None = None,
+    embed_concurrency: int = INGEST_EMBED_CONCURRENCY,
+    embed_batch_size: int = INGEST_EMBED_BATCH_SIZE,
+) -> list[IngestReport]:
+    "rebuild the index of every document, partitioning in parallel and embedding in batches"
+    service_context = ServiceContext.from_defaults()
+    embed_model = service_context.embed_model
+    max_workers = max_workers or min(len(documents), os.cpu_count() or 1)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers) as partition_pool, ThreadPoolExecutor(
+        max_workers=embed_concurrency
+    ) as embed_pool, ThreadPoolExecutor(max_workers=len(documents)) as write_pool:
+        partition_futures = [
+            partition_pool.submit(partition_and_parse, *document) for document in documents
+        ]
+        write_futures = []
+        for future in as_completed(partition_futures):
+            parsed = future.result()
+            print(
+                f"partitioned {parsed.doc_filename}: {parsed.num_pages} pages, "
+                f"{len(parsed.nodes)} nodes in {parsed.partition_seconds:.1f}s"
+            )
+            batch_futures = [
+                embed_pool.submit(
+                    embed_batch, embed_model, parsed.nodes[i : i + embed_batch_size]
+                )
+                for i in range(0, len(parsed.nodes), embed_batch_size)
+            ]
+            write_futures.append(
+                write_pool.submit(write_index, parsed, service_context, batch_futures)
+            )
+        reports = [future.result() for future in write_futures]
+    total_seconds = time.perf_counter() - start
+
+    for report in reports:
+        print(
+            f"{report.doc_filename}: {report.num_pages} pages, {report.num_nodes} nodes, "
+            f"partition {report.partition_seconds:.1f}s, parse {report.parse_seconds:.1f}s, "
+            f"embed {report.embed_seconds:.1f}s, write {report.write_seconds:.1f}s, "
+            f"{report.stage_rates}"
+        )
+    total_pages = sum(report.num_pages for report in reports)
+    total_nodes = sum(report.num_nodes for report in reports)
+    print(
+        f"ingested {len(reports)} documents in {total_seconds:.1f}s: "
+        f"{rate(total_pages, total_seconds)} pages/s, "
+        f"{rate(total_nodes, total_seconds)} nodes/s end to end, "
+        f"embedding cache: {embedding_cache.stats()}"
+    )
+    return reports
+
+
+def update_documents(
+    documents: list[tuple[str, int, int]] = documents_to_index,
+) -> list[UpdateReport]:
+    "incremental re-index, only changed pages are parsed and embedded"
+    reports = []
+    for doc_filename, start_skip, end_skip in documents:
+        builder = BuildRagIndex(doc_filename, start_skip, end_skip, load_index=False)
+        report = builder.update_index()
+        print(
+            f"{doc_filename}: added {report.added}, changed {report.changed}, "
+            f"removed {report.removed}, unchanged {report.unchanged} pages, "
+            "timings: "
+            + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in report.timings.items())
+        )
+        reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rebuild all product indexes")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--embed-concurrency", type=int, default=INGEST_EMBED_CONCURRENCY)
+    parser.add_argument("--embed-batch-size", type=int, default=INGEST_EMBED_BATCH_SIZE)
+    parser.add_argument("--incremental", action="store_true")
+    args = parser.parse_args()
+    if args.incremental:
+        update_documents()
+        raise SystemExit
+    ingest_documents(
+        max_workers=args.workers,
+        embed_concurrency=args.embed_concurrency,
+        embed_batch_size=args.embed_batch_size,
+    )
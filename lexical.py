@@ -0,0 +1,160 @@
+"""
+BM25 inverted index over the nodes of one manual, persisted next to the vector store.
+
+python lexical.py    builds lexical_index.json for the existing index directories
+"""
+from collections import Counter, defaultdict
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+LEXICAL_INDEX_FNAME = "lexical_index.json"
+BM25_K1: float = 1.2
+BM25_B: float = 0.75
+# constant of reciprocal rank fusion, larger values flatten the rank weights
+RRF_K: int = 60
+
+# keeps part numbers and error codes such as "E-1203" or "5.2.1" as one token
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*", re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class LexicalIndex:
+    """Compact BM25 index.
+    - postings: term -> (doc positions, term frequencies) as numpy arrays
+    - doc positions index into node_ids, the same node ids as the vector store
+    """
+
+    def __init__(
+        self,
+        node_ids: list[str],
+        doc_lengths: np.ndarray,
+        postings: dict[str, tuple[np.ndarray, np.ndarray]],
+    ) -> None:
+        self.node_ids = node_ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        num_docs = len(node_ids)
+        self.idf = {
+            term: math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, (docs, _tfs) in postings.items()
+        }
+        # precomputed bm25 length normalisation per doc
+        self.length_norm = BM25_K1 * (
+            1 - BM25_B + BM25_B * doc_lengths / max(self.avg_doc_length, 1e-9)
+        )
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    @classmethod
+    def build(cls, documents: list[tuple[str, str]]) -> "LexicalIndex":
+        "documents: (node_id, text) pairs"
+        node_ids = []
+        doc_lengths = []
+        postings = defaultdict(lambda: ([], []))
+        for position, (node_id, text) in enumerate(documents):
+            tokens = tokenize(text)
+            node_ids.append(node_id)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                docs, tfs = postings[term]
+                docs.append(position)
+                tfs.append(tf)
+        return cls(
+            node_ids,
+            np.asarray(doc_lengths, dtype=np.float32),
+            {
+                term: (np.asarray(docs, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+                for term, (docs, tfs) in postings.items()
+            },
+        )
+
+    def search(self, query_text: str, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+        "(doc positions, bm25 scores) of the top_k matching docs, by descending score"
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query_text)):
+            if term not in self.postings:
+                continue
+            docs, tfs = self.postings[term]
+            # a term appears once per doc in its postings, so plain indexing is safe
+            scores[docs] += self.idf[term] * tfs * (BM25_K1 + 1) / (tfs + self.length_norm[docs])
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return matched, scores[matched]
+        k = min(top_k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+    def persist(self, persist_dir: str) -> None:
+        data = {
+            "node_ids": self.node_ids,
+            "doc_lengths": self.doc_lengths.astype(int).tolist(),
+            "postings": {
+                term: [docs.tolist(), tfs.astype(int).tolist()]
+                for term, (docs, tfs) in self.postings.items()
+            },
+        }
+        path = os.path.join(persist_dir, LEXICAL_INDEX_FNAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "LexicalIndex | None":
+        path = os.path.join(persist_dir, LEXICAL_INDEX_FNAME)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(
+            data["node_ids"],
+            np.asarray(data["doc_lengths"], dtype=np.float32),
+            {
+                term: (np.asarray(docs, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+                for term, (docs, tfs) in data["postings"].items()
+            },
+        )
+
+
+def reciprocal_rank_fusion(*rankings: list, k: int = RRF_K) -> list:
+    "fuse several ranked lists of ids, best first"
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            fused[item] += 1.0 / (k + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)
+
+
+def build_from_docstore_json(persist_dir: str) -> LexicalIndex:
+    "build from a persisted docstore.json, no re-partitioning needed"
+    with open(os.path.join(persist_dir, "docstore.json")) as f:
+        docstore = json.load(f)
+    return LexicalIndex.build(
+        [
+            (node_id, node["__data__"]["text"])
+            for node_id, node in docstore["docstore/data"].items()
+        ]
+    )
+
+
+if __name__ == "__main__":
+    from indexer import PATH_RAG_INDEX
+    from utils import documents_to_index
+
+    for doc_filename, _start_skip, _end_skip in documents_to_index:
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, doc_filename)
+        if not os.path.exists(os.path.join(persist_dir, "docstore.json")):
+            print(f"skipping {persist_dir}: no docstore.json")
+            continue
+        lexical_index = build_from_docstore_json(persist_dir)
+        lexical_index.persist(persist_dir)
+        print(f"built lexical index for {doc_filename}: {len(lexical_index.postings)} terms")
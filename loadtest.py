@@ -0,0 +1,72 @@
+"""
+Concurrent load against a running `/converse/` server, reports p50/p99 latency.
+
+python loadtest.py [--url http://localhost:8000] [--conversations 50] [--concurrency 20]
+
+Each conversation asks a question and confirms the classified product,
+so both the classification turn and the rag turn are measured.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import aiohttp
+import numpy as np
+
+QUESTIONS = [
+    "How to do Occlusal scan?",
+    "How do I change the filter bag and HEPA filter on my device?",
+    "How do I add new devices to my software?",
+    "How do I recalibrate my scanner?",
+    "So führen Sie einen okklusalen Scan durch?",
+]
+
+
+async def post(session, url: str, session_id: str, content: str) -> float:
+    start = time.perf_counter()
+    async with session.post(
+        url, json={"content": content}, headers={"X-Session-Id": session_id}
+    ) as response:
+        await response.read()
+        response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def conversation(session, url: str, question: str, latencies: dict) -> None:
+    session_id = uuid.uuid4().hex
+    latencies["classify"].append(await post(session, url, session_id, question))
+    latencies["answer"].append(await post(session, url, session_id, "y"))
+
+
+async def run(base_url: str, conversations: int, concurrency: int) -> dict:
+    url = base_url.rstrip("/") + "/converse/"
+    latencies = {"classify": [], "answer": []}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i: int) -> None:
+        async with semaphore:
+            await conversation(session, url, QUESTIONS[i % len(QUESTIONS)], latencies)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(bounded(i) for i in range(conversations)))
+    total_seconds = time.perf_counter() - start
+
+    report = {"conversations_per_second": round(conversations / total_seconds, 2)}
+    for turn, values in latencies.items():
+        report[turn] = {
+            "p50": round(float(np.percentile(values, 50)), 3),
+            "p99": round(float(np.percentile(values, 99)), 3),
+            "max": round(max(values), 3),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load test the /converse/ endpoint")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    print(asyncio.run(run(args.url, args.conversations, args.concurrency)))
@@ -1,10 +1,29 @@
-from langchain.llms import OpenAI
-from agents import Agent, classification_agent
-from indexer import BuildRagIndex, index_to_product_mapping, product_descriptions
-
-from fastapi import FastAPI
+from indexer import index_to_product_mapping, retrieval_executor
+from registry import index_registry
+from embedding_cache import embedding_cache
+from router import product_router
+from conversation_store import conversation_store
+from combined_index import ALL_PRODUCTS, COMBINED_INDEX_NAME, USE_COMBINED_INDEX
+from batch import BATCH_MAX_QUESTIONS, BATCH_SYNTHESIS_CONCURRENCY, answer_batch, throughput
+from tracing import (
+    TRACE_HISTOGRAMS,
+    Trace,
+    current_trace,
+    in_context,
+    queued_file_handler,
+    span,
+    stage_histograms,
+    write_trace,
+)
+
+from fastapi import FastAPI, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+import asyncio
 import json
+import time
+from dataclasses import asdict
+from typing import AsyncIterator
 
 from utils import documents_to_index
 
@@ -12,10 +31,17 @@ import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-fh = logging.FileHandler("query.log", mode="a")
-fh.setLevel(logging.INFO)
+fh = queued_file_handler("query.log", logging.INFO)
 logger.addHandler(fh)
 
+# llm requests (classification fallback and synthesis) in flight per worker
+MAX_CONCURRENT_LLM_REQUESTS: int = 16
+
+llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_REQUESTS)
+
+# clients that send no X-Session-Id header share one conversation
+DEFAULT_SESSION_ID = "default"
+
 ###### Pydantic base classes for FastAPI ######
 
 
@@ -29,63 +55,158 @@ class Response(BaseModel):
     sources: str | None
 
 
+class BatchQuestion(BaseModel):
+    content: str
+    # skips classification when the product is already known, eg. from the ticket
+    product: str | None = None
+
+
+class BatchRequest(BaseModel):
+    questions: list[BatchQuestion] = Field(..., min_items=1, max_items=BATCH_MAX_QUESTIONS)
+    concurrency: int = Field(BATCH_SYNTHESIS_CONCURRENCY, ge=1, le=64)
+
+
+class Memory(BaseModel):
+    content: str
+    # classification made in the first turn, reused once the user confirms,
+    # ALL_PRODUCTS when the combined index searches every manual
+    product: str | None = None
+
+
 ####################################################
 
 
 app = FastAPI()
 
 
+@app.middleware("http")
+async def log_latency(request, call_next):
+    start = time.perf_counter()
+    # spans recorded while handling the request are collected into this trace
+    request_trace = Trace(request.url.path, {"method": request.method})
+    token = current_trace.set(request_trace)
+    try:
+        response = await call_next(request)
+    except Exception:
+        write_trace(request_trace)
+        raise
+    finally:
+        current_trace.reset(token)
+    request_trace.attributes["status"] = response.status_code
+    logger.info(f"{request.url.path} latency: {time.perf_counter() - start:.3f}s")
+
+    # call_next returns once the headers are sent, a streamed body still records spans,
+    # eg. synthesis on /converse/stream/, so the trace is written after its last chunk
+    body_iterator = response.body_iterator
+
+    async def traced_body() -> AsyncIterator[bytes]:
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            write_trace(request_trace)
+
+    response.body_iterator = traced_body()
+    return response
+
+
+@app.on_event("startup")
+def warm_index_registry():
+    # load every persisted product index once, before the first request
+    start = time.perf_counter()
+    if USE_COMBINED_INDEX:
+        index_registry.warm([(COMBINED_INDEX_NAME, 0, 0)])
+    else:
+        index_registry.warm(documents_to_index)
+    product_router.warm()
+    logger.info(f"startup: indexes and router warmed in {time.perf_counter() - start:.3f}s")
+
+
+@app.get("/indexes/")
+def get_index_stats() -> dict:
+    "load time and resident size of every loaded product index"
+    return index_registry.stats()
+
+
+@app.get("/timings/")
+def get_stage_timings() -> dict:
+    "p50/p95/p99 per pipeline stage over the recent requests"
+    if not TRACE_HISTOGRAMS:
+        return {}
+    return stage_histograms.percentiles()
+
+
+@app.get("/embedding-cache/")
+def get_embedding_cache_stats() -> dict:
+    "hit/miss counters of the embedding cache"
+    return embedding_cache.stats()
+
+
 # query = "What are the most important maintenance steps I need to do within one year?"
 # query = "Something is wrong with the scanner. What should I do?"
 
 
-def memory_refresher():
-    f = open("memory.txt", "w")
-    f.close()
+def memory_refresher(session_id: str):
+    conversation_store.delete(session_id)
 
 
-def memory_getter() -> Message | None:
-    f = open("memory.txt", "r")
-    memory = f.read()
-    f.close()
-    if memory == "":
+def memory_getter(session_id: str) -> Memory | None:
+    memory = conversation_store.get(session_id)
+    if memory is None:
         # return means this is a new request
         return None
     else:
-        memory = json.loads(memory)
-        return Message(**memory)
+        return Memory(**memory)
 
 
-def memory_writer(memory: Message):
-    with open("memory.txt", "w") as f:
-        f.write(json.dumps(memory.dict()))
+def memory_writer(session_id: str, memory: Memory):
+    conversation_store.set(session_id, memory.dict())
 
 
-def get_classification(message: Message) -> Response:
-    product_that_query_is_about = classification_agent(message.content)
-    product_that_query_is_about = product_that_query_is_about.strip()
+async def get_classification(message: Message) -> Response:
+    with span("classification") as classification:
+        route = await product_router.aroute(message.content, llm_semaphore)
+        classification.attributes.update(product=route.product, routed_by=route.routed_by)
+    product_that_query_is_about = route.product
 
-    logger.debug(f"product_that_query_is_about: {product_that_query_is_about}")
+    logger.debug(
+        f"product_that_query_is_about: {product_that_query_is_about}, "
+        f"confidence: {route.confidence:.3f}, routed by: {route.routed_by}"
+    )
     # appropriate rag index
     try:
         index_id = index_to_product_mapping[product_that_query_is_about]
         msg1 = f"You seem to be asking about {product_that_query_is_about}. Press enter if I got it right. \n\nIf not type `no`, and I will try asking the question again.\n\nI am fairly capable, so help me with a few contextual clues and I'll figure it out."
         return Response(content=msg1, product=product_that_query_is_about, sources=None)
     except KeyError:
+        if USE_COMBINED_INDEX:
+            # the combined index can still search every manual at once
+            msg1 = f"I could not tell which product you are asking about. Press enter and I will look through all the manuals.\n\nIf not type `no` and ask again with a few identifying details about the product."
+            return Response(content=msg1, product=None, sources=None)
         msg1 = f"Sorry, I cannot seem to find the product you are asking about in my database.\n\n"
         msg2 = f"As reference, I only have the following products in my database:\n{list(index_to_product_mapping.keys())}"
         msg3 = f"\n\nPlease try again. It may help to give any identifying information about the product for my benefit."
         return Response(content=f"{msg1}{msg2}{msg3}", product=None, sources=None)
 
 
-def perform_rag_call(message: Message) -> Response:
+async def perform_rag_call(message: Memory) -> Response:
     # response query initialize
     response_query = []
-    # find the appropriate index for the product
-    product_that_query_is_about = classification_agent(message.content)
-    product_that_query_is_about = product_that_query_is_about.strip()
+    # reuse the product confirmed by the user, classify only if there is none
+    product_that_query_is_about = message.product
+    if product_that_query_is_about is None:
+        with span("classification") as classification:
+            route = await product_router.aroute(message.content, llm_semaphore)
+            classification.attributes.update(
+                product=route.product, routed_by=route.routed_by
+            )
+        product_that_query_is_about = route.product
 
-    print(f"product_that_query_is_about: {product_that_query_is_about}")
+    logger.debug(f"product_that_query_is_about: {product_that_query_is_about}")
+    if USE_COMBINED_INDEX:
+        if product_that_query_is_about == ALL_PRODUCTS:
+            product_that_query_is_about = None
+        return await perform_combined_rag_call(message, product_that_query_is_about)
     # appropriate rag index
     try:
         index_id = index_to_product_mapping[product_that_query_is_about]
@@ -104,29 +225,55 @@ def perform_rag_call(message: Message) -> Response:
         logger.info(f"\n {'-'*30}\n")
         return Response(**response_obj)
 
-    b = BuildRagIndex(index_id)
-    response_text, page_numbers = b.query(message.content)
-    # sort page numbers for presentation
-    page_numbers = sorted(page_numbers)
-    response_query.append(msg1)
-    response_query.append(response_text)
-    response_obj = {
-        "content": "\n\n".join(response_query),
-        "product": product_that_query_is_about,
-        "sources": ", ".join([str(page_num) for page_num in page_numbers]),
-    }
+    # a cold registry load reads from disk, keep it off the event loop
+    with span("index_lookup", index=index_id):
+        b = await asyncio.get_running_loop().run_in_executor(
+            retrieval_executor, in_context(index_registry.get, index_id)
+        )
+    response_text, page_numbers = await b.aquery(message.content, llm_semaphore)
+    with span("response_formatting"):
+        # sort page numbers for presentation
+        page_numbers = sorted(page_numbers)
+        response_query.append(msg1)
+        response_query.append(response_text)
+        response_obj = {
+            "content": "\n\n".join(response_query),
+            "product": product_that_query_is_about,
+            "sources": ", ".join([str(page_num) for page_num in page_numbers]),
+        }
+    logger.info(response_obj)
+    logger.info(f"\n {'-'*30}\n")
+    return Response(**response_obj)
+
+
+async def perform_combined_rag_call(message: Memory, product: str | None) -> Response:
+    "search the combined index, restricted to product when it is known, else all manuals"
+    with span("index_lookup", index=COMBINED_INDEX_NAME):
+        b = await asyncio.get_running_loop().run_in_executor(
+            retrieval_executor, in_context(index_registry.get, COMBINED_INDEX_NAME)
+        )
+    response_text, sources = await b.aquery(message.content, llm_semaphore, product)
+    with span("response_formatting"):
+        answered_product, formatted_sources = b.format_sources(sources, product)
+        response_obj = {
+            "content": "\n\n".join([f"Product: {answered_product}.\n\n", response_text]),
+            "product": answered_product,
+            "sources": formatted_sources,
+        }
     logger.info(response_obj)
     logger.info(f"\n {'-'*30}\n")
     return Response(**response_obj)
 
 
 @app.post("/converse/")
-def get_response(
+async def get_response(
     message: Message,
+    x_session_id: str = Header(default=DEFAULT_SESSION_ID),
 ) -> Response | dict:
     logger.info(message.content)
+    session_id = x_session_id
 
-    memory = memory_getter()
+    memory = memory_getter(session_id)
 
     # one more check for if memory is a prev memory
     # this can be done by checking if memory has the message content in its string.
@@ -134,17 +281,21 @@ def get_response(
     #
 
     if memory is None:
-        print("memory is None, hence doing classification")
+        logger.debug("memory is None, hence doing classification")
         # means this is a fresh request
         # send a classification response
-        memory_writer(message)
-        response_msg = get_classification(message)
+        response_msg = await get_classification(message)
+        product = response_msg.product
+        if product is None and USE_COMBINED_INDEX:
+            # the confirm turn searches all manuals, it must not classify again
+            product = ALL_PRODUCTS
+        memory_writer(session_id, Memory(content=message.content, product=product))
         if "sorry" in response_msg.content.lower():
-            memory_refresher()
+            memory_refresher(session_id)
             return response_msg
         return response_msg
     elif message.content.strip().lower() in ["n", "no"]:
-        memory_refresher()
+        memory_refresher(session_id)
         return Response(
             content="Sorry for getting it wrong, request you to try asking your question again.\nYou can ask the same question again with a few more contextual clues.\n",
             product=None,
@@ -152,11 +303,11 @@ def get_response(
         )
     elif message.content.strip().lower() in ["", "y", "yes"]:
         # switch the message so as to reset the memory for the next call
-        memory_refresher()
+        memory_refresher(session_id)
         # perform the rag call
-        return perform_rag_call(memory)
+        return await perform_rag_call(memory)
     else:
-        memory_refresher()
+        memory_refresher(session_id)
         return Response(
             content="Apologoes for the hiccup. Needed to reset my memory there. Now, I am ready. Please ask me again.",
             product=None,
@@ -164,6 +315,105 @@ def get_response(
         )
 
 
+@app.post("/converse/batch/")
+async def batch_response(request: BatchRequest) -> StreamingResponse:
+    """
+    answer many independent questions, no conversation state is used
+    - streamed as json lines in the order of the questions, each with its Response fields
+    - the last line is a summary with the throughput in questions per second
+    """
+    start = time.perf_counter()
+
+    async def lines() -> AsyncIterator[str]:
+        async for answer in answer_batch(
+            [question.content for question in request.questions],
+            [question.product for question in request.questions],
+            request.concurrency,
+            llm_semaphore,
+        ):
+            yield json.dumps(asdict(answer)) + "\n"
+        summary = throughput(len(request.questions), time.perf_counter() - start)
+        logger.info(f"batch: {summary}")
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def single_event(response: Response) -> AsyncIterator[str]:
+    yield sse_event("done", response.dict())
+
+
+@app.post("/converse/stream/")
+async def stream_response(
+    message: Message,
+    x_session_id: str = Header(default=DEFAULT_SESSION_ID),
+) -> StreamingResponse:
+    """
+    same conversation flow as /converse/, with the answer streamed as server-sent events
+    - `token` events carry pieces of the answer as soon as synthesis starts
+    - the final `done` event carries the whole Response: content, product and sources
+    """
+    request_start = time.perf_counter()
+    session_id = x_session_id
+    memory = memory_getter(session_id)
+    is_rag_turn = memory is not None and message.content.strip().lower() in ["", "y", "yes"]
+
+    if not is_rag_turn:
+        # classification, deny and reset turns are short, send them as one event
+        response = await get_response(message, session_id)
+        return StreamingResponse(single_event(response), media_type="text/event-stream")
+
+    memory_refresher(session_id)
+    product_that_query_is_about = memory.product
+    if USE_COMBINED_INDEX or product_that_query_is_about not in index_to_product_mapping:
+        response = await perform_rag_call(memory)
+        return StreamingResponse(single_event(response), media_type="text/event-stream")
+
+    loop = asyncio.get_running_loop()
+    index_id = index_to_product_mapping[product_that_query_is_about]
+    with span("index_lookup", index=index_id):
+        b = await loop.run_in_executor(
+            retrieval_executor, in_context(index_registry.get, index_id)
+        )
+
+    async def events() -> AsyncIterator[str]:
+        first_token_seconds = None
+        # embedding and retrieval, the llm is only called once tokens is read
+        tokens, page_numbers = await b.astream_query(memory.content)
+        msg1 = f"Product: {product_that_query_is_about}.\n\n"
+        content = [msg1, "\n\n"]
+        yield sse_event("token", {"token": "".join(content)})
+        async with llm_semaphore:
+            while True:
+                # the llm stream blocks on network reads, pull it off the event loop
+                token = await loop.run_in_executor(None, in_context(next, tokens, None))
+                if token is None:
+                    break
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - request_start
+                content.append(token)
+                yield sse_event("token", {"token": token})
+
+        response_obj = {
+            "content": "".join(content),
+            "product": product_that_query_is_about,
+            "sources": ", ".join([str(page_num) for page_num in sorted(page_numbers)]),
+        }
+        logger.info(response_obj)
+        logger.info(
+            f"time to first token: {first_token_seconds or 0.0:.3f}s, "
+            f"total latency: {time.perf_counter() - request_start:.3f}s"
+        )
+        logger.info(f"\n {'-'*30}\n")
+        yield sse_event("done", response_obj)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 class ConversationHandler:
     def __init__(self, message: Message):
         self.memory: Message | None = None
@@ -180,4 +430,4 @@ if __name__ == "__main__":
     while True:
         query = input("Enter query: ")
         message = Message(content=query)
-        print(get_response(message))
+        print(asyncio.run(get_response(message, DEFAULT_SESSION_ID)))
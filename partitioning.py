@@ -0,0 +1,174 @@
+"""
+Streaming, page range at a time partitioning of a pdf.
+
+- the pdf is cut into ranges of PARTITION_PAGES_PER_RANGE pages, partitioned in parallel processes
+- elements come back as plain (page, category, text) tuples, grouped and yielded page by page
+- the category is kept through filtering, chunking starts a section at every title
+- the frequency filter is two pass: the first pass keeps only text hashes and counts,
+  the second pass reads the pages back, from the extraction cache or a temporary spill file, and filters
+- peak memory is a few page ranges plus one 8 byte hash per distinct text
+"""
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from typing import Callable, Iterator
+import hashlib
+import json
+import os
+import tempfile
+import logging
+
+from pypdf import PdfReader, PdfWriter
+
+import extraction_cache
+
+# pages partitioned together by one worker
+PARTITION_PAGES_PER_RANGE: int = 8
+# worker processes partitioning page ranges of one pdf
+PARTITION_WORKERS: int = min(4, os.cpu_count() or 1)
+
+logger = logging.getLogger("indexer.partitioning")
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+
+def page_count(document_location: str) -> int:
+    return len(PdfReader(document_location).pages)
+
+
+def partition_page_range(
+    document_location: str, first_page: int, last_page: int
+) -> list[tuple[int | None, str, str]]:
+    """
+    runs in a worker process
+    (page_number, category, text) of every element on pages first_page..last_page, 1 based inclusive
+    """
+    from unstructured.partition.auto import partition
+
+    reader = PdfReader(document_location)
+    writer = PdfWriter()
+    for page_index in range(first_page - 1, last_page):
+        writer.add_page(reader.pages[page_index])
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as page_range_pdf:
+        writer.write(page_range_pdf)
+        page_range_pdf.flush()
+        elements = partition(filename=page_range_pdf.name)
+    return [
+        (
+            el.metadata.page_number + first_page - 1
+            if el.metadata.page_number is not None
+            else None,
+            el.category,
+            el.text,
+        )
+        for el in elements
+    ]
+
+
+def group_by_page(
+    elements: list[tuple[int | None, str, str]]
+) -> Iterator[tuple[int | None, list[tuple[str, str]]]]:
+    for page_number, page_elements in groupby(elements, key=lambda element: element[0]):
+        yield page_number, [(category, text) for _page, category, text in page_elements]
+
+
+def iter_page_elements(
+    document_location: str,
+    pages_per_range: int | None = None,
+    max_workers: int | None = None,
+) -> Iterator[tuple[int | None, list[tuple[str, str]]]]:
+    """
+    (page_number, [(category, text), ...]) for every page, in page order
+    at most 2 * max_workers page ranges are partitioned or waiting at any time
+    """
+    # read at call time, eg. ingest sets PARTITION_WORKERS in its worker processes
+    pages_per_range = pages_per_range or PARTITION_PAGES_PER_RANGE
+    max_workers = max_workers or PARTITION_WORKERS
+    num_pages = page_count(document_location)
+    ranges = [
+        (first_page, min(first_page + pages_per_range - 1, num_pages))
+        for first_page in range(1, num_pages + 1, pages_per_range)
+    ]
+    if max_workers <= 1:
+        # eg. inside an ingestion worker process, no nested pool
+        for first_page, last_page in ranges:
+            yield from group_by_page(
+                partition_page_range(document_location, first_page, last_page)
+            )
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for first_page, last_page in ranges:
+            pending.append(
+                pool.submit(partition_page_range, document_location, first_page, last_page)
+            )
+            if len(pending) >= 2 * max_workers:
+                yield from group_by_page(pending.popleft().result())
+        while pending:
+            yield from group_by_page(pending.popleft().result())
+
+
+def frequency_filter(
+    read_pages: Callable[[], Iterator[tuple[int | None, list[tuple[str, str]]]]],
+    threshold_information_value: int,
+) -> tuple[dict[int | None, list[tuple[str, str]]], int]:
+    """
+    two passes over read_pages(): count text hashes, then keep the (category, text) elements
+    whose text is repeated less than threshold_information_value times
+    """
+    textrank = Counter()
+    num_elements = 0
+    for _page_number, page_elements in read_pages():
+        textrank.update(text_hash(text) for _category, text in page_elements)
+        num_elements += len(page_elements)
+
+    paged_text_list = {}
+    for page_number, page_elements in read_pages():
+        for category, text in page_elements:
+            frequency_of_text = textrank[text_hash(text)]
+            if frequency_of_text < threshold_information_value:
+                paged_text_list.setdefault(page_number, []).append((category, text))
+            else:
+                logger.debug(f"frequency: {frequency_of_text} skipped text: {text}")
+    return paged_text_list, num_elements
+
+
+def partition_with_frequency_filter(
+    document_location: str,
+    threshold_information_value: int,
+    pages_per_range: int | None = None,
+    max_workers: int | None = None,
+) -> tuple[dict[int | None, list[tuple[str, str]]], int]:
+    """
+    page elements without the ones whose text is repeated threshold_information_value times or more,
+    eg. headers and footers, and the number of elements before filtering
+    - the partitioned pages are read from, or written to, the extraction cache
+    - without the cache they are spilled to a temporary file between the two passes
+    """
+    def pages():
+        return iter_page_elements(document_location, pages_per_range, max_workers)
+
+    if extraction_cache.USE_EXTRACTION_CACHE:
+        path = extraction_cache.elements_path(document_location)
+        if extraction_cache.is_cached(path):
+            logger.debug(f"extraction cache hit for {document_location}: {path}")
+        else:
+            logger.debug(f"extraction cache miss for {document_location}, partitioning")
+            extraction_cache.write_page_elements(path, pages())
+        return frequency_filter(
+            lambda: extraction_cache.read_page_elements(path), threshold_information_value
+        )
+
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as spill:
+        for page_number, page_elements in pages():
+            spill.write(json.dumps([page_number, page_elements]) + "\n")
+
+        def read_spill():
+            spill.seek(0)
+            for line in spill:
+                yield tuple(json.loads(line))
+
+        return frequency_filter(read_spill, threshold_information_value)
@@ -1,4 +1,5 @@
 from langchain.prompts import PromptTemplate
+from llama_index.prompts import LangchainPromptTemplate
 
 text_qa_template_str = (
     """
@@ -14,3 +15,6 @@ You use the context below.
 )
 
 text_qa_template = PromptTemplate.from_template(text_qa_template_str)
+
+# llama_index wrapper, used by the response synthesizer
+text_qa_prompt = LangchainPromptTemplate(template=text_qa_template)
@@ -0,0 +1,229 @@
+"""
+Quantized copies of the binary embedding store for a cheap first pass scan.
+
+python quantization.py [--shortlist 20 50 100]
+    writes the quantized files for the existing indexes and reports their recall and size
+
+- int8: every row scaled by its largest absolute value into [-127, 127], 4x smaller than float32
+- binary: one sign bit per dimension, 32x smaller, scanned by hamming distance
+- the scan keeps a shortlist of QUANTIZED_SHORTLIST rows per query, only those are re-scored
+  with the full precision rows of the memory mapped store, so scores stay exact cosine similarities
+- files live next to embeddings.bin and are opened with mmap like it; a quantized scan is
+  only used over that store, over the json vector store every float is resident anyway,
+  so the command above first converts indexes that have only vector_store.json
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from ann import node_ids_fingerprint, top_k_of
+
+QUANTIZED_HEADER_FNAME = "embeddings_quantized.json"
+INT8_FNAME = "embeddings_int8.npy"
+INT8_SCALES_FNAME = "embeddings_int8_scales.npy"
+SIGN_FNAME = "embeddings_sign.npy"
+# first pass scan of every query: "float" (exact, no quantized copy), "int8" or "binary"
+EMBEDDING_SCAN: str = "float"
+SCAN_KINDS = ("float", "int8", "binary")
+# rows kept by the quantized scan and re-scored with full precision
+QUANTIZED_SHORTLIST: int = 100
+# rows decoded at a time, bounds the temporary float32 copy of the scan
+SCAN_CHUNK: int = 16_384
+
+# set bits of every byte value
+POPCOUNT = np.asarray([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def write_quantized(persist_dir: str, matrix: np.ndarray, node_ids: list[str]) -> None:
+    "int8 and sign bit copies of the normalised store matrix"
+    num_rows, dim = matrix.shape
+    codes = np.empty((num_rows, dim), dtype=np.int8)
+    scales = np.empty(num_rows, dtype=np.float32)
+    signs = np.empty((num_rows, (dim + 7) // 8), dtype=np.uint8)
+    for start in range(0, num_rows, SCAN_CHUNK):
+        chunk = np.asarray(matrix[start : start + SCAN_CHUNK], dtype=np.float32)
+        peak = np.abs(chunk).max(axis=1)
+        peak[peak == 0] = 1.0
+        codes[start : start + SCAN_CHUNK] = np.round(chunk / peak[:, None] * 127)
+        scales[start : start + SCAN_CHUNK] = peak / 127
+        signs[start : start + SCAN_CHUNK] = np.packbits(chunk > 0, axis=1)
+
+    for fname, array in [(INT8_FNAME, codes), (INT8_SCALES_FNAME, scales), (SIGN_FNAME, signs)]:
+        path = os.path.join(persist_dir, fname)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.replace(path + ".tmp", path)
+    # written last, a store without a matching header is not used
+    header_path = os.path.join(persist_dir, QUANTIZED_HEADER_FNAME)
+    with open(header_path + ".tmp", "w") as f:
+        json.dump(
+            {"dim": dim, "count": num_rows, "fingerprint": node_ids_fingerprint(node_ids)}, f
+        )
+    os.replace(header_path + ".tmp", header_path)
+
+
+class QuantizedScan:
+    """First pass over int8 or sign bit rows.
+    only the quantized array of `kind` is opened, memory mapped
+    """
+
+    def __init__(self, persist_dir: str, kind: str) -> None:
+        with open(os.path.join(persist_dir, QUANTIZED_HEADER_FNAME)) as f:
+            header = json.load(f)
+        self.kind = kind
+        self.fingerprint: str = header["fingerprint"]
+        self.dim: int = header["dim"]
+        if kind == "int8":
+            self.codes = np.load(os.path.join(persist_dir, INT8_FNAME), mmap_mode="r")
+            self.scales = np.load(os.path.join(persist_dir, INT8_SCALES_FNAME))
+        else:
+            self.signs = np.load(os.path.join(persist_dir, SIGN_FNAME), mmap_mode="r")
+
+    @classmethod
+    def load(cls, persist_dir: str, kind: str | None = None) -> "QuantizedScan | None":
+        "None for exact scans, or when no quantized copy was written"
+        kind = kind or EMBEDDING_SCAN
+        if kind not in SCAN_KINDS:
+            raise ValueError(f"scan must be one of {SCAN_KINDS}, got {kind}")
+        if kind == "float" or not os.path.exists(
+            os.path.join(persist_dir, QUANTIZED_HEADER_FNAME)
+        ):
+            return None
+        return cls(persist_dir, kind)
+
+    def __len__(self) -> int:
+        return len(self.scales) if self.kind == "int8" else len(self.signs)
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        "approximate score of every row, higher is closer"
+        scores = np.empty(len(self), dtype=np.float32)
+        if self.kind == "int8":
+            for start in range(0, len(self), SCAN_CHUNK):
+                chunk = np.asarray(self.codes[start : start + SCAN_CHUNK], dtype=np.float32)
+                scores[start : start + SCAN_CHUNK] = chunk @ query
+            return scores * self.scales
+        query_signs = np.packbits(query > 0)
+        for start in range(0, len(self), SCAN_CHUNK):
+            differing = np.bitwise_xor(self.signs[start : start + SCAN_CHUNK], query_signs)
+            # negative hamming distance
+            scores[start : start + SCAN_CHUNK] = -POPCOUNT[differing].sum(
+                axis=1, dtype=np.int32
+            )
+        return scores
+
+    def search(
+        self, query: np.ndarray, matrix: np.ndarray, top_k: int, shortlist: int | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        "(rows, exact scores) of one normalised query, sorted by descending score"
+        shortlist = max(top_k, shortlist or QUANTIZED_SHORTLIST)
+        rows = top_k_of(self.scores(query), shortlist)
+        # ascending rows read the memory mapped store front to back
+        rows = np.sort(rows)
+        scores = np.asarray(matrix[rows] @ query, dtype=np.float32)
+        best = top_k_of(scores, top_k)
+        return rows[best], scores[best]
+
+
+def json_resident_bytes(vector_store_path: str) -> int:
+    "memory held by vector_store.json once parsed, measured with tracemalloc"
+    tracemalloc.start()
+    try:
+        with open(vector_store_path) as f:
+            parsed = json.load(f)
+        resident, _peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del parsed
+    return resident
+
+
+def index_sizes(persist_dir: str) -> dict[str, float]:
+    "MiB per representation: files as written, the json store as resident once parsed"
+    from embedding_store import EMBEDDINGS_FNAME, VECTOR_STORE_FNAME
+
+    mib = 2**20
+    sizes = {}
+    vector_store_path = os.path.join(persist_dir, VECTOR_STORE_FNAME)
+    if os.path.exists(vector_store_path):
+        sizes["json, parsed"] = json_resident_bytes(vector_store_path) / mib
+    sizes["embeddings.bin"] = os.path.getsize(os.path.join(persist_dir, EMBEDDINGS_FNAME)) / mib
+    sizes["int8"] = (
+        sum(
+            os.path.getsize(os.path.join(persist_dir, fname))
+            for fname in (INT8_FNAME, INT8_SCALES_FNAME)
+        )
+        / mib
+    )
+    sizes["binary"] = os.path.getsize(os.path.join(persist_dir, SIGN_FNAME)) / mib
+    return sizes
+
+
+def recall_report(
+    persist_dir: str, matrix: np.ndarray, queries: np.ndarray, top_k: int, shortlists: list[int]
+) -> list[dict]:
+    "recall@top_k and latency of both quantized scans against the exact scan"
+    exact = [top_k_of(matrix @ query, top_k) for query in queries]
+    results = []
+    for kind in ("int8", "binary"):
+        scan = QuantizedScan(persist_dir, kind)
+        for shortlist in shortlists:
+            recalls = []
+            start = time.perf_counter()
+            for query, expected in zip(queries, exact):
+                rows, _scores = scan.search(query, matrix, top_k, shortlist)
+                recalls.append(len(np.intersect1d(rows, expected)) / len(expected))
+            results.append(
+                {
+                    "scan": kind,
+                    "shortlist": shortlist,
+                    "recall": round(float(np.mean(recalls)), 4),
+                    "ms_per_query": round((time.perf_counter() - start) / len(queries) * 1000, 4),
+                }
+            )
+    return results
+
+
+if __name__ == "__main__":
+    from embedding_store import (
+        MmapEmbeddingStore,
+        convert_index_dir,
+        mmap_store_exists,
+        normalise_rows,
+    )
+    from indexer import PATH_RAG_INDEX
+    from utils import documents_to_index
+
+    parser = argparse.ArgumentParser(description="quantized scans against exact search")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--shortlist", type=int, nargs="+", default=[20, 50, QUANTIZED_SHORTLIST])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for doc_filename, _start_skip, _end_skip in documents_to_index:
+        persist_dir = os.path.join(os.getcwd(), PATH_RAG_INDEX, doc_filename)
+        # the quantized scans only serve from the binary store, produce it when missing
+        if not mmap_store_exists(persist_dir) and not convert_index_dir(persist_dir):
+            print(f"skipping {persist_dir}: no embeddings")
+            continue
+        store = MmapEmbeddingStore(persist_dir)
+        matrix = np.asarray(store.matrix, dtype=np.float32)
+        write_quantized(persist_dir, matrix, store.node_ids)
+
+        # queries: perturbed rows, the persisted embeddings are the only real vectors at hand
+        picked = matrix[rng.integers(0, len(matrix), size=args.queries)]
+        queries = normalise_rows(
+            picked + rng.normal(scale=0.03, size=picked.shape).astype(np.float32)
+        )
+        sizes = index_sizes(persist_dir)
+        print(f"{doc_filename}: {matrix.shape[0]} rows x {matrix.shape[1]} dims")
+        print("  " + ", ".join(f"{name} {size:.2f} MiB" for name, size in sizes.items()))
+        for result in recall_report(persist_dir, matrix, queries, args.top_k, args.shortlist):
+            print(
+                f"  {result['scan']:<6} shortlist {result['shortlist']:<4} "
+                f"recall@{args.top_k} {result['recall']:.3f}  {result['ms_per_query']:.3f}ms"
+            )
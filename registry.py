@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+import logging
+
+import psutil
+
+from indexer import BuildRagIndex, PATH_RAG_INDEX
+from combined_index import COMBINED_INDEX_NAME, CombinedRagIndex
+from answer_cache import answer_cache
+from utils import documents_to_index
+
+# how often (seconds) a cached index checks its persisted files for changes
+RELOAD_CHECK_INTERVAL: float = 5.0
+
+# child of the indexer logger, so registry events land in indexer.log
+logger = logging.getLogger("indexer.registry")
+
+
+def index_dir_for(doc_filename: str) -> str:
+    return os.path.join(os.getcwd(), PATH_RAG_INDEX, doc_filename)
+
+
+def index_fingerprint(doc_filename: str) -> tuple:
+    "(name, mtime, size) of every persisted file, changes whenever the index is rewritten"
+    index_dir = index_dir_for(doc_filename)
+    if not os.path.isdir(index_dir):
+        return ()
+    fingerprint = []
+    for entry in sorted(os.scandir(index_dir), key=lambda e: e.name):
+        if entry.is_file():
+            stat = entry.stat()
+            fingerprint.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+@dataclass
+class RegistryEntry:
+    index: BuildRagIndex
+    fingerprint: tuple
+    load_seconds: float
+    resident_bytes: int
+    on_disk_bytes: int
+    loaded_at: float = field(default_factory=time.time)
+    last_checked: float = field(default_factory=time.monotonic)
+
+    def stats(self) -> dict:
+        return {
+            "load_seconds": round(self.load_seconds, 4),
+            "resident_bytes": self.resident_bytes,
+            "on_disk_bytes": self.on_disk_bytes,
+            "loaded_at": self.loaded_at,
+        }
+
+
+class IndexRegistry:
+    """Process wide cache of loaded product indexes.
+    - every request for the same doc_filename gets the same in-memory BuildRagIndex
+    - an index is loaded at most once at a time, concurrent callers wait on it
+    - an index is reloaded when its persisted files change on disk
+    """
+
+    def __init__(self, reload_check_interval: float = RELOAD_CHECK_INTERVAL) -> None:
+        self.reload_check_interval = reload_check_interval
+        self._entries: dict[str, RegistryEntry] = {}
+        self._lock = threading.Lock()
+        self._load_locks: dict[str, threading.Lock] = {}
+
+    def get(self, doc_filename: str) -> BuildRagIndex:
+        "return the loaded index for a document, loading or reloading it if needed"
+        entry = self._entries.get(doc_filename)
+        if entry is not None and not self._is_stale(entry, doc_filename):
+            return entry.index
+
+        with self._load_lock_for(doc_filename):
+            # another thread may have finished the load while we waited
+            entry = self._entries.get(doc_filename)
+            if entry is not None and not self._is_stale(entry, doc_filename):
+                return entry.index
+            return self._load(doc_filename).index
+
+    def warm(self, documents: list[tuple[str, int, int]] = documents_to_index) -> None:
+        "load every already persisted index up front, eg. at server startup, never raises"
+        for doc_filename, _start_skip, _end_skip in documents:
+            if not os.path.exists(index_dir_for(doc_filename)):
+                logger.debug(f"registry: no persisted index for {doc_filename}, skipped")
+                continue
+            try:
+                self.get(doc_filename)
+            except Exception:
+                # eg. an incomplete index directory, only requests for this index fail
+                logger.exception(f"registry: could not load {doc_filename}, skipped")
+
+    def invalidate(self, doc_filename: str) -> None:
+        with self._lock:
+            self._entries.pop(doc_filename, None)
+
+    def stats(self) -> dict[str, dict]:
+        "per index load time and resident size"
+        return {
+            doc_filename: entry.stats() for doc_filename, entry in self._entries.items()
+        }
+
+    def _load_lock_for(self, doc_filename: str) -> threading.Lock:
+        with self._lock:
+            return self._load_locks.setdefault(doc_filename, threading.Lock())
+
+    def _is_stale(self, entry: RegistryEntry, doc_filename: str) -> bool:
+        now = time.monotonic()
+        if now - entry.last_checked < self.reload_check_interval:
+            return False
+        entry.last_checked = now
+        stale = index_fingerprint(doc_filename) != entry.fingerprint
+        if stale:
+            logger.debug(f"registry: persisted index changed for {doc_filename}")
+            answer_cache.invalidate(doc_filename)
+        return stale
+
+    def _load(self, doc_filename: str) -> RegistryEntry:
+        process = psutil.Process()
+        rss_before = process.memory_info().rss
+        start = time.perf_counter()
+
+        if doc_filename == COMBINED_INDEX_NAME:
+            index = CombinedRagIndex()
+        else:
+            index = BuildRagIndex(doc_filename)
+
+        load_seconds = time.perf_counter() - start
+        # rss delta is approximate when other loads run concurrently
+        resident_bytes = max(process.memory_info().rss - rss_before, 0)
+        fingerprint = index_fingerprint(doc_filename)
+        entry = RegistryEntry(
+            index=index,
+            fingerprint=fingerprint,
+            load_seconds=load_seconds,
+            resident_bytes=resident_bytes,
+            on_disk_bytes=sum(size for _name, _mtime, size in fingerprint),
+        )
+        with self._lock:
+            self._entries[doc_filename] = entry
+
+        logger.debug(
+            f"registry: loaded {doc_filename} in {load_seconds:.3f}s, "
+            f"resident: {resident_bytes / 2**20:.1f} MiB, "
+            f"on disk: {entry.on_disk_bytes / 2**20:.1f} MiB"
+        )
+        return entry
+
+
+index_registry = IndexRegistry()
@@ -0,0 +1,197 @@
+import numpy as np
+
+from llama_index import VectorStoreIndex
+from llama_index.schema import NodeWithScore
+
+from ann import IVFPQIndex, node_ids_fingerprint
+from embedding_store import MmapEmbeddingDict, normalise_rows
+from quantization import QuantizedScan
+from lexical import LexicalIndex, reciprocal_rank_fusion
+
+
+class MatrixRetriever:
+    """Vectorized top-k retrieval over one product index.
+    - embeddings are held as a single pre-normalised (num_nodes, dim) matrix
+    - scoring is one matrix product for any number of queries
+    - node objects are only fetched from the docstore for the rows that survive the cuts
+    - an optional bm25 index gives lexical candidates over the same rows
+    - an optional ivf-pq index replaces the full matrix product for large indexes
+    - or an optional int8/binary scan shortlists rows that are then re-scored exactly
+    """
+
+    def __init__(
+        self,
+        node_ids: list[str],
+        ref_doc_ids: list[str],
+        matrix: np.ndarray,
+        docstore,
+        normalised: bool = False,
+    ) -> None:
+        self.node_ids = node_ids
+        self.ref_doc_ids = ref_doc_ids
+        self.matrix = matrix if normalised else normalise_rows(matrix)
+        self.docstore = docstore
+        self.lexical_index: LexicalIndex | None = None
+        self.lexical_rows: np.ndarray | None = None
+        self.ann_index: IVFPQIndex | None = None
+        self.quantized_scan: QuantizedScan | None = None
+
+    @classmethod
+    def from_index(cls, rag_index: VectorStoreIndex) -> "MatrixRetriever":
+        data = rag_index.storage_context.vector_store._data
+        embedding_dict = data.embedding_dict
+        if isinstance(embedding_dict, MmapEmbeddingDict):
+            # binary store rows are already normalised, keep the mmap as is
+            store = embedding_dict.store
+            return cls(
+                store.node_ids,
+                store.ref_doc_ids,
+                store.matrix,
+                rag_index.docstore,
+                normalised=True,
+            )
+        node_ids = list(embedding_dict.keys())
+        matrix = np.asarray(
+            [embedding_dict[node_id] for node_id in node_ids], dtype=np.float32
+        )
+        ref_doc_ids = [
+            data.text_id_to_ref_doc_id.get(node_id, "None") for node_id in node_ids
+        ]
+        return cls(node_ids, ref_doc_ids, matrix, rag_index.docstore)
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def attach_lexical_index(self, lexical_index: LexicalIndex | None) -> None:
+        "map the lexical index positions onto matrix rows, -1 for nodes without an embedding"
+        self.lexical_index = lexical_index
+        if lexical_index is None:
+            self.lexical_rows = None
+            return
+        row_of = {node_id: row for row, node_id in enumerate(self.node_ids)}
+        self.lexical_rows = np.asarray(
+            [row_of.get(node_id, -1) for node_id in lexical_index.node_ids], dtype=np.int64
+        )
+
+    def attach_ann_index(self, ann_index: IVFPQIndex | None) -> None:
+        "only an ann index built over exactly these rows is used"
+        if ann_index is not None and ann_index.fingerprint != node_ids_fingerprint(
+            self.node_ids
+        ):
+            ann_index = None
+        self.ann_index = ann_index
+
+    def attach_quantized_scan(self, quantized_scan: QuantizedScan | None) -> None:
+        """
+        only a quantized copy of exactly these rows is used, and only over the memory mapped store:
+        over the json vector store every full precision row is resident anyway
+        """
+        if quantized_scan is not None and (
+            not isinstance(self.matrix, np.memmap)
+            or quantized_scan.fingerprint != node_ids_fingerprint(self.node_ids)
+        ):
+            quantized_scan = None
+        self.quantized_scan = quantized_scan
+
+    def lexical_search(
+        self, query_text: str, top_k: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        "(rows, bm25 scores) sorted by descending score"
+        if self.lexical_index is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        positions, scores = self.lexical_index.search(query_text, top_k)
+        rows = self.lexical_rows[positions]
+        keep = rows >= 0
+        return rows[keep], scores[keep]
+
+    def similarities(self, query_embedding, rows: np.ndarray) -> np.ndarray:
+        "cosine similarity of one query to the given rows only"
+        query = normalise_rows(np.asarray(query_embedding, np.float32))
+        return np.asarray(self.matrix[rows] @ query, dtype=np.float32)
+
+    def weighted_mean(self, rows: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        "normalised weighted mean of the given rows, eg. a query vector from bm25 hits"
+        mean = np.asarray(weights, np.float32) @ np.asarray(self.matrix[rows], np.float32)
+        return normalise_rows(mean)
+
+    def fuse(
+        self,
+        query_embedding,
+        vector_rows: np.ndarray,
+        lexical_rows: np.ndarray,
+        top_k: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        reciprocal rank fusion of the vector and lexical candidates
+        returns (rows, cosine scores) in fused order, so the similarity cutoff still applies
+        """
+        rows = np.asarray(
+            reciprocal_rank_fusion(vector_rows.tolist(), lexical_rows.tolist())[:top_k],
+            dtype=np.int64,
+        )
+        return rows, self.similarities(query_embedding, rows)
+
+    def search(
+        self, query_embeddings, top_k: int
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        score one query embedding (dim,) or a batch (num_queries, dim)
+        returns one (rows, scores) pair per query, sorted by descending score
+        """
+        queries = normalise_rows(np.atleast_2d(np.asarray(query_embeddings, np.float32)))
+        if len(self) == 0:
+            empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            return [empty for _ in range(len(queries))]
+
+        if self.ann_index is not None:
+            return [self.ann_index.search(query, self.matrix, top_k) for query in queries]
+        if self.quantized_scan is not None:
+            return [
+                self.quantized_scan.search(query, self.matrix, top_k) for query in queries
+            ]
+
+        # (num_queries, num_nodes)
+        return self.top_k_rows(queries @ self.matrix.T, top_k)
+
+    @staticmethod
+    def top_k_rows(
+        scores: np.ndarray, top_k: int
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        "best top_k columns of every row of a (num_queries, num_nodes) score matrix"
+        k = min(top_k, scores.shape[1])
+        if k < scores.shape[1]:
+            top_rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top_rows = np.broadcast_to(np.arange(k), (scores.shape[0], k))
+        top_scores = np.take_along_axis(scores, top_rows, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_rows = np.take_along_axis(top_rows, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return list(zip(top_rows, top_scores))
+
+    @staticmethod
+    def apply_cutoff(
+        rows: np.ndarray, scores: np.ndarray, similarity_cutoff: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        keep = scores > similarity_cutoff
+        return rows[keep], scores[keep]
+
+    @staticmethod
+    def apply_cap(
+        rows: np.ndarray, scores: np.ndarray, max_nodes: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        return rows[:max_nodes], scores[:max_nodes]
+
+    def pages(self, rows: np.ndarray, scores: np.ndarray) -> list[tuple[str, float]]:
+        "(page, score) pairs for logging, without touching the docstore"
+        return [
+            (self.ref_doc_ids[row], float(score)) for row, score in zip(rows, scores)
+        ]
+
+    def to_nodes(self, rows: np.ndarray, scores: np.ndarray) -> list[NodeWithScore]:
+        return [
+            NodeWithScore(
+                node=self.docstore.get_node(self.node_ids[row]), score=float(score)
+            )
+            for row, score in zip(rows, scores)
+        ]
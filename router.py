@@ -0,0 +1,254 @@
+import asyncio
+import contextlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+import logging
+
+import numpy as np
+
+from llama_index.embeddings import OpenAIEmbedding
+
+from agents import classification_agent
+from embedding_cache import embedding_cache
+from embedding_store import normalise_rows
+from indexer import (
+    LEXICAL_CONFIDENT_RATIO,
+    BuildRagIndex,
+    index_to_product_mapping,
+    product_descriptions,
+)
+from combined_index import COMBINED_INDEX_NAME, USE_COMBINED_INDEX, combined_index_exists
+from registry import index_registry, index_dir_for
+
+# below this gap between the two best products the llm agent decides
+ROUTER_MIN_MARGIN: float = 0.02
+# softmax temperature used to turn similarities into a confidence
+ROUTER_TEMPERATURE: float = 0.01
+
+logger = logging.getLogger("indexer.router")
+
+
+@dataclass
+class Route:
+    product: str | None
+    confidence: float
+    routed_by: str  # "lexical", "embedding" or "llm"
+
+
+class ProductRouter:
+    """Embedding based replacement for the llm classification agent.
+    - one centroid per product, from its description and the mean of its index vectors
+    - a query that one manual's bm25 index matches far better than the others is routed
+      without embedding it, the rag call then takes the lexical shortcut of that index
+    - any other query is embedded once and scored against all centroids
+    - the llm agent is only asked when the top two products are too close to call
+    """
+
+    def __init__(self, embed_model=None) -> None:
+        self._embed_model = embed_model
+        self.products: list[str] = list(index_to_product_mapping.keys())
+        self.centroids: np.ndarray | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def embed_model(self):
+        if self._embed_model is None:
+            self._embed_model = OpenAIEmbedding()
+        return self._embed_model
+
+    def build_centroids(self) -> np.ndarray:
+        description_embeddings = normalise_rows(
+            np.asarray(
+                embedding_cache.get_text_embeddings(
+                    self.embed_model,
+                    [product_descriptions[product].strip() for product in self.products],
+                ),
+                dtype=np.float32,
+            )
+        )
+        # with the combined index served, do not load every product index just for the means
+        combined_means = (
+            index_registry.get(COMBINED_INDEX_NAME).product_means()
+            if USE_COMBINED_INDEX and combined_index_exists()
+            else None
+        )
+        centroids = []
+        for product, description_embedding in zip(self.products, description_embeddings):
+            doc_filename = index_to_product_mapping[product]
+            if combined_means is not None:
+                index_mean = combined_means.get(product)
+            elif os.path.exists(index_dir_for(doc_filename)):
+                index_mean = self.index_mean(doc_filename)
+            else:
+                index_mean = None
+            if index_mean is None:
+                centroids.append(description_embedding)
+                continue
+            centroids.append(description_embedding + index_mean)
+        return normalise_rows(np.vstack(centroids))
+
+    @staticmethod
+    def product_index(doc_filename: str) -> BuildRagIndex | None:
+        "the loaded index, None when it is not built or cannot be loaded"
+        if not os.path.exists(index_dir_for(doc_filename)):
+            return None
+        try:
+            return index_registry.get(doc_filename)
+        except Exception:
+            # eg. an incomplete index directory
+            logger.exception(f"router: could not load {doc_filename}")
+            return None
+
+    def index_mean(self, doc_filename: str) -> np.ndarray | None:
+        "normalised mean of the index vectors, None when the index cannot be loaded"
+        b = self.product_index(doc_filename)
+        if b is None:
+            # the description alone is the centroid
+            return None
+        return normalise_rows(np.asarray(b.retriever.matrix, dtype=np.float32).mean(axis=0))
+
+    def lexical_route(self, query_text: str) -> Route | None:
+        """
+        the product whose bm25 index answers confidently, with a best score
+        LEXICAL_CONFIDENT_RATIO times that of every other product, eg. an error code or part number
+        """
+        if USE_COMBINED_INDEX:
+            # one lexical index over all manuals, nothing to tell the products apart with
+            return None
+        best_scores = {}
+        for product in self.products:
+            b = self.product_index(index_to_product_mapping[product])
+            if b is None:
+                continue
+            _rows, scores = b.retriever.lexical_search(query_text, 1)
+            if len(scores):
+                best_scores[product] = float(scores[0])
+        if not best_scores:
+            return None
+        ranked = sorted(best_scores, key=best_scores.get, reverse=True)
+        best = ranked[0]
+        if len(ranked) > 1 and best_scores[best] < LEXICAL_CONFIDENT_RATIO * best_scores[ranked[1]]:
+            return None
+        if self.product_index(index_to_product_mapping[best]).confident_lexical_hits(
+            query_text
+        ) is None:
+            return None
+        logger.debug(f"router: lexical match, bm25 best scores: {best_scores}")
+        return Route(best, best_scores[best] / sum(best_scores.values()), "lexical")
+
+    def warm(self) -> None:
+        with self._lock:
+            if self.centroids is None:
+                self.centroids = self.build_centroids()
+
+    def route(self, query_text: str) -> Route:
+        if self.centroids is None:
+            self.warm()
+
+        lexical = self.lexical_route(query_text)
+        if lexical is not None:
+            return lexical
+
+        query_embedding = embedding_cache.get_query_embedding(self.embed_model, query_text)
+        route, decisive = self.score(query_embedding)
+        if decisive:
+            return route
+
+        # too close to call, fall back to the llm agent
+        return self.llm_route(classification_agent(query_text), route.confidence)
+
+    async def aroute(
+        self, query_text: str, llm_semaphore: asyncio.Semaphore | None = None
+    ) -> Route:
+        """
+        async version of route, using the async embedding and llm clients
+        - llm_semaphore is only held for the llm agent fallback
+        """
+        if self.centroids is None:
+            self.warm()
+
+        lexical = self.lexical_route(query_text)
+        if lexical is not None:
+            return lexical
+
+        query_embedding = await embedding_cache.aget_query_embedding(
+            self.embed_model, query_text
+        )
+        route, decisive = self.score(query_embedding)
+        if decisive:
+            return route
+
+        # too close to call, fall back to the llm agent
+        async with llm_semaphore or contextlib.nullcontext():
+            agent_output = await classification_agent.acall(query_text)
+        return self.llm_route(agent_output, route.confidence)
+
+    async def aroute_batch(
+        self,
+        query_texts: list[str],
+        query_embeddings: list[list[float]],
+        llm_semaphore: asyncio.Semaphore | None = None,
+    ) -> list[Route]:
+        """
+        routes for many already embedded queries
+        - all queries are scored in one matrix product
+        - only the ones too close to call ask the llm agent, concurrently, capped by llm_semaphore
+        """
+        if self.centroids is None:
+            self.warm()
+
+        async def decide(query_text: str, route: Route, decisive: bool) -> Route:
+            if decisive:
+                return route
+            async with llm_semaphore or contextlib.nullcontext():
+                agent_output = await classification_agent.acall(query_text)
+            return self.llm_route(agent_output, route.confidence)
+
+        return await asyncio.gather(
+            *(
+                decide(query_text, route, decisive)
+                for query_text, (route, decisive) in zip(
+                    query_texts, self.score_batch(query_embeddings)
+                )
+            )
+        )
+
+    def score(self, query_embedding) -> tuple[Route, bool]:
+        "best product by centroid similarity, and whether it is clear enough to skip the llm agent"
+        [scored] = self.score_batch([query_embedding])
+        return scored
+
+    def score_batch(self, query_embeddings) -> list[tuple[Route, bool]]:
+        "score for every query, in one matrix product"
+        start = time.perf_counter()
+        queries = normalise_rows(np.atleast_2d(np.asarray(query_embeddings, np.float32)))
+        # (num_queries, num_products)
+        all_scores = queries @ self.centroids.T
+        route_seconds = time.perf_counter() - start
+
+        scored = []
+        for scores in all_scores:
+            best, second = np.argsort(-scores)[:2]
+            margin = float(scores[best] - scores[second])
+            weights = np.exp((scores - scores.max()) / ROUTER_TEMPERATURE)
+            confidence = float(weights[best] / weights.sum())
+
+            logger.debug(
+                f"router scores: {dict(zip(self.products, np.round(scores, 4).tolist()))}, "
+                f"margin: {margin:.4f}, scored in {route_seconds * 1000:.3f} ms"
+            )
+            decisive = margin >= ROUTER_MIN_MARGIN
+            scored.append((Route(self.products[best], confidence, "embedding"), decisive))
+        return scored
+
+    def llm_route(self, agent_output: str, confidence: float) -> Route:
+        product = agent_output.strip()
+        logger.debug(f"router fell back to llm agent: {product}")
+        if product not in index_to_product_mapping:
+            return Route(None, confidence, "llm")
+        return Route(product, confidence, "llm")
+
+
+product_router = ProductRouter()
@@ -0,0 +1,67 @@
+"""
+Import cost of a module, eg. the `main:app` serving path, per top level package.
+
+python startup_report.py [main] [--top 15]
+
+- imports the module in a fresh interpreter with `-X importtime`, so nothing is already cached
+- sums the self time of every imported module per top level package
+- flags ingestion only packages that should not be imported when serving
+"""
+import argparse
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# only needed to partition pdfs, never on the serving path
+INGESTION_ONLY_PACKAGES = ("unstructured", "pypdf", "partitioning", "extraction_cache")
+
+
+def import_times(module: str) -> tuple[list[tuple[str, int, int]], float]:
+    "(module, self us, cumulative us) of every import, and the wall time of the interpreter"
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    wall_seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports, wall_seconds
+
+
+def report(module: str, top: int) -> None:
+    imports, wall_seconds = import_times(module)
+    per_package = defaultdict(int)
+    for name, self_us, _cumulative_us in imports:
+        per_package[name.split(".")[0]] += self_us
+
+    total_us = sum(per_package.values())
+    print(f"import {module}: {total_us / 1e6:.2f}s in imports, {wall_seconds:.2f}s wall")
+    print(f"{'package':<32}{'self (s)':>10}{'share':>8}")
+    for package, self_us in sorted(per_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"{package:<32}{self_us / 1e6:>10.3f}{self_us / total_us:>8.1%}")
+
+    print("\nslowest modules by cumulative time")
+    for name, _self_us, cumulative_us in sorted(imports, key=lambda item: -item[2])[:top]:
+        print(f"{name:<48}{cumulative_us / 1e6:>10.3f}")
+
+    loaded = sorted(set(per_package).intersection(INGESTION_ONLY_PACKAGES))
+    if loaded:
+        print(f"\ningestion only packages imported: {', '.join(loaded)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per package import cost of a module")
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    report(args.module, args.top)
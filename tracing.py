@@ -0,0 +1,178 @@
+"""
+Structured per stage timings for the query pipeline.
+
+- `trace` wraps one request, `span` times one stage inside it
+- spans carry attributes such as node and token counts
+- a finished trace is written as one json line to trace.log, through a queue,
+  so the request path never waits on file io
+- every span duration also lands in an in-process histogram, for p50/p95/p99 per stage
+"""
+import atexit
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Callable, Iterator
+import logging
+
+import numpy as np
+
+TRACE_LOG_PATH = "trace.log"
+# keep per stage histograms in memory, served by GET /timings/
+TRACE_HISTOGRAMS: bool = True
+# most recent samples kept per stage
+HISTOGRAM_SIZE: int = 4096
+
+
+def queued_file_handler(path: str, level: int = logging.DEBUG) -> QueueHandler:
+    "a handler that only enqueues records, a background thread writes them to the file"
+    queue = SimpleQueue()
+    file_handler = logging.FileHandler(path, mode="a")
+    file_handler.setLevel(level)
+    listener = QueueListener(queue, file_handler, respect_handler_level=True)
+    listener.start()
+    # flush what is still queued on interpreter exit
+    atexit.register(listener.stop)
+    handler = QueueHandler(queue)
+    handler.setLevel(level)
+    return handler
+
+
+trace_logger = logging.getLogger("tracing")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+trace_logger.addHandler(queued_file_handler(TRACE_LOG_PATH, logging.INFO))
+
+
+@dataclass
+class Span:
+    name: str
+    start: float = field(default_factory=time.perf_counter)
+    seconds: float = 0.0
+    attributes: dict = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    name: str
+    attributes: dict = field(default_factory=dict)
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    started_at: float = field(default_factory=time.time)
+    start: float = field(default_factory=time.perf_counter)
+    spans: list[Span] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "started_at": self.started_at,
+                "duration_ms": round((time.perf_counter() - self.start) * 1000, 3),
+                **self.attributes,
+                "spans": [
+                    {
+                        "name": span.name,
+                        "offset_ms": round((span.start - self.start) * 1000, 3),
+                        "duration_ms": round(span.seconds * 1000, 3),
+                        **span.attributes,
+                    }
+                    for span in self.spans
+                ],
+            },
+            default=str,
+        )
+
+
+class StageHistograms:
+    "bounded samples of recent span durations per stage"
+
+    def __init__(self, size: int = HISTOGRAM_SIZE) -> None:
+        self.size = size
+        self._samples: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.size)
+            samples.append(seconds)
+
+    def percentiles(self) -> dict[str, dict]:
+        with self._lock:
+            snapshot = {stage: np.asarray(samples) for stage, samples in self._samples.items()}
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 3),
+                "p95_ms": round(float(np.percentile(values, 95)) * 1000, 3),
+                "p99_ms": round(float(np.percentile(values, 99)) * 1000, 3),
+            }
+            for stage, values in snapshot.items()
+            if len(values)
+        }
+
+
+stage_histograms = StageHistograms()
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+@contextlib.contextmanager
+def trace(name: str, **attributes) -> Iterator[Trace]:
+    "one request, written to trace.log when it ends"
+    active = Trace(name, attributes)
+    token = current_trace.set(active)
+    try:
+        yield active
+    finally:
+        current_trace.reset(token)
+        write_trace(active)
+
+
+def write_trace(finished: Trace) -> None:
+    trace_logger.info(finished.to_json())
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """
+    time one stage, add counts to span.attributes inside the block
+    span.seconds is set when the block exits
+    """
+    active = Span(name, attributes=attributes)
+    try:
+        yield active
+    finally:
+        active.seconds = time.perf_counter() - active.start
+        record(active)
+
+
+def record(finished: Span) -> None:
+    "attach a finished span to the current trace, if any, and to the histograms"
+    active = current_trace.get()
+    if active is not None:
+        # list.append is atomic, spans may finish on executor threads
+        active.spans.append(finished)
+    if TRACE_HISTOGRAMS:
+        stage_histograms.record(finished.name, finished.seconds)
+
+
+def in_context(fn: Callable, *args) -> Callable:
+    "bind fn to the current context, so spans recorded on an executor thread join the trace"
+    return functools.partial(contextvars.copy_context().run, fn, *args)
+
+
+def count_tokens(text: str) -> int:
+    "tokens as counted by llama_index when it packs prompts"
+    from llama_index.utils import globals_helper
+
+    return len(globals_helper.tokenizer(text))